@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+""" Benchmark of the two ways an upload's checksum is verified: iput -K, or local digests with iput -k and ichksum """
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench_end_to_end
+import file_checksum
+import irods_upload
+
+WRITE_CHUNK_SIZE = 16 * 1024 * 1024
+# The collection the files are uploaded into when the fake iRODS commands are used
+FAKE_IRODS_LOCATION = '/fakeZone/home/benchmark/checksum'
+
+
+def make_file(file_path: str, size_bytes: int) -> None:
+    """Writes a file of random bytes
+    Arguments:
+        file_path: the path of the file to write
+        size_bytes: the size of the file
+    """
+    with open(file_path, 'wb') as out_file:
+        remaining = size_bytes
+        while remaining > 0:
+            chunk_size = min(WRITE_CHUNK_SIZE, remaining)
+            out_file.write(os.urandom(chunk_size))
+            remaining -= chunk_size
+        out_file.flush()
+        os.fsync(out_file.fileno())
+
+
+def drop_cache(file_path: str) -> None:
+    """Asks the operating system to drop the file from its page cache so that reads come from the disk
+    Arguments:
+        file_path: the path of the file
+    """
+    if hasattr(os, 'posix_fadvise'):
+        file_desc = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(file_desc, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(file_desc)
+
+
+def iput_verify(uploader: irods_upload.Uploader, file_path: str) -> None:
+    """Uploads a file with iput -K, which checksums the local file and has the server checksum the stored one
+    Arguments:
+        uploader: the iput uploader
+        file_path: the path of the file
+    """
+    uploader.upload(file_path)
+
+
+def local_digests(uploader: irods_upload.Uploader, file_path: str, use_mmap: bool = False) -> None:
+    """Computes the digests of a file locally, uploads it with iput -k and compares the checksum from ichksum
+    Arguments:
+        uploader: the iput uploader
+        file_path: the path of the file
+        use_mmap: set to True to memory map the file when computing the digests
+    """
+    uploader.upload(file_path, file_checksum.compute_digests(file_path, use_mmap=use_mmap))
+
+
+def run() -> None:
+    """Runs the benchmark and prints the results"""
+    parser = argparse.ArgumentParser(description='Benchmark the checksum verification of iRODS uploads of large files')
+    parser.add_argument('--size_mb', type=int, default=1024, help='Size of each synthetic file in MiB')
+    parser.add_argument('--files', type=int, default=2, help='Number of synthetic files')
+    parser.add_argument('--dir', type=str, default=None, help='Folder to create the synthetic files in')
+    parser.add_argument('--irods_location', type=str, default=None,
+                        help='iRODS collection to upload into with the real icommands instead of the fake ones')
+    args = parser.parse_args()
+
+    methods = (('iput -K', iput_verify),
+               ('digests + iput -k', local_digests),
+               ('digests mmap + iput -k', lambda uploader, file_path: local_digests(uploader, file_path, True)))
+    with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+        irods_location = args.irods_location
+        if not irods_location:
+            bin_dir = os.path.join(work_dir, 'bin')
+            zone_dir = os.path.join(work_dir, 'zone')
+            os.makedirs(bin_dir)
+            os.makedirs(zone_dir)
+            bench_end_to_end.install_fake_irods(bin_dir, zone_dir, 0)
+            irods_location = FAKE_IRODS_LOCATION
+        uploader = irods_upload.IputUploader(irods_location)
+
+        file_paths = [os.path.join(work_dir, 'synthetic_%s.tif' % str(idx)) for idx in range(args.files)]
+        for one_path in file_paths:
+            make_file(one_path, args.size_mb * 1024 * 1024)
+
+        total_size = args.files * args.size_mb * 1024 * 1024
+        print("%-24s %10s %10s" % ('method', 'seconds', 'MiB/s'))
+        for method_name, method in methods:
+            elapsed = 0.0
+            for one_path in file_paths:
+                drop_cache(one_path)
+                start = time.monotonic()
+                method(uploader, one_path)
+                elapsed += time.monotonic() - start
+            print("%-24s %10.2f %10.1f" % (method_name, elapsed, total_size / (1024 * 1024) / elapsed))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+""" Benchmark of filtering a very large synthetic folder listing for the files to download """
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import file_matcher
+
+EXTENSIONS = ('.tif', '.TIF', '.tiff', '.TIFF')
+EXCLUDE_PARTS = ('_10pct', '_thumb', '_copy', '_mask', '_nrmac', 'test')
+SYNTHETIC_SUFFIXES = ('.tif', '.tif', '_10pct.tif', '_thumb.tif', '_mask.tif', '.json', '.txt', '.TIFF', '.xml', '_copy.tiff')
+
+
+def make_listing(num_entries: int) -> list:
+    """Returns a synthetic folder listing in the format returned by Globus
+    Arguments:
+        num_entries: the number of entries in the listing
+    Return:
+        Returns the list of entries
+    """
+    rng = random.Random(42)
+    listing = []
+    for idx in range(num_entries):
+        if idx % 1000 == 0:
+            listing.append({'name': 'sub_%s' % str(idx), 'type': 'dir', 'size': 0})
+        else:
+            listing.append({'name': 'rgb_fullfield_%s%s' % (str(idx), rng.choice(SYNTHETIC_SUFFIXES)),
+                            'type': 'file', 'size': rng.randint(1, 1024 * 1024 * 1024)})
+    return listing
+
+
+def list_scan_filter(folder_path: str, listing: list) -> list:
+    """Filters the listing by splitting off each extension and scanning the extension and fragment lists
+    Arguments:
+        folder_path: the path of the listed folder
+        listing: the entries of the listing
+    Return:
+        Returns the list of (file path, entry) tuples that are wanted
+    """
+    check_ext = [e.lstrip('.') for e in EXTENSIONS]
+    matches = []
+    for one_entry in listing:
+        if one_entry['type'] != 'dir':
+            file_path = os.path.join(folder_path, one_entry['name'])
+            logging.debug("Globus remote file path: %s", file_path)
+
+            file_format = os.path.splitext(one_entry['name'])[1]
+            if file_format:
+                file_format = file_format.lstrip('.')
+            if file_format not in check_ext:
+                logging.debug("   remote file doesn't match extension: %s %s", os.path.basename(file_path), check_ext)
+                continue
+
+            found_exclude = False
+            for part in EXCLUDE_PARTS:
+                if part in one_entry['name']:
+                    found_exclude = True
+                    break
+            if found_exclude:
+                continue
+
+            matches.append((file_path, one_entry))
+    return matches
+
+
+def matcher_filter(folder_path: str, listing: list) -> list:
+    """Filters the listing with a precompiled file matcher
+    Arguments:
+        folder_path: the path of the listed folder
+        listing: the entries of the listing
+    Return:
+        Returns the list of (file path, entry) tuples that are wanted
+    """
+    matcher = file_matcher.FileMatcher(EXTENSIONS, exclude_parts=EXCLUDE_PARTS)
+    return list(matcher.filter_entries(folder_path, listing))
+
+
+def run() -> None:
+    """Runs the benchmark and prints the results"""
+    parser = argparse.ArgumentParser(description='Benchmark filtering a large folder listing')
+    parser.add_argument('--entries', type=int, default=1000000, help='Number of entries in the synthetic listing')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times to run each method, keeping the fastest')
+    args = parser.parse_args()
+
+    folder_path = '/-/ua-mac/public/season-6/Level_2/rgb_fullfield/2018-05-01'
+    listing = make_listing(args.entries)
+
+    methods = (('list scan', list_scan_filter), ('precompiled matcher', matcher_filter))
+    results = {}
+    print("%-20s %10s %12s %14s" % ('method', 'seconds', 'matches', 'entries/s'))
+    for method_name, method in methods:
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            matches = method(folder_path, listing)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[method_name] = matches
+        print("%-20s %10.3f %12d %14.0f" % (method_name, best, len(matches), len(listing) / best))
+
+    if results['list scan'] != results['precompiled matcher']:
+        print("Methods found different files")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
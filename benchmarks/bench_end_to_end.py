@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+""" Offline end to end benchmark of get_terraref.py and get_10pct.py against a fake Globus endpoint and iRODS zone """
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import concurrency_control
+import fake_globus
+import file_selection
+import run_metrics
+import task_monitor
+import transfer_sinks
+
+GIGABYTE = 1000 * 1000 * 1000
+# The scripts that can be benchmarked
+SCRIPTS = {'terraref': 'get_terraref', '10pct': 'get_10pct'}
+
+
+def install_fake_irods(bin_dir: str, zone_dir: str, upload_bytes_per_second: float) -> None:
+    """Puts the fake iRODS commands first on the PATH
+    Arguments:
+        bin_dir: the folder to link the commands into
+        zone_dir: the folder holding the records of the fake data objects
+        upload_bytes_per_second: the simulated upload bandwidth (0 for no delay)
+    """
+    fake_script = os.path.join(BENCHMARK_DIR, 'fake_irods.py')
+    os.chmod(fake_script, 0o755)
+    for one_command in ('iput', 'icd', 'ils', 'iquest', 'ichksum'):
+        os.symlink(fake_script, os.path.join(bin_dir, one_command))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['FAKE_IRODS_ZONE'] = zone_dir
+    os.environ['FAKE_IRODS_BYTES_PER_SECOND'] = str(upload_bytes_per_second)
+
+
+def script_arguments(args: argparse.Namespace, save_dir: str) -> list:
+    """Returns the command line of a script for the benchmark's settings
+    Arguments:
+        args: the benchmark's command line arguments
+        save_dir: the folder files are downloaded to
+    Return:
+        Returns the list of arguments to parse
+    """
+    argv = ['--save_path', save_dir, '--local_endpoint_id', 'fake-local-endpoint', '--no_credentials', '--no_cache',
+            '--no_journal', '--list_workers', str(args.list_workers), '--batch_files', str(args.batch_files),
+            '--max_active_tasks', str(args.max_active_tasks), '--retries', str(args.retries),
+            '--staging_budget', str(int(args.staging_gb * GIGABYTE))]
+    if args.fixed_concurrency:
+        argv.append('--fixed_concurrency')
+    if args.sink:
+        argv.extend(('--sink', args.sink))
+    if args.script == 'terraref':
+        argv.extend(('--select', file_selection.POLICY_LARGEST, '--upload_workers', str(args.upload_workers),
+                     '--irods_location', '/fakeZone/home/benchmark/terraref'))
+        if args.local_checksums:
+            argv.append('--local_checksum')
+    return argv
+
+
+def run_once(args: argparse.Namespace, work_dir: str) -> dict:
+    """Runs one script end to end over a synthetic season
+    Arguments:
+        args: the benchmark's command line arguments
+        work_dir: an empty folder for the run
+    Return:
+        Returns the results of the run
+    """
+    save_dir = os.path.join(work_dir, 'download')
+    bin_dir = os.path.join(work_dir, 'bin')
+    zone_dir = os.path.join(work_dir, 'zone')
+    for one_dir in (save_dir, bin_dir, zone_dir):
+        os.makedirs(one_dir)
+    install_fake_irods(bin_dir, zone_dir, args.upload_gb_per_second * GIGABYTE)
+    # Schedule the status checks of the tasks for the simulated link instead of a real one
+    task_monitor.MONITOR_ASSUMED_BYTES_PER_SECOND = args.link_gb_per_second * GIGABYTE
+
+    script = importlib.import_module(SCRIPTS[args.script])
+    script_args = script.parse_args(script_arguments(args, save_dir))
+    metrics = run_metrics.RunMetrics()
+
+    listings = fake_globus.make_season(script.GLOBUS_PATH, args.folders, int(args.file_gb * GIGABYTE))
+    client = fake_globus.FakeTransferClient(listings, script.GLOBUS_ENDPOINT, args.link_gb_per_second * GIGABYTE,
+                                            args.task_latency, args.ls_latency, args.failure_rate)
+
+    start = time.monotonic()
+    error = None
+    try:
+        script.run(script_args, client, metrics)
+    except RuntimeError as ex:
+        error = str(ex)
+    elapsed = time.monotonic() - start
+
+    transfer_stage = metrics.report()['stages'].get('transfer', {})
+    files = transfer_stage.get('files', 0)
+    num_bytes = transfer_stage.get('bytes', 0)
+    if args.script == 'terraref' and script_args.sink == transfer_sinks.SINK_IRODS:
+        uploaded = sum(len(one_names) for _, _, one_names in os.walk(zone_dir))
+    else:
+        uploaded = None
+
+    return {'script': args.script, 'folders': args.folders, 'file_gb': args.file_gb, 'seconds': elapsed,
+            'files': files, 'bytes': num_bytes, 'uploaded': uploaded, 'error': error,
+            'files_per_second': files / elapsed, 'gb_per_second': num_bytes / GIGABYTE / elapsed,
+            'client_calls': client.calls, 'report': metrics.report()}
+
+
+def run() -> None:
+    """Runs the benchmark and prints the results"""
+    parser = argparse.ArgumentParser(description='Benchmark a script end to end against fake Globus and iRODS services')
+    parser.add_argument('--script', type=str, choices=tuple(SCRIPTS.keys()), default='terraref', help='Script to run')
+    parser.add_argument('--folders', type=int, default=500, help='Number of daily folders in the synthetic season')
+    parser.add_argument('--file_gb', type=float, default=2.0, help='Size of the full field image in each folder in GB')
+    parser.add_argument('--link_gb_per_second', type=float, default=50.0, help='Bandwidth of the simulated Globus link')
+    parser.add_argument('--task_latency', type=float, default=1.0,
+                        help='Seconds each Globus task is queued before its files start to transfer')
+    parser.add_argument('--ls_latency', type=float, default=0.02, help='Seconds each folder listing request takes')
+    parser.add_argument('--failure_rate', type=float, default=0.0, help='Fraction of files that fail to transfer')
+    parser.add_argument('--upload_gb_per_second', type=float, default=0.0,
+                        help='Bandwidth of the simulated iRODS uploads (0 for no delay)')
+    parser.add_argument('--list_workers', type=int, default=8, help='Maximum number of folders listed at the same time')
+    parser.add_argument('--batch_files', type=int, default=100, help='Maximum number of files in one Globus task')
+    parser.add_argument('--max_active_tasks', type=int, default=4, help='Maximum number of active Globus tasks')
+    parser.add_argument('--upload_workers', type=int, default=1, help='Number of concurrent uploads to iRODS')
+    parser.add_argument('--staging_gb', type=float, default=1000.0,
+                        help='Staging budget in GB; the staged files are sparse so they use little disk space')
+    parser.add_argument('--local_checksums', action='store_true',
+                        help='Checksum the staged files locally, which reads every synthetic byte')
+    parser.add_argument('--retries', type=int, default=concurrency_control.RETRY_ATTEMPTS,
+                        help='Number of times a failed transfer or upload of a file is tried again')
+    parser.add_argument('--fixed_concurrency', action='store_true',
+                        help='Always run the maximum numbers of listings, transfer tasks and uploads at the same time')
+    parser.add_argument('--sink', type=str, choices=transfer_sinks.SINKS, default=None,
+                        help='Where the downloaded files go (defaults to the script\'s own default)')
+    parser.add_argument('--dir', type=str, default=None, help='Folder to create the run folder in')
+    parser.add_argument('--json', type=str, default=None, help='File to write the results to for comparing runs')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+        results = run_once(args, work_dir)
+
+    print("script %s: %s folders of %s GB files" % (results['script'], str(results['folders']), str(results['file_gb'])))
+    print("%-10s %10s %14s %10s %10s" % ('seconds', 'files', 'bytes', 'files/s', 'GB/s'))
+    print("%-10.2f %10d %14d %10.2f %10.3f" % (results['seconds'], results['files'], results['bytes'],
+                                               results['files_per_second'], results['gb_per_second']))
+    if results['uploaded'] is not None:
+        print("uploaded to the fake iRODS zone:", results['uploaded'])
+    if results['error']:
+        print("run failed:", results['error'])
+    for stage_name, stage_report in sorted(results['report']['stages'].items()):
+        print("  %-20s %8d ops  p50 %8.3fs  p95 %8.3fs  p99 %8.3fs  wall %8.2fs" %
+              (stage_name, stage_report['operations'], stage_report['p50'], stage_report['p95'], stage_report['p99'],
+               stage_report['wall_seconds']))
+    for one_name, one_count in sorted(results['report']['counters'].items()):
+        if one_name.endswith('_retries') or one_name.endswith('_limit_increases') or one_name.endswith('_limit_decreases'):
+            print("  %-30s %8d" % (one_name, one_count))
+
+    if args.json:
+        with open(args.json, 'w') as out_file:
+            json.dump(results, out_file, indent=2, sort_keys=True)
+            out_file.write('\n')
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,214 @@
+""" In-process fake of the Globus TransferClient that simulates listings, task latency and bandwidth """
+
+import datetime
+import os
+import random
+import threading
+import time
+import uuid
+
+# The ID of the fake remote endpoint
+FAKE_ENDPOINT_ID = 'fake-remote-endpoint'
+
+
+def make_season(base_path: str, num_folders: int, file_size: int, extra_files: bool = True) -> dict:
+    """Returns the listings of a synthetic season of daily folders
+    Arguments:
+        base_path: the remote path holding the season's folders
+        num_folders: the number of daily folders
+        file_size: the size of the full field image in each folder
+        extra_files: set to False to only have the full field image in each folder
+    Return:
+        Returns a dictionary of remote folder paths to their listing entries
+    Notes:
+        Besides the full field image, each folder has the files the scripts skip or fetch separately: a 10 percent
+        image, a thumbnail, a mask and the metadata
+    """
+    base_path = base_path.rstrip('/')
+    first_day = datetime.date(2018, 5, 1)
+    modified = '2018-09-01 00:00:00+00:00'
+    listings = {base_path: []}
+    for idx in range(num_folders):
+        folder_name = (first_day + datetime.timedelta(days=idx)).isoformat()
+        listings[base_path].append({'name': folder_name, 'type': 'dir', 'size': 0, 'last_modified': modified})
+
+        prefix = 'rgb_fullfield_L2_ua-mac_%s' % folder_name
+        entries = [{'name': prefix + '.tif', 'type': 'file', 'size': file_size, 'last_modified': modified}]
+        if extra_files:
+            entries.extend([
+                {'name': prefix + '_10pct.tif', 'type': 'file', 'size': max(1, file_size // 100), 'last_modified': modified},
+                {'name': prefix + '_thumb.tif', 'type': 'file', 'size': max(1, file_size // 1000), 'last_modified': modified},
+                {'name': prefix + '_mask.tif', 'type': 'file', 'size': max(1, file_size // 10), 'last_modified': modified},
+                {'name': prefix + '_metadata.json', 'type': 'file', 'size': 4096, 'last_modified': modified},
+            ])
+        listings[base_path + '/' + folder_name] = entries
+    return listings
+
+
+class FakeTransferClient:
+    """Stands in for globus_sdk.TransferClient, completing transfer tasks by creating sparse local files
+    Notes:
+        Tasks share one simulated link: each task waits for the task latency and then for the link to be free
+        before its bytes are sent at the link's bandwidth. Files can be made to fail at random to exercise the
+        handling of skipped files. As with a sync transfer, a file already at its destination with the same size
+        isn't sent again and is left out of the task's successful transfers
+    """
+
+    def __init__(self, listings: dict, endpoint_name: str, bytes_per_second: float, task_latency: float = 1.0,
+                 ls_latency: float = 0.0, failure_rate: float = 0.0, seed: int = 0):
+        """Initializes the fake client
+        Arguments:
+            listings: dictionary of remote folder paths to their listing entries, as returned by make_season()
+            endpoint_name: the display name of the fake remote endpoint
+            bytes_per_second: the bandwidth of the simulated link
+            task_latency: the number of seconds a task is queued before its files start to transfer
+            ls_latency: the number of seconds each listing request takes
+            failure_rate: the fraction of files, from 0 to 1, that fail to transfer
+            seed: the seed of the random failures
+        """
+        self._listings = {one_path.rstrip('/'): one_entries for one_path, one_entries in listings.items()}
+        self._sizes = {one_path + '/' + one_entry['name']: one_entry['size']
+                       for one_path, one_entries in self._listings.items() for one_entry in one_entries}
+        self._endpoint_name = endpoint_name
+        self._bytes_per_second = bytes_per_second
+        self._task_latency = task_latency
+        self._ls_latency = ls_latency
+        self._failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._link_free = 0.0
+        self._tasks = {}
+        self.calls = {}
+
+    def _called(self, name: str) -> None:
+        """Counts a call of a client method
+        Arguments:
+            name: the name of the method
+        """
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def endpoint_search(self, filter_fulltext: str = None, filter_scope: str = None, **params) -> list:
+        """Returns the fake remote endpoint"""
+        self._called('endpoint_search')
+        return [{'id': FAKE_ENDPOINT_ID, 'display_name': self._endpoint_name, 'canonical_name': self._endpoint_name}]
+
+    def operation_ls(self, endpoint_id: str, path: str = '/', offset: int = 0, limit: int = None, **params) -> dict:
+        """Returns a page of the listing of a folder
+        Arguments:
+            endpoint_id: the ID of the endpoint
+            path: the path of the folder
+            offset: the index of the first entry to return
+            limit: the maximum number of entries to return
+        Return:
+            Returns the page in the format of the Globus ls operation; unknown folders are empty
+        """
+        self._called('operation_ls')
+        if self._ls_latency:
+            time.sleep(self._ls_latency)
+        entries = self._listings.get(path.rstrip('/'), [])
+        page = entries[offset:offset + limit] if limit else entries[offset:]
+        return {'DATA': page, 'path': path, 'offset': offset, 'limit': limit, 'total': len(entries)}
+
+    def get_submission_id(self) -> dict:
+        """Returns a new submission ID"""
+        self._called('get_submission_id')
+        return {'value': str(uuid.uuid4())}
+
+    def submit_transfer(self, transfer_data: dict) -> dict:
+        """Queues a transfer task on the simulated link
+        Arguments:
+            transfer_data: the globus_sdk.TransferData describing the task
+        Return:
+            Returns the task ID in the format of the Globus submission response
+        """
+        self._called('submit_transfer')
+        items = [{'source_path': one_item['source_path'], 'destination_path': one_item['destination_path'],
+                  'size': self._sizes.get(one_item['source_path'])} for one_item in transfer_data['DATA']]
+        now = time.monotonic()
+        with self._lock:
+            for one_item in items:
+                one_item['failed'] = one_item['size'] is None or self._random.random() < self._failure_rate
+                one_item['synced'] = transfer_data.get('sync_level') is not None and not one_item['failed'] and \
+                    os.path.exists(one_item['destination_path']) and \
+                    os.path.getsize(one_item['destination_path']) == one_item['size']
+            task_bytes = sum(one_item['size'] for one_item in items if not one_item['failed'] and not one_item['synced'])
+            start = max(now + self._task_latency, self._link_free)
+            self._link_free = start + task_bytes / self._bytes_per_second
+            task_id = str(uuid.uuid4())
+            self._tasks[task_id] = {'status': 'ACTIVE', 'done_at': self._link_free, 'items': items}
+        return {'task_id': task_id, 'code': 'Accepted'}
+
+    def _update_task(self, task_id: str) -> dict:
+        """Completes a task once its transfer time has passed, creating its files
+        Arguments:
+            task_id: the ID of the task
+        Return:
+            Returns the task
+        """
+        with self._lock:
+            task = self._tasks[task_id]
+            if task['status'] != 'ACTIVE' or time.monotonic() < task['done_at']:
+                return task
+            task['status'] = 'SUCCEEDED'
+
+        for one_item in task['items']:
+            if not one_item['failed'] and not one_item['synced']:
+                with open(one_item['destination_path'], 'wb') as out_file:
+                    out_file.truncate(one_item['size'])
+        return task
+
+    def get_task(self, task_id: str) -> dict:
+        """Returns the status of a task"""
+        self._called('get_task')
+        task = self._update_task(task_id)
+        return {'task_id': task_id, 'status': task['status']}
+
+    def task_wait(self, task_id: str, timeout: int = 10, polling_interval: int = 10) -> bool:
+        """Waits for a task to finish
+        Return:
+            Returns True if the task finished before the timeout
+        """
+        self._called('task_wait')
+        deadline = time.monotonic() + timeout
+        while self._update_task(task_id)['status'] == 'ACTIVE':
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(min(polling_interval, max(0.0, deadline - time.monotonic())))
+        return True
+
+    def cancel_task(self, task_id: str) -> dict:
+        """Cancels a task, failing its files"""
+        self._called('cancel_task')
+        with self._lock:
+            task = self._tasks[task_id]
+            if task['status'] == 'ACTIVE':
+                task['status'] = 'FAILED'
+                for one_item in task['items']:
+                    one_item['failed'] = True
+        return {'code': 'Canceled'}
+
+    def task_successful_transfers(self, task_id: str, num_results: int = 100, **params) -> list:
+        """Returns the files of a task that were transferred, which leaves out the files skipped by the sync"""
+        self._called('task_successful_transfers')
+        task = self._tasks[task_id]
+        return [{'source_path': one_item['source_path'], 'destination_path': one_item['destination_path']}
+                for one_item in task['items']
+                if task['status'] == 'SUCCEEDED' and not one_item['failed'] and not one_item['synced']]
+
+    def task_skipped_errors(self, task_id: str, num_results: int = 100, **params) -> list:
+        """Returns the files of a task that failed"""
+        self._called('task_skipped_errors')
+        return [{'source_path': one_item['source_path'], 'destination_path': one_item['destination_path'],
+                 'error_code': 'NOT_FOUND' if one_item['size'] is None else 'PERMISSION_DENIED'}
+                for one_item in self._tasks[task_id]['items'] if one_item['failed']]
+
+
+def local_save_paths(save_dir: str) -> list:
+    """Returns the files created in a folder by fake transfers
+    Arguments:
+        save_dir: the folder the files were saved to
+    Return:
+        Returns the paths of the image files in the folder
+    """
+    return [os.path.join(save_dir, one_name) for one_name in os.listdir(save_dir) if one_name.endswith('.tif')]
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+""" Fake iRODS icommands (iput, icd, ils, iquest, ichksum) that store data objects as records in a local folder
+
+The command to run is taken from the name the script is called by, so it's installed by linking each command
+name to this script. The FAKE_IRODS_ZONE environment variable names the folder holding the records, and
+FAKE_IRODS_BYTES_PER_SECOND optionally slows down iput to simulate the upload bandwidth of the server, and
+FAKE_IRODS_HASH_SCHEME set to MD5 stores checksums the way a zone with an MD5 default_hash_scheme does.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+# The commands provided by this script
+COMMANDS = ('iput', 'icd', 'ils', 'iquest', 'ichksum')
+# The size of each read when checksumming a file
+READ_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def _record_path(irods_path: str) -> str:
+    """Returns the path of the record of a data object
+    Arguments:
+        irods_path: the absolute path of the data object
+    Return:
+        Returns the path of the local file holding the record
+    """
+    return os.path.join(os.environ['FAKE_IRODS_ZONE'], irods_path.lstrip('/')) + '.json'
+
+
+def _checksum(local_path: str) -> str:
+    """Returns the iRODS checksum of a local file
+    Arguments:
+        local_path: the path of the file
+    Return:
+        Returns the hex MD5 digest for a zone using MD5, otherwise 'sha2:' followed by the base64 encoded SHA-256 digest
+    """
+    use_md5 = os.environ.get('FAKE_IRODS_HASH_SCHEME', 'SHA256').upper() == 'MD5'
+    hasher = hashlib.md5() if use_md5 else hashlib.sha256()
+    with open(local_path, 'rb') as in_file:
+        while True:
+            chunk = in_file.read(READ_BUFFER_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    if use_md5:
+        return hasher.hexdigest()
+    return 'sha2:' + base64.b64encode(hasher.digest()).decode('ascii')
+
+
+def iput(args: list) -> int:
+    """Stores a record of a local file as a data object
+    Arguments:
+        args: the command line arguments: flags, the local path, and the data object path
+    Return:
+        Returns the exit code of the command
+    Notes:
+        The checksum is only computed when the -k or -K flag asks for it, so that large synthetic files aren't read
+        when the caller doesn't compare checksums. As with iput, -k only has the server compute the checksum, while
+        -K also computes it from the local file and fails if the two differ
+    """
+    paths = [one_arg for one_arg in args if not one_arg.startswith('-')]
+    if len(paths) != 2 or not os.path.isfile(paths[0]):
+        print("USER_INPUT_PATH_ERR", file=sys.stderr)
+        return 1
+    local_path, irods_path = paths
+
+    file_size = os.path.getsize(local_path)
+    bytes_per_second = float(os.environ.get('FAKE_IRODS_BYTES_PER_SECOND', '0'))
+    if bytes_per_second > 0:
+        time.sleep(file_size / bytes_per_second)
+
+    checksum = None
+    if '-k' in args or '-K' in args:
+        checksum = _checksum(local_path)
+    if '-K' in args and _checksum(local_path) != checksum:
+        print("USER_CHKSUM_MISMATCH", file=sys.stderr)
+        return 1
+    record = {'size': file_size, 'checksum': checksum}
+    os.makedirs(os.path.dirname(_record_path(irods_path)), exist_ok=True)
+    with open(_record_path(irods_path), 'w') as out_file:
+        json.dump(record, out_file)
+    return 0
+
+
+def ils(args: list) -> int:
+    """Lists a collection, which always exists in the fake zone
+    Arguments:
+        args: the command line arguments
+    Return:
+        Returns the exit code of the command
+    """
+    for one_arg in args:
+        print(one_arg + ':')
+    return 0
+
+
+def iquest(args: list) -> int:
+    """Answers the query of the names, sizes and checksums of the data objects in a collection
+    Arguments:
+        args: the command line arguments: flags, the output format, and the query
+    Return:
+        Returns the exit code of the command
+    """
+    match = re.search(r"COLL_NAME = '(.*)'", args[-1])
+    if not match:
+        print("Unsupported query: %s" % args[-1], file=sys.stderr)
+        return 1
+    collection_dir = os.path.join(os.environ['FAKE_IRODS_ZONE'], match.group(1).replace("''", "'").lstrip('/'))
+    separator = args[-2].replace('%s', '')[:1] or '|'
+
+    found = False
+    if os.path.isdir(collection_dir):
+        for one_name in sorted(os.listdir(collection_dir)):
+            if not one_name.endswith('.json'):
+                continue
+            with open(os.path.join(collection_dir, one_name), 'r') as in_file:
+                record = json.load(in_file)
+            print(separator.join((one_name[:-len('.json')], str(record['size']), record['checksum'] or '')))
+            found = True
+    if not found:
+        print("CAT_NO_ROWS_FOUND: Nothing was found matching your query")
+        return 1
+    return 0
+
+
+def ichksum(args: list) -> int:
+    """Prints the checksum of a data object
+    Arguments:
+        args: the command line arguments: flags and the data object path
+    Return:
+        Returns the exit code of the command
+    """
+    irods_path = [one_arg for one_arg in args if not one_arg.startswith('-')][-1]
+    if not os.path.exists(_record_path(irods_path)):
+        print("USER_INPUT_PATH_ERR", file=sys.stderr)
+        return 1
+    with open(_record_path(irods_path), 'r') as in_file:
+        record = json.load(in_file)
+    print("    %s    %s" % (os.path.basename(irods_path), record['checksum'] or ''))
+    return 0
+
+
+def run() -> int:
+    """Runs the command the script is called as
+    Return:
+        Returns the exit code of the command
+    """
+    command = os.path.basename(sys.argv[0])
+    if command == 'icd':
+        return 0
+    handlers = {'iput': iput, 'ils': ils, 'iquest': iquest, 'ichksum': ichksum}
+    if command not in handlers:
+        print("Unknown fake iRODS command: %s" % command, file=sys.stderr)
+        return 1
+    return handlers[command](sys.argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(run())
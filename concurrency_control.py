@@ -0,0 +1,290 @@
+""" Adaptive concurrency limits and retry backoff for the calls made to Globus and iRODS """
+
+import contextlib
+import logging
+import random
+import threading
+import time
+from typing import Callable
+
+import run_metrics
+
+# Default number of times an operation is retried after it fails
+RETRY_ATTEMPTS = 3
+# Default base and longest number of seconds to wait before a retry
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+# How much slower than the fastest seen an operation can be before the limit is lowered
+LATENCY_TOLERANCE = 3.0
+# The number of operations timed before slow operations lower the limit
+LATENCY_WARMUP = 5
+# The fraction the limit is lowered to on a failure or slow operation
+DECREASE_FACTOR = 0.5
+
+# The HTTP statuses that indicate a service is throttling requests or is overloaded
+THROTTLED_HTTP_STATUSES = (429, 503)
+
+
+def backoff_delay(attempt: int, base_seconds: float = BACKOFF_BASE_SECONDS,
+                  max_seconds: float = BACKOFF_MAX_SECONDS) -> float:
+    """Returns the number of seconds to wait before retrying an operation
+    Arguments:
+        attempt: the number of attempts that have failed so far, starting at 1
+        base_seconds: the longest wait after the first failure
+        max_seconds: the longest wait after any failure
+    Return:
+        Returns a random wait between zero and the exponentially growing limit, so that retries of operations
+        that failed together don't all happen together
+    """
+    return random.uniform(0, min(max_seconds, base_seconds * (2 ** max(0, attempt - 1))))
+
+
+def is_throttled(ex: Exception) -> bool:
+    """Returns whether an exception indicates that a service is throttling requests or is overloaded
+    Arguments:
+        ex: the exception to check
+    Return:
+        Returns True for HTTP 429 and 503 responses, such as those returned by Globus when its limits are reached
+    """
+    return getattr(ex, 'http_status', None) in THROTTLED_HTTP_STATUSES
+
+
+def is_retryable(ex: Exception) -> bool:
+    """Returns whether an operation that raised an exception may succeed if it's retried
+    Arguments:
+        ex: the exception to check
+    Return:
+        Returns False for client errors such as a missing path or a lack of permission, and True otherwise
+    """
+    http_status = getattr(ex, 'http_status', None)
+    return not (isinstance(http_status, int) and 400 <= http_status < 500 and http_status not in THROTTLED_HTTP_STATUSES)
+
+
+class AimdController:
+    """Limits the number of operations running at once, adjusting the limit by additive increase and
+    multiplicative decrease
+    Notes:
+        The limit goes up by one after a full limit's worth of operations succeed at a healthy latency, and is halved
+        when an operation fails, is throttled, or takes much longer than the fastest operation seen. After the limit
+        is lowered, it isn't lowered again until a limit's worth of operations have finished, so that a burst of
+        failures from operations that were already running only counts once
+    """
+
+    def __init__(self, name: str, maximum: int, initial: int = None, minimum: int = 1,
+                 metrics: run_metrics.RunMetrics = None, latency_tolerance: float = LATENCY_TOLERANCE):
+        """Initializes the controller
+        Arguments:
+            name: the name of the operations being limited, used in logs and metrics
+            maximum: the highest the limit can go
+            initial: the starting limit; defaults to half of the maximum
+            minimum: the lowest the limit can go
+            metrics: optional run metrics to record the limit and its changes in
+            latency_tolerance: how many times slower than the fastest seen an operation can be while still healthy
+                               (0 to ignore latency)
+        """
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self._limit = min(self.maximum, max(self.minimum, initial if initial else (self.maximum + 1) // 2))
+        self.metrics = metrics
+        self._latency_tolerance = latency_tolerance
+        self._condition = threading.Condition()
+        self._active = 0
+        self._successes = 0
+        self._since_decrease = None
+        self._best_latency = None
+        self._timed = 0
+        if self.metrics:
+            self.metrics.gauge(self.name + '_limit', self._limit)
+
+    @property
+    def limit(self) -> int:
+        """Returns the current limit"""
+        with self._condition:
+            return self._limit
+
+    @property
+    def active(self) -> int:
+        """Returns the number of operations running"""
+        with self._condition:
+            return self._active
+
+    def acquire(self) -> None:
+        """Waits until another operation can start and counts it as running"""
+        with self._condition:
+            while self._active >= self._limit:
+                self._condition.wait()
+            self._active += 1
+
+    def release(self) -> None:
+        """Counts an operation as no longer running"""
+        with self._condition:
+            self._active = max(0, self._active - 1)
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Runs the enclosed operation once the limit allows it"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _change_limit(self, new_limit: int, reason: str) -> None:
+        """Changes the limit and records the decision; the caller holds the condition
+        Arguments:
+            new_limit: the new limit
+            reason: why the limit is changing
+        """
+        old_limit = self._limit
+        self._limit = min(self.maximum, max(self.minimum, new_limit))
+        if self._limit == old_limit:
+            return
+        logging.info("Concurrency of %s changed from %s to %s: %s", self.name, str(old_limit), str(self._limit), reason)
+        if self.metrics:
+            self.metrics.gauge(self.name + '_limit', self._limit)
+            self.metrics.count(self.name + ('_limit_increases' if self._limit > old_limit else '_limit_decreases'))
+            self.metrics.event('concurrency', name=self.name, old_limit=old_limit, new_limit=self._limit, reason=reason)
+        self._condition.notify_all()
+
+    def _decrease(self, reason: str) -> None:
+        """Lowers the limit unless it was recently lowered; the caller holds the condition
+        Arguments:
+            reason: why the limit is being lowered
+        """
+        self._successes = 0
+        if self._since_decrease is not None and self._since_decrease < self._limit:
+            return
+        self._since_decrease = 0
+        self._change_limit(int(self._limit * DECREASE_FACTOR), reason)
+
+    def success(self, latency: float = None, units: float = 1) -> None:
+        """Records that an operation succeeded
+        Arguments:
+            latency: optional number of seconds the operation took
+            units: the amount of work the operation did, such as its number of bytes, used to compare latencies
+        """
+        with self._condition:
+            if self._since_decrease is not None:
+                self._since_decrease += 1
+            if latency is not None and self._latency_tolerance:
+                unit_latency = latency / max(units, 1)
+                self._timed += 1
+                if self._best_latency is None or unit_latency < self._best_latency:
+                    self._best_latency = unit_latency
+                if self._timed > LATENCY_WARMUP and unit_latency > self._best_latency * self._latency_tolerance:
+                    self._decrease("latency %.3fs is over %s times the best" % (latency, str(self._latency_tolerance)))
+                    return
+
+            self._successes += 1
+            if self._successes >= self._limit:
+                self._successes = 0
+                self._change_limit(self._limit + 1, "%s operations succeeded" % str(self._limit))
+
+    def failure(self, throttled: bool = False) -> None:
+        """Records that an operation failed
+        Arguments:
+            throttled: set to True if the service reported that it's throttling requests
+        """
+        with self._condition:
+            if self._since_decrease is not None:
+                self._since_decrease += 1
+            self._decrease("throttled by the service" if throttled else "an operation failed")
+
+
+class RetrySchedule:
+    """Keeps track of the items waiting to be retried, each with its own attempt count and backoff"""
+
+    def __init__(self, attempts: int = RETRY_ATTEMPTS):
+        """Initializes the schedule
+        Arguments:
+            attempts: the number of times an item is retried after its first failure
+        """
+        self.attempts = attempts
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._waiting = {}
+
+    def schedule(self, item: object) -> bool:
+        """Schedules a failed item to be retried after a jittered exponential backoff
+        Arguments:
+            item: the item that failed
+        Return:
+            Returns True if the item will be retried, or False if it has run out of attempts
+        """
+        with self._lock:
+            failures = self._failures.get(item, 0) + 1
+            self._failures[item] = failures
+            if failures > self.attempts:
+                return False
+            self._waiting[item] = time.monotonic() + backoff_delay(failures)
+            return True
+
+    def pop_due(self) -> list:
+        """Returns the items whose backoff has passed, removing them from the schedule
+        Return:
+            Returns the list of items to retry now
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = [one_item for one_item, due_time in self._waiting.items() if due_time <= now]
+            for one_item in due:
+                del self._waiting[one_item]
+        return due
+
+    def seconds_until_due(self):
+        """Returns the number of seconds until the next item is due, or None if no items are waiting"""
+        with self._lock:
+            if not self._waiting:
+                return None
+            return max(0.0, min(self._waiting.values()) - time.monotonic())
+
+
+def call_with_retries(operation: Callable, description: str, attempts: int = RETRY_ATTEMPTS,
+                      retry_on: tuple = (RuntimeError,), controller: AimdController = None,
+                      metrics: run_metrics.RunMetrics = None, units: float = 1):
+    """Calls an operation, retrying it with jittered exponential backoff when it fails
+    Arguments:
+        operation: the function to call, without arguments
+        description: what the operation does, used in logs
+        attempts: the number of times to retry the operation after the first failure
+        retry_on: the exception types that cause a retry
+        controller: optional controller limiting the number of these operations running at once
+        metrics: optional run metrics to count the retries in
+        units: the amount of work the operation does, used by the controller to compare latencies
+    Return:
+        Returns the value returned by the operation
+    Exceptions:
+        The exception of the last attempt is raised if every attempt fails, or the exception raised by an attempt
+        that isn't worth retrying
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        latency = None
+        try:
+            if controller:
+                with controller.slot():
+                    start = time.monotonic()
+                    result = operation()
+                    latency = time.monotonic() - start
+            else:
+                result = operation()
+        except retry_on as ex:
+            if controller:
+                controller.failure(is_throttled(ex))
+            if attempt > attempts or not is_retryable(ex):
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning("Retrying %s in %.1f seconds after attempt %s failed: %s", description, delay, str(attempt),
+                            str(ex))
+            metrics = metrics or (controller.metrics if controller else None)
+            if metrics:
+                metrics.count((controller.name if controller else 'operation') + '_retries')
+            time.sleep(delay)
+            continue
+
+        if controller:
+            controller.success(latency, units)
+        return result
@@ -0,0 +1,93 @@
+""" Single pass computation of the checksums of a staged file """
+
+import base64
+import binascii
+import hashlib
+import mmap
+import os
+import re
+from typing import Optional
+
+# Default size of each read from the file
+READ_BUFFER_SIZE = 16 * 1024 * 1024
+# Default digests computed for a file, covering both of the checksum schemes an iRODS zone can be configured with
+DEFAULT_ALGORITHMS = ('md5', 'sha256')
+# The prefix of the SHA-256 checksums stored by iRODS; zones using MD5 store the plain hex digest
+IRODS_SHA256_PREFIX = 'sha2:'
+
+
+def compute_digests(file_path: str, algorithms: tuple = DEFAULT_ALGORITHMS, buffer_size: int = READ_BUFFER_SIZE,
+                    use_mmap: bool = False) -> dict:
+    """Computes several digests of a file while only reading it once
+    Arguments:
+        file_path: the path of the file
+        algorithms: the names of the hashlib algorithms to compute
+        buffer_size: the number of bytes to read at a time
+        use_mmap: set to True to memory map the file instead of reading it into a buffer
+    Return:
+        Returns a dictionary of the algorithm names to their hex digests
+    """
+    hashers = [hashlib.new(one_algorithm) for one_algorithm in algorithms]
+
+    with open(file_path, 'rb') as in_file:
+        if use_mmap and os.fstat(in_file.fileno()).st_size > 0:
+            with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, len(view), buffer_size):
+                        chunk = view[offset:offset + buffer_size]
+                        for one_hasher in hashers:
+                            one_hasher.update(chunk)
+                        chunk.release()
+                finally:
+                    view.release()
+        else:
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while True:
+                num_read = in_file.readinto(buffer)
+                if not num_read:
+                    break
+                for one_hasher in hashers:
+                    one_hasher.update(view[:num_read])
+
+    return {one_algorithm: one_hasher.hexdigest() for one_algorithm, one_hasher in zip(algorithms, hashers)}
+
+
+def parse_irods_checksum(stored: str) -> Optional[tuple]:
+    """Returns the algorithm and hex digest of a checksum stored by iRODS
+    Arguments:
+        stored: the checksum as iRODS reports it
+    Return:
+        Returns a tuple of the hashlib algorithm name and the hex digest, or None if the value isn't a checksum
+    """
+    if not stored:
+        return None
+    if stored.startswith(IRODS_SHA256_PREFIX):
+        try:
+            return 'sha256', base64.b64decode(stored[len(IRODS_SHA256_PREFIX):], validate=True).hex()
+        except binascii.Error:
+            return None
+    if re.fullmatch('[0-9a-fA-F]{32}', stored):
+        return 'md5', stored.lower()
+    return None
+
+
+def verify_irods_checksum(file_path: str, stored: str, digests: dict) -> None:
+    """Compares the checksum iRODS stored for an uploaded file against the digests of the local file
+    Arguments:
+        file_path: the path of the local file, used in the error messages
+        stored: the checksum as iRODS reports it, using the zone's checksum scheme
+        digests: the dictionary of algorithm names to the hex digests of the local file
+    Exceptions:
+        RuntimeError is raised if the checksum isn't recognised, its algorithm wasn't computed, or it doesn't match
+    """
+    parsed = parse_irods_checksum(stored)
+    if not parsed:
+        raise RuntimeError("Unable to read the iRODS checksum of %s: %s" % (file_path, str(stored)))
+    algorithm, digest = parsed
+    if algorithm not in digests:
+        raise RuntimeError("Unable to compare the iRODS %s checksum of %s without its local digest" % (algorithm, file_path))
+    if digests[algorithm] != digest:
+        raise RuntimeError("Checksum mismatch after loading file to iRODS %s: %s %s expected %s" %
+                           (file_path, algorithm, digest, digests[algorithm]))
@@ -0,0 +1,73 @@
+""" Precompiled matching of remote file names against extensions and name fragments """
+
+import os
+import re
+from typing import Iterable, Optional
+
+# The extension that accepts any file
+WILDCARD_EXTENSION = '*'
+
+
+def _compile_fragments(parts: tuple) -> Optional[re.Pattern]:
+    """Compiles file name fragments into one regular expression
+    Arguments:
+        parts: the plain text fragments to search for
+    Return:
+        Returns the compiled expression matching any of the fragments, or None if there are no fragments
+    """
+    if not parts:
+        return None
+    # Longer fragments first so that the alternation doesn't stop at a shorter fragment they contain
+    return re.compile('|'.join(re.escape(one_part) for one_part in sorted(set(parts), key=len, reverse=True)))
+
+
+class FileMatcher:
+    """Decides which remote file names are wanted using a set of extensions and name fragments
+    Notes:
+        The extensions are kept in a set and all the fragments of each kind are joined into a single regular
+        expression, so that checking a name doesn't depend on the number of extensions or fragments
+    """
+
+    def __init__(self, extensions: tuple, include_parts: tuple = (), exclude_parts: tuple = ()):
+        """Initializes the matcher
+        Arguments:
+            extensions: the acceptable file name extensions, with or without the leading period ('*' for any)
+            include_parts: file name fragments of which at least one must be present (no fragments accepts all names)
+            exclude_parts: file name fragments that reject a name when any of them are present
+        """
+        self.extensions = frozenset(one_ext.lstrip('.') for one_ext in extensions or ())
+        self._any_extension = WILDCARD_EXTENSION in self.extensions
+        self._include = _compile_fragments(include_parts)
+        self._exclude = _compile_fragments(exclude_parts)
+
+    def matches(self, name: str) -> bool:
+        """Checks whether a file name is wanted
+        Arguments:
+            name: the name of the file, without its folder
+        Return:
+            Returns True if the file has an acceptable extension, includes a wanted fragment, and doesn't
+            include an excluded fragment
+        """
+        if not self._any_extension:
+            # The same extension os.path.splitext() finds, where leading periods don't start an extension
+            stem = name.lstrip('.')
+            dot_idx = stem.rfind('.')
+            if (stem[dot_idx + 1:] if dot_idx >= 0 else '') not in self.extensions:
+                return False
+        if self._include is not None and not self._include.search(name):
+            return False
+        if self._exclude is not None and self._exclude.search(name):
+            return False
+        return True
+
+    def filter_entries(self, folder_path: str, entries: Iterable[dict]):
+        """Yields the wanted files from the entries of a folder listing
+        Arguments:
+            folder_path: the path of the listed folder
+            entries: the listing entries of the folder
+        Return:
+            Yields a (file path, listing entry) tuple for each wanted file; sub folders are skipped
+        """
+        for one_entry in entries:
+            if one_entry['type'] != 'dir' and self.matches(one_entry['name']):
+                yield os.path.join(folder_path, one_entry['name']), one_entry
@@ -0,0 +1,157 @@
+""" Policies for selecting the file to download from each remote folder """
+
+import logging
+import os
+import re
+from typing import Optional
+
+# The names of the selection policies
+POLICY_INTERACTIVE = 'interactive'
+POLICY_LARGEST = 'largest'
+POLICY_NEWEST = 'newest'
+POLICY_REGEX = 'regex'
+POLICY_FIRST = 'first'
+
+
+def _select_interactive(folder: str, matches: list, patterns: tuple) -> Optional[str]:
+    """Asks the user to select the file
+    Arguments:
+        folder: the remote folder containing the files
+        matches: the list of (file path, listing entry) tuples to select from
+        patterns: not used
+    Return:
+        Returns the path of the selected file, or None if the user chose to skip the folder
+    """
+    get_input = getattr(__builtins__, 'raw_input', input)
+
+    selected = None
+    done = False
+    while not done:
+        print("Remote folder", folder)
+        print("Please select file to download:")
+        print(0, ".", "None")
+        idx = 1
+        for one_match, _ in matches:
+            print(idx, ".", os.path.basename(one_match))
+            idx += 1
+        sel_file = get_input('Enter the number associated with file: ').strip()
+        try:
+            sel_idx = int(sel_file)
+        except ValueError:
+            sel_idx = -1
+        if sel_idx > 0:
+            if sel_idx <= len(matches):
+                logging.debug(" file index %s selected", sel_idx)
+                selected = matches[sel_idx - 1][0]
+                done = True
+            else:
+                print("Entered value is out of range: %s %d", sel_file, sel_idx)
+        elif sel_idx == 0:
+            print("Skipping folder")
+            done = True
+        else:
+            print("Invalid entry")
+        if not done:
+            print("Please try again")
+    print("-")
+    print("-")
+
+    return selected
+
+
+def _select_largest(folder: str, matches: list, patterns: tuple) -> Optional[str]:
+    """Selects the largest file, using the first one found when there's a tie
+    Arguments:
+        folder: not used
+        matches: the list of (file path, listing entry) tuples to select from
+        patterns: not used
+    Return:
+        Returns the path of the selected file
+    """
+    return max(matches, key=lambda one_match: one_match[1].get('size') or 0)[0]
+
+
+def _select_newest(folder: str, matches: list, patterns: tuple) -> Optional[str]:
+    """Selects the most recently modified file, using the first one found when there's a tie
+    Arguments:
+        folder: not used
+        matches: the list of (file path, listing entry) tuples to select from
+        patterns: not used
+    Return:
+        Returns the path of the selected file
+    """
+    return max(matches, key=lambda one_match: one_match[1].get('last_modified') or '')[0]
+
+
+def _select_regex(folder: str, matches: list, patterns: tuple) -> Optional[str]:
+    """Selects the first file matching the highest priority regular expression
+    Arguments:
+        folder: not used
+        matches: the list of (file path, listing entry) tuples to select from
+        patterns: the compiled regular expressions in priority order, searched for in the file names
+    Return:
+        Returns the path of the selected file, or None if no file name matches any of the expressions
+    """
+    for one_pattern in patterns:
+        for one_match, one_entry in matches:
+            if one_pattern.search(one_entry['name']):
+                return one_match
+    return None
+
+
+def _select_first(folder: str, matches: list, patterns: tuple) -> Optional[str]:
+    """Selects the first file found
+    Arguments:
+        folder: not used
+        matches: the list of (file path, listing entry) tuples to select from
+        patterns: not used
+    Return:
+        Returns the path of the selected file
+    """
+    return matches[0][0]
+
+
+SELECTION_POLICIES = {
+    POLICY_INTERACTIVE: _select_interactive,
+    POLICY_LARGEST: _select_largest,
+    POLICY_NEWEST: _select_newest,
+    POLICY_REGEX: _select_regex,
+    POLICY_FIRST: _select_first,
+}
+
+
+def compile_patterns(patterns: tuple) -> tuple:
+    """Compiles the regular expressions used by the regex policy
+    Arguments:
+        patterns: the regular expressions in priority order
+    Return:
+        Returns the compiled regular expressions
+    Exceptions:
+        RuntimeError is raised if an expression isn't valid
+    """
+    compiled = []
+    for one_pattern in patterns or ():
+        try:
+            compiled.append(re.compile(one_pattern))
+        except re.error as ex:
+            raise RuntimeError("Invalid file selection pattern '%s': %s" % (one_pattern, str(ex))) from ex
+    return tuple(compiled)
+
+
+def select_file(policy: str, folder: str, matches: list, patterns: tuple = ()) -> Optional[str]:
+    """Selects the file to download from the files found in a folder
+    Arguments:
+        policy: the name of the selection policy to use
+        folder: the remote folder containing the files
+        matches: the list of (file path, listing entry) tuples that passed the file filters
+        patterns: the compiled regular expressions used by the regex policy
+    Return:
+        Returns the path of the selected file, or None if no file was selected
+    Exceptions:
+        RuntimeError is raised if the policy isn't known
+    """
+    if policy not in SELECTION_POLICIES:
+        raise RuntimeError("Unknown file selection policy: %s" % policy)
+    if not matches:
+        return None
+    return SELECTION_POLICIES[policy](folder, matches, patterns)
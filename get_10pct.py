@@ -1,206 +1,218 @@
 #!/usr/bin/env python3
 """ Generate TERRA REF canopy cover """
 
+import argparse
 import logging
 import os
-import stat
-import subprocess
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Optional
 
-import globus_sdk
+import file_matcher
+import file_selection
+import run_metrics
+import tiff_overview
+import transfer_engine
+import transfer_journal
+import transfer_sinks
+
+if TYPE_CHECKING:
+    # globus_sdk is only loaded by the transfer engine once a run starts
+    import globus_sdk
 
 GLOBUS_ENDPOINT = 'Terraref'
 GLOBUS_PATH = '/ua-mac/public/season-6/Level_2/rgb_fullfield/'
 LOCAL_SAVE_PATH = os.path.realpath(os.getcwd())
-GLOBUS_LOCAL_ENDPOINT_ID = None
-GLOBUS_CLIENT_ID = '80e3a80b-0e81-43b0-84df-125ce5ad6088'  # This script's ID registered with Globus
+
+# The extensions of the images and the name fragments of the files that aren't full field mosaics
+IMAGE_EXTENSIONS = ('.tif', '.TIF', '.tiff', '.TIFF')
+FULLFIELD_EXCLUDE_PARTS = ('_10pct', '_thumb', '_copy', '_mask', '_nrmac', 'test')
 
 
-def globus_get_authorizer() -> globus_sdk.RefreshTokenAuthorizer:
-    """Returns Globus authorization information (requires user interaction)
+def fullfield_source(remote_path: str, save_path: str, fullfield_dir: str = None) -> str:
+    """Returns the local path of the full field mosaic to derive a 10 percent image from
+    Arguments:
+        remote_path: the remote path of the mosaic
+        save_path: the folder the files are downloaded to
+        fullfield_dir: optional folder of mosaics already on hand
     Return:
-        The authorizer instance
+        Returns the path of the mosaic in fullfield_dir if it's there, otherwise the path it's downloaded to
     """
-    auth_client = globus_sdk.NativeAppAuthClient(GLOBUS_CLIENT_ID)
-    auth_client.oauth2_start_flow(refresh_tokens=True)
-
-    authorize_url = auth_client.oauth2_get_authorize_url()
-    print("Authorization URL: %s" % authorize_url)
-    print("Go to the following URL to obtain the authorization code:", authorize_url)
+    file_name = os.path.basename(remote_path)
+    if fullfield_dir and os.path.exists(os.path.join(fullfield_dir, file_name)):
+        return os.path.join(fullfield_dir, file_name)
+    return os.path.join(save_path, file_name)
 
-    get_input = getattr(__builtins__, 'raw_input', input)
-    auth_code = get_input('Enter the authorization code: ').strip()
 
-    token_response = auth_client.oauth2_exchange_code_for_tokens(auth_code)
-    transfer_info = token_response.by_resource_server['transfer.api.globus.org']
-
-    return globus_sdk.RefreshTokenAuthorizer(transfer_info['refresh_token'], auth_client,
-                                             access_token=transfer_info['access_token'],
-                                             expires_at=transfer_info['expires_at_seconds'])
+def local_overview_path(remote_path: str, save_path: str) -> str:
+    """Returns the local path of the 10 percent image derived from a full field mosaic
+    Arguments:
+        remote_path: the path of the mosaic
+        save_path: the folder the files are downloaded to
+    """
+    return os.path.join(save_path, tiff_overview.overview_name(os.path.basename(remote_path)))
 
 
-def globus_download_files(client: globus_sdk.TransferClient, endpoint_id: str, files: tuple) -> None:
-    """Gets the details of the files in the list
+def derive_overviews(fullfield_files: list, save_path: str, fullfield_dir: str,
+                     max_workers: int = tiff_overview.OVERVIEW_WORKERS, metrics: run_metrics.RunMetrics = None) -> None:
+    """Derives the missing 10 percent images from the full field mosaics in the folder of mosaics on hand
     Arguments:
-        client: the Globus transfer client to use
-        endpoint_id: the ID of the endpoint to access
-        files: the list of files to fetch
-    Return:
-        Returns an updated list of file details
+        fullfield_files: the remote paths of the mosaics on hand of the folders without a 10 percent image
+        save_path: the folder the files are downloaded to
+        fullfield_dir: the folder of mosaics on hand, which are left where they are
+        max_workers: the number of 10 percent images derived at the same time
+        metrics: optional run metrics to record the derivations in
+    Exceptions:
+        RuntimeError is raised if any of the 10 percent images couldn't be derived
+    """
+    metrics = metrics or run_metrics.RunMetrics()
+    jobs = {}
+    for one_file in fullfield_files:
+        source_path = fullfield_source(one_file, save_path, fullfield_dir)
+        if os.path.isfile(source_path) and not os.path.exists(local_overview_path(one_file, save_path)):
+            jobs[source_path] = local_overview_path(one_file, save_path)
+    if not jobs:
+        return
+
+    logging.info("Deriving %s 10 percent images from full field mosaics on hand", str(len(jobs)))
+    succeeded, failed = tiff_overview.make_overviews(jobs, max_workers)
+    for source_path, seconds in succeeded.items():
+        metrics.observe('derive_overview', seconds, 1, os.path.getsize(source_path))
+    metrics.count('derive_failed_files', len(failed))
+    if failed:
+        raise RuntimeError("Unable to derive %s of %s 10 percent images" % (str(len(failed)), str(len(jobs))))
+
+
+def create_sink(args: argparse.Namespace, engine_ref: Callable[[], transfer_engine.TransferEngine],
+                metrics: run_metrics.RunMetrics) -> transfer_sinks.Sink:
+    """Returns the sink the downloaded files are handed to
+    Arguments:
+        args: the parsed command line arguments
+        engine_ref: returns the transfer engine the sink is used by, which is created after the sink
+        metrics: the run metrics to record the derivations in
+    Notes:
+        When the missing 10 percent images are derived, each downloaded mosaic is derived from as it arrives and
+        removed if it was downloaded for that. Mosaics that are only in the journal as transferred may have been kept
+        by another script sharing the journal, so they're left alone
     """
-    # Fetch metadata and pull information out of it
-    file_transfers = {}
-    for one_file in files:
-        globus_save_path = os.path.join(LOCAL_SAVE_PATH, os.path.basename(one_file))
-        if not os.path.exists(globus_save_path):
-            globus_remote_path = one_file
-            file_transfers[globus_remote_path] = globus_save_path
-
-    if file_transfers:
-        have_exception = False
-        cnt = 1
-
-        for remote_path, save_path in file_transfers.items():
-            try:
-                logging.info("Trying transfer %s: %s", str(cnt), str(remote_path))
-                cnt += 1
-                transfer_setup = globus_sdk.TransferData(client, endpoint_id, GLOBUS_LOCAL_ENDPOINT_ID,
-                                                         label="Get image file", sync_level="checksum")
-                transfer_setup.add_item(remote_path, save_path)
-                transfer_request = client.submit_transfer(transfer_setup)
-                task_result = client.task_wait(transfer_request['task_id'], timeout=600, polling_interval=5)
-                if not task_result:
-                    raise RuntimeError("Unable to retrieve JSON metadata: %s" % remote_path)
-                if not os.path.exists(save_path):
-                    raise RuntimeError("Unable to find downloaded file at: %s" % save_path)
-
-            except RuntimeError as ex:
-                have_exception = True
-                logging.warning("Failed to get image: %s", str(ex))
-        if have_exception:
-            raise RuntimeError("Unable to retrieve all files individually")
-        del file_transfers
-
-
-def query_files(client: globus_sdk.TransferClient, endpoint_id: str, folders: tuple, extensions: tuple,
-                include_parts: tuple) -> Optional[tuple]:
-    """Returns a list of files on the endpoint path that match the dates provided
+    if args.sink == transfer_sinks.SINK_NULL:
+        return transfer_sinks.NullSink()
+    if not args.derive_missing:
+        return transfer_sinks.LocalSink()
+
+    fullfield_matcher = file_matcher.FileMatcher(IMAGE_EXTENSIONS, exclude_parts=FULLFIELD_EXCLUDE_PARTS)
+    leftover_paths = None
+
+    def removable(save_path: str) -> bool:
+        """Returns whether a mosaic was downloaded to derive from, marking the ones transferred by this run in the
+        journal"""
+        nonlocal leftover_paths
+        engine = engine_ref()
+        remote_path = engine.transferred.get(save_path)
+        if remote_path:
+            if engine.journal:
+                engine.journal.record(remote_path, transfer_journal.STATE_DERIVING)
+            return True
+        if leftover_paths is None:
+            # An earlier run may have stopped before deriving from the mosaics it downloaded
+            leftover_paths = set()
+            if engine.journal:
+                leftover_paths.update(engine.journal.files_in_state(transfer_journal.STATE_DERIVING).values())
+        return save_path in leftover_paths
+
+    return transfer_sinks.OverviewSink(lambda save_path: fullfield_matcher.matches(os.path.basename(save_path)),
+                                       removable, args.overview_workers, metrics)
+
+
+def create_selector(save_path: str, fullfield_dir: str = None, fullfield_files: list = None,
+                    metrics: run_metrics.RunMetrics = None) -> Callable[[str, str, list], Optional[tuple]]:
+    """Returns the function choosing the 10 percent image to download in each folder
     Arguments:
-        client: the Globus transfer client to use
-        endpoint_id: the ID of the endpoint to access
-        folders: a list of folders to search within (search is 1 deep)
-        extensions: a list of acceptable filename extensions (can be wildcard '*')
-        include_parts: the file name fragments for inclusion
+        save_path: the folder the files are downloaded to
+        fullfield_dir: optional folder of mosaics already on hand
+        fullfield_files: optional list that's filled in with the full field mosaics in fullfield_dir of the folders
+                         without a 10 percent image, to derive the images from; None skips those folders
+        metrics: optional run metrics to count the folders without a 10 percent image in
     Return:
-        Returns a list of acceptable files with the extension(s)
+        Returns a function called with a folder's name, its remote path and its listing entries that returns the
+        (remote path, entry, listed) of the first 10 percent image, or of the mosaic to derive the image from
+        that isn't in fullfield_dir, or None
     """
-    found_files = []
-    check_ext = [e.lstrip('.') for e in extensions]
-    out_file = open(os.path.join(LOCAL_SAVE_PATH, 'file_10pct.txt'), 'w')
-    for one_folder in folders:
-        cur_path = os.path.join('/-', one_folder)
-        logging.debug("Globus files path: %s", cur_path)
-        try:
-            path_contents = client.operation_ls(endpoint_id, path=cur_path)
-        except globus_sdk.exc.TransferAPIError:
-            logging.error("Continuing after TransferAPIError Exception caught for: '%s'", cur_path)
-            continue
-
-        matches = []
-        for one_entry in path_contents:
-            if one_entry['type'] != 'dir':
-                file_path = os.path.join(cur_path, one_entry['name'])
-                logging.debug("Globus remote file path: %s", file_path)
-
-                # Get the format of the file (aka: its extension)
-                file_format = os.path.splitext(one_entry['name'])[1]
-                if file_format:
-                    file_format = file_format.lstrip('.')
-
-                # Check if it's included
-                if file_format not in check_ext:
-                    logging.debug("   remote file doesn't match extension: %s %s", os.path.basename(file_path), check_ext)
-                    continue
-
-                if include_parts:
-                    found_include = False
-                    for part in include_parts:
-                        if part in one_entry['name']:
-                            found_include = True
-                            break
-                    if found_include:
-                        logging.warning("Found wanted image: %s %s", one_entry['name'], include_parts)
-                        matches.append(file_path)
-                        break
-
-        for one_match in matches:
-            found_files.append(one_match)
-            out_file.write(one_match + '\n')
-
-    out_file.close()
-    print("Done searching for files to download: found", len(found_files), "files")
-
-    return tuple(found_files)
-
-
-def globus_get_folders(client: globus_sdk.TransferClient, endpoint_id: str, remote_path: str) -> Optional[tuple]:
-    """Returns a list of files on the endpoint path that match the dates provided
+    metrics = metrics or run_metrics.RunMetrics()
+    matcher = file_matcher.FileMatcher(IMAGE_EXTENSIONS, include_parts=('_10pct',))
+    fullfield_matcher = file_matcher.FileMatcher(IMAGE_EXTENSIONS, exclude_parts=FULLFIELD_EXCLUDE_PARTS)
+
+    def select(folder: str, cur_path: str, entries: list) -> Optional[tuple]:
+        """Chooses the 10 percent image to download in a folder"""
+        # The rest of the folder isn't checked once a wanted image is found
+        found_path = next(matcher.filter_entries(cur_path, entries), None)
+        if found_path:
+            logging.warning("Found wanted image: %s %s", found_path[1]['name'], ('_10pct',))
+            return found_path[0], found_path[1], True
+
+        metrics.count('missing_10pct_folders')
+        if fullfield_files is None:
+            logging.warning("No wanted image found in: %s", cur_path)
+            return None
+        mosaics = list(fullfield_matcher.filter_entries(cur_path, entries))
+        selected = file_selection.select_file(file_selection.POLICY_LARGEST, cur_path, mosaics)
+        if not selected or os.path.exists(local_overview_path(selected, save_path)):
+            return None
+        # Mosaics in the folder of those on hand aren't downloaded; the engine decides about the download folder
+        if fullfield_dir and os.path.exists(fullfield_source(selected, save_path, fullfield_dir)):
+            fullfield_files.append(selected)
+            return None
+        file_path, one_entry = next(one_match for one_match in mosaics if one_match[0] == selected)
+        logging.info("Fetching full field image to derive the wanted image from: %s", one_entry['name'])
+        return file_path, one_entry, False
+
+    return select
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    """Parses the command line
     Arguments:
-        client: the Globus transfer client to use
-        endpoint_id: the ID of the endpoint to access
-        remote_path: the remote path to search
+        argv: optional list of arguments to parse instead of the command line
     Return:
-        Returns a list of found sub folders
+        Returns the parsed arguments
     """
-    base_path = os.path.join('/-', remote_path)
-    return_paths = []
-    try:
-        path_contents = client.operation_ls(endpoint_id, path=base_path)
-    except globus_sdk.exc.TransferAPIError:
-        logging.error("Continuing after TransferAPIError Exception caught for: '%s'", base_path)
-        return None
-
-    for one_entry in path_contents:
-        if one_entry['type'] == 'dir':
-            sub_folder = os.path.join(base_path, one_entry['name'])
-            logging.debug("Globus remote sub folder: %s", sub_folder)
-            return_paths.append(sub_folder)
-
-    return tuple(return_paths)
-
-
-def globus_get_tif_files(globus_authorizer: globus_sdk.RefreshTokenAuthorizer, remote_endpoint: str,
-                         remote_path: str) -> None:
-    """Fetches files in the remote folder
+    parser = argparse.ArgumentParser(description='Download 10 percent image files using Globus')
+    transfer_engine.add_arguments(parser, LOCAL_SAVE_PATH)
+    parser.add_argument('--sink', type=str, choices=(transfer_sinks.SINK_LOCAL, transfer_sinks.SINK_NULL),
+                        default=transfer_sinks.SINK_LOCAL, help='Whether the downloaded files are kept or discarded')
+    parser.add_argument('--derive_missing', action='store_true',
+                        help='Derive the 10 percent image of folders without one from their full field image (needs GDAL)')
+    parser.add_argument('--fullfield_dir', type=str, default=None,
+                        help='Folder of full field images already on hand to derive from instead of downloading them')
+    parser.add_argument('--overview_workers', type=int, default=tiff_overview.OVERVIEW_WORKERS,
+                        help='Number of 10 percent images derived at the same time')
+    return parser.parse_args(argv)
+
+
+def run(args: argparse.Namespace, client: 'globus_sdk.TransferClient' = None,
+        metrics: run_metrics.RunMetrics = None) -> None:
+    """Downloads the 10 percent images, deriving the missing ones when asked to
     Arguments:
-        globus_authorizer: the Globus authorization instance
-        remote_endpoint: the remote endpoint to access
-        remote_path: the path of remote folder to start in
+        args: the parsed command line arguments
+        client: optional Globus transfer client to use instead of authorizing a new one
+        metrics: optional run metrics to record the timings of the stages in
+    Exceptions:
+        RuntimeError exceptions are raised when something goes wrong
     """
-    # Prepare to fetch file information from Globus
-    trans_client = globus_sdk.TransferClient(authorizer=globus_authorizer)
-
-    # Find the remote ID
-    endpoint_id = None
-    for endpoint in trans_client.endpoint_search(filter_scope='shared-with-me'):
-        if 'display_name' in endpoint and endpoint['display_name'] == remote_endpoint:
-            endpoint_id = endpoint['id']
-            break
-        if 'canonical_name' in endpoint and endpoint['canonical_name'] == remote_endpoint:
-            endpoint_id = endpoint['id']
-            break
-    if not endpoint_id:
-        raise RuntimeError("Unable to find remote endpoint: %s" % remote_endpoint)
-
-    # Get all the sub folders for this location
-    folders = globus_get_folders(trans_client, endpoint_id, remote_path)
-
-    # Query for all the files to download
-    files = query_files(trans_client, endpoint_id, folders, ('.tif', '.TIF', '.tiff', '.TIFF'),
-                        ('_10pct',))
+    metrics = metrics or run_metrics.RunMetrics()
+    engine = transfer_engine.create_engine(args, create_sink(args, lambda: engine, metrics), metrics)
+    fullfield_dir = os.path.realpath(args.fullfield_dir) if args.fullfield_dir else None
+    fullfield_files = [] if args.derive_missing else None
+    select = create_selector(engine.save_path, fullfield_dir, fullfield_files, metrics)
 
-    # Download the files
-    globus_download_files(trans_client, endpoint_id, files)
+    try:
+        engine.run(GLOBUS_ENDPOINT, GLOBUS_PATH, select, 'file_10pct.txt', args.list, args.list_only, client)
+    finally:
+        try:
+            # The downloaded mosaics were derived from as they arrived, and the ones on hand are used even if
+            # other files failed
+            if fullfield_files and not args.list_only:
+                derive_overviews(fullfield_files, engine.save_path, fullfield_dir, args.overview_workers, metrics)
+        finally:
+            engine.close(args.report, args.prometheus_file)
 
 
 def generate() -> None:
@@ -208,26 +220,8 @@ def generate() -> None:
     Exceptions:
         RuntimeError exceptions are raised when something goes wrong
     """
-    global GLOBUS_LOCAL_ENDPOINT_ID
-
     logging.getLogger().setLevel(logging.DEBUG)
-
-    # Make sure our storage endpoint exists
-    if not os.path.exists(LOCAL_SAVE_PATH):
-        os.makedirs(LOCAL_SAVE_PATH, exist_ok=True)
-        os.chmod(LOCAL_SAVE_PATH, stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IWGRP|stat.S_IXGRP|
-                 stat.S_IROTH|stat.S_IWOTH|stat.S_IXOTH)
-
-    resp = subprocess.run(['globus', 'endpoint', 'local-id'], stdout=subprocess.PIPE)
-    if resp.returncode != 0:
-        raise RuntimeError("Unable to get Local Endpoint ID for Globus. Please use --globus_local_endpoint_id and try again")
-    GLOBUS_LOCAL_ENDPOINT_ID = resp.stdout.decode('ascii').rstrip('\n')
-
-    # Get the Globus authorization
-    authorizer = globus_get_authorizer()
-
-    # Get the tif files
-    globus_get_tif_files(authorizer, GLOBUS_ENDPOINT, GLOBUS_PATH)
+    run(parse_args())
 
 
 if __name__ == "__main__":
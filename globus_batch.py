@@ -0,0 +1,117 @@
+""" Packs many files into a single Globus transfer task """
+
+import logging
+import os
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # globus_sdk is slow to import, so it's imported by the functions that use it
+    import globus_sdk
+
+# Default limits on the number of files and bytes placed into one transfer task
+BATCH_MAX_FILES = 100
+BATCH_MAX_BYTES = 50 * 1024 * 1024 * 1024
+# Default number of seconds allowed for each file in a transfer task before the task is cancelled
+BATCH_TIMEOUT_PER_FILE = 600
+
+
+def plan_batches(files: tuple, file_sizes: dict = None, max_files: int = BATCH_MAX_FILES,
+                 max_bytes: int = BATCH_MAX_BYTES) -> list:
+    """Splits the files into batches that are limited by number of files and total bytes
+    Arguments:
+        files: the list of remote files to split up
+        file_sizes: optional dictionary of remote file paths to their size in bytes
+        max_files: the maximum number of files in one batch (0 for no limit)
+        max_bytes: the maximum number of bytes in one batch (0 for no limit)
+    Return:
+        Returns a list of batches, with each batch being a list of remote file paths
+    Notes:
+        Files with an unknown size are counted as zero bytes. A file larger than the byte limit is
+        placed in a batch by itself
+    """
+    batches = []
+    cur_batch = []
+    cur_bytes = 0
+    for one_file in files:
+        file_size = file_sizes.get(one_file, 0) if file_sizes else 0
+        if cur_batch and ((max_files and len(cur_batch) >= max_files) or (max_bytes and cur_bytes + file_size > max_bytes)):
+            batches.append(cur_batch)
+            cur_batch = []
+            cur_bytes = 0
+        cur_batch.append(one_file)
+        cur_bytes += file_size
+
+    if cur_batch:
+        batches.append(cur_batch)
+
+    return batches
+
+
+def build_transfer(client: 'globus_sdk.TransferClient', endpoint_id: str, local_endpoint_id: str, transfers: dict,
+                   label: str = "Get image files") -> 'globus_sdk.TransferData':
+    """Prepares the transfer of a batch of files as one Globus task
+    Arguments:
+        client: the Globus transfer client to use
+        endpoint_id: the ID of the endpoint to fetch from
+        local_endpoint_id: the ID of the local endpoint to save to
+        transfers: dictionary of remote file paths to their local save paths
+        label: the label of the transfer task
+    Return:
+        Returns the transfer to submit
+    Notes:
+        The task is set up so that errors on individual files are skipped over instead of failing the entire task.
+        Globus verifies the checksum of each file it transfers, since its task results don't report the checksums
+        for the files to be checked again locally
+    """
+    import globus_sdk
+
+    transfer_setup = globus_sdk.TransferData(client, endpoint_id, local_endpoint_id, label=label,
+                                             sync_level="checksum", verify_checksum=True,
+                                             skip_source_errors=True)
+    for remote_path, save_path in transfers.items():
+        transfer_setup.add_item(remote_path, save_path)
+    return transfer_setup
+
+
+def task_results(client: 'globus_sdk.TransferClient', task_id: str, transfers: dict, status: str = None) -> tuple:
+    """Determines which files of a finished transfer task arrived
+    Arguments:
+        client: the Globus transfer client to use
+        task_id: the ID of the finished task
+        transfers: dictionary of the task's remote file paths to their local save paths
+        status: the final status of the task
+    Return:
+        Returns a tuple of the remote paths that were transferred and the remote paths that failed
+    Notes:
+        The successful transfers of a task leave out the files its sync skipped because they were already at
+        their destination. So once a task has succeeded, every file it didn't report as skipped for an error and
+        that's at its destination counts as transferred
+    """
+    # Match the files by either their source or destination paths
+    error_paths = set()
+    for one_error in client.task_skipped_errors(task_id, num_results=None):
+        error_paths.add(one_error.get('source_path'))
+        error_paths.add(one_error.get('destination_path'))
+        logging.warning("Transfer task %s skipped file %s: %s", task_id, one_error.get('source_path'),
+                        one_error.get('error_code'))
+
+    done_paths = None
+    if status != 'SUCCEEDED':
+        done_paths = set()
+        for one_item in client.task_successful_transfers(task_id, num_results=None):
+            done_paths.add(one_item['source_path'])
+            done_paths.add(one_item['destination_path'])
+
+    succeeded = []
+    failed = []
+    for remote_path, save_path in transfers.items():
+        if done_paths is None:
+            arrived = remote_path not in error_paths and save_path not in error_paths
+        else:
+            arrived = remote_path in done_paths or save_path in done_paths
+        if arrived and os.path.exists(save_path):
+            succeeded.append(remote_path)
+        else:
+            failed.append(remote_path)
+
+    return tuple(succeeded), tuple(failed)
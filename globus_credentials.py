@@ -0,0 +1,163 @@
+""" Saved Globus credentials and endpoint IDs so that runs can start without user interaction """
+
+import json
+import logging
+import os
+import stat
+import threading
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    # globus_sdk is imported when the saved tokens are used, not when the credentials file is read
+    import globus_sdk
+
+# Default location of the saved credentials
+CREDENTIALS_FILE = os.path.join(os.path.expanduser('~'), '.globus_terraref.json')
+# The resource server of the saved tokens
+TRANSFER_RESOURCE_SERVER = 'transfer.api.globus.org'
+# The name the local endpoint's ID is saved under
+LOCAL_ENDPOINT_NAME = '<local>'
+
+
+class CredentialsCache:
+    """Refresh token and resolved endpoint IDs saved in a file that only the user can read
+    Notes:
+        A file that can be accessed by other users, or that belongs to someone else, is ignored
+    """
+
+    def __init__(self, credentials_path: str = CREDENTIALS_FILE):
+        """Loads the saved credentials, if there are any
+        Arguments:
+            credentials_path: the path to the credentials file
+        """
+        self.path = credentials_path
+        self._lock = threading.Lock()
+        self._data = self._load()
+
+    def _load(self) -> dict:
+        """Returns the contents of the credentials file after checking its permissions
+        Return:
+            Returns the saved credentials, or an empty dictionary if there aren't any usable ones
+        """
+        if not os.path.exists(self.path):
+            return {}
+
+        file_stat = os.stat(self.path)
+        if file_stat.st_uid != os.getuid() or stat.S_IMODE(file_stat.st_mode) & (stat.S_IRWXG | stat.S_IRWXO):
+            logging.warning("Ignoring saved Globus credentials that other users can access: %s", self.path)
+            return {}
+
+        try:
+            with open(self.path, 'r') as in_file:
+                data = json.load(in_file)
+        except (OSError, ValueError) as ex:
+            logging.warning("Ignoring unreadable saved Globus credentials %s: %s", self.path, str(ex))
+            return {}
+
+        return data if isinstance(data, dict) else {}
+
+    def _save(self) -> None:
+        """Writes the credentials to the file, readable only by the user"""
+        temp_path = self.path + '.tmp'
+        file_desc = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IRUSR | stat.S_IWUSR)
+        with os.fdopen(file_desc, 'w') as out_file:
+            json.dump(self._data, out_file, indent=2)
+        os.chmod(temp_path, stat.S_IRUSR | stat.S_IWUSR)
+        os.replace(temp_path, self.path)
+
+    def clear(self) -> None:
+        """Removes all the saved credentials and endpoint IDs"""
+        with self._lock:
+            self._data = {}
+            self._save()
+
+    def get_tokens(self, client_id: str) -> Optional[dict]:
+        """Returns the saved transfer tokens
+        Arguments:
+            client_id: the ID of the client the tokens were issued to
+        Return:
+            Returns a dictionary with the refresh_token, access_token, and expires_at_seconds values, or None
+        """
+        tokens = self._data.get('tokens')
+        if self._data.get('client_id') != client_id or not isinstance(tokens, dict) or not tokens.get('refresh_token'):
+            return None
+        return tokens
+
+    def set_tokens(self, client_id: str, transfer_info: dict) -> None:
+        """Saves the transfer tokens
+        Arguments:
+            client_id: the ID of the client the tokens were issued to
+            transfer_info: the token information for the transfer resource server
+        """
+        with self._lock:
+            if self._data.get('client_id') != client_id:
+                self._data = {'client_id': client_id}
+            self._data['tokens'] = {'refresh_token': transfer_info['refresh_token'],
+                                    'access_token': transfer_info['access_token'],
+                                    'expires_at_seconds': transfer_info['expires_at_seconds']}
+            self._save()
+
+    def on_refresh(self, token_response: 'globus_sdk.auth.token_response.OAuthTokenResponse') -> None:
+        """Saves the new access token after the authorizer has refreshed it
+        Arguments:
+            token_response: the response containing the new tokens
+        """
+        transfer_info = dict(token_response.by_resource_server[TRANSFER_RESOURCE_SERVER])
+        if not transfer_info.get('refresh_token'):
+            transfer_info['refresh_token'] = self._data.get('tokens', {}).get('refresh_token')
+        self.set_tokens(self._data.get('client_id'), transfer_info)
+
+    def get_endpoint_id(self, name: str) -> Optional[str]:
+        """Returns the saved ID of an endpoint
+        Arguments:
+            name: the name of the endpoint
+        Return:
+            Returns the ID of the endpoint or None if it's not known
+        """
+        return self._data.get('endpoints', {}).get(name)
+
+    def set_endpoint_id(self, name: str, endpoint_id: Optional[str]) -> None:
+        """Saves the ID of an endpoint
+        Arguments:
+            name: the name of the endpoint
+            endpoint_id: the ID of the endpoint, or None to forget the saved ID
+        """
+        with self._lock:
+            endpoints = self._data.setdefault('endpoints', {})
+            if endpoint_id:
+                endpoints[name] = endpoint_id
+            else:
+                endpoints.pop(name, None)
+            self._save()
+
+
+def cached_authorizer(credentials: CredentialsCache, auth_client: 'globus_sdk.NativeAppAuthClient',
+                      client_id: str) -> Optional['globus_sdk.RefreshTokenAuthorizer']:
+    """Returns an authorizer using the saved refresh token
+    Arguments:
+        credentials: the saved credentials
+        auth_client: the Globus authorization client
+        client_id: the ID of the client
+    Return:
+        Returns the authorizer, or None if there are no usable saved credentials
+    Notes:
+        The saved access token is used as-is while it's still valid; otherwise a new one is requested with
+        the refresh token, which also checks that the refresh token hasn't been revoked
+    """
+    import globus_sdk
+
+    tokens = credentials.get_tokens(client_id)
+    if not tokens:
+        return None
+
+    try:
+        authorizer = globus_sdk.RefreshTokenAuthorizer(tokens['refresh_token'], auth_client,
+                                                       access_token=tokens.get('access_token'),
+                                                       expires_at=tokens.get('expires_at_seconds'),
+                                                       on_refresh=credentials.on_refresh)
+        authorizer.check_expiration_time()
+    except globus_sdk.exc.GlobusAPIError as ex:
+        logging.warning("Saved Globus credentials are no longer valid: %s", str(ex))
+        return None
+
+    return authorizer
@@ -0,0 +1,217 @@
+""" Concurrent listing of folders on a Globus endpoint """
+
+import collections
+import concurrent.futures
+import logging
+import os
+from typing import TYPE_CHECKING, Iterable, Optional
+
+if TYPE_CHECKING:
+    # globus_sdk is only imported once a folder is listed, which keeps the scripts quick to start
+    import globus_sdk
+
+import concurrency_control
+import listing_cache
+
+# Default number of folders listed at the same time
+LISTING_MAX_WORKERS = 8
+# Default number of entries requested in each page of a folder listing
+LISTING_PAGE_SIZE = 1000
+
+
+def iter_folder(client: 'globus_sdk.TransferClient', endpoint_id: str, path: str, page_size: int = LISTING_PAGE_SIZE):
+    """Yields the contents of one folder on the endpoint a page at a time
+    Arguments:
+        client: the Globus transfer client to use
+        endpoint_id: the ID of the endpoint to access
+        path: the path of the folder to list
+        page_size: the number of entries to request in each page
+    Return:
+        Yields each entry in the folder
+    Exceptions:
+        globus_sdk.exc.GlobusError is raised if a page of the folder couldn't be listed
+    Notes:
+        A page that's shorter than requested ends the listing, as does a page that's longer than requested
+        in case the endpoint returned the whole folder at once
+    """
+    offset = 0
+    while True:
+        response = client.operation_ls(endpoint_id, path=path, offset=offset, limit=page_size)
+        page = response['DATA']
+        yield from page
+
+        offset += len(page)
+        total = response.get('total')
+        if len(page) != page_size or (total is not None and offset >= total):
+            break
+
+
+def list_folder(client: 'globus_sdk.TransferClient', endpoint_id: str, path: str,
+                cache: listing_cache.ListingCache = None, controller: concurrency_control.AimdController = None,
+                retries: int = concurrency_control.RETRY_ATTEMPTS) -> Optional[list]:
+    """Returns the contents of one folder on the endpoint
+    Arguments:
+        client: the Globus transfer client to use
+        endpoint_id: the ID of the endpoint to access
+        path: the path of the folder to list
+        cache: optional cache of folder listings to read through
+        controller: optional controller adjusting the number of folders listed at the same time
+        retries: the number of times a failed listing is retried
+    Return:
+        Returns the list of entries in the folder, or None if the folder couldn't be listed
+    """
+    import globus_sdk
+
+    if cache is not None:
+        path_contents = cache.get(endpoint_id, path)
+        if path_contents is not None:
+            return path_contents
+
+    try:
+        path_contents = concurrency_control.call_with_retries(lambda: list(iter_folder(client, endpoint_id, path)),
+                                                              "listing of '%s'" % path, retries,
+                                                              (globus_sdk.exc.GlobusError,), controller)
+    except globus_sdk.exc.GlobusError as ex:
+        # Network errors aren't API errors, and neither one stops the rest of the folders from being listed
+        logging.error("Continuing after %s Exception caught for: '%s'", type(ex).__name__, path)
+        return None
+
+    if cache is not None:
+        cache.put(endpoint_id, path, path_contents)
+    return path_contents
+
+
+def iter_folders(client: 'globus_sdk.TransferClient', endpoint_id: str, paths: Iterable[str],
+                 max_workers: int = LISTING_MAX_WORKERS, cache: listing_cache.ListingCache = None,
+                 controller: concurrency_control.AimdController = None):
+    """Lists many folders on the endpoint concurrently, yielding each listing in order as it becomes available
+    Arguments:
+        client: the Globus transfer client to use
+        endpoint_id: the ID of the endpoint to access
+        paths: the paths of the folders to list; this can be any iterable, which is only read once
+        max_workers: the maximum number of folders to list at the same time
+        cache: optional cache of folder listings to read through
+        controller: optional controller adjusting the number of folders listed at the same time, up to max_workers
+    Return:
+        Yields a (path, entries) tuple for each path in the same order as the paths; the entries are None for
+        folders that couldn't be listed
+    Notes:
+        Only a few listings beyond the one being consumed are fetched ahead, so the listings of all the folders
+        aren't held in memory at the same time
+    """
+    max_workers = max(1, max_workers)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        for one_path in paths:
+            pending.append((one_path, executor.submit(list_folder, client, endpoint_id, one_path, cache, controller)))
+            if len(pending) >= max_workers * 2:
+                done_path, done_future = pending.popleft()
+                yield done_path, done_future.result()
+        while pending:
+            done_path, done_future = pending.popleft()
+            yield done_path, done_future.result()
+
+
+def list_folders(client: 'globus_sdk.TransferClient', endpoint_id: str, paths: tuple,
+                 max_workers: int = LISTING_MAX_WORKERS, cache: listing_cache.ListingCache = None,
+                 controller: concurrency_control.AimdController = None) -> list:
+    """Lists many folders on the endpoint concurrently
+    Arguments:
+        client: the Globus transfer client to use
+        endpoint_id: the ID of the endpoint to access
+        paths: the paths of the folders to list
+        max_workers: the maximum number of folders to list at the same time
+        cache: optional cache of folder listings to read through
+        controller: optional controller adjusting the number of folders listed at the same time, up to max_workers
+    Return:
+        Returns a list of (path, entries) tuples in the same order as the paths; the entries are None for
+        folders that couldn't be listed
+    """
+    return list(iter_folders(client, endpoint_id, paths, max_workers, cache, controller))
+
+
+def find_sub_folders(client: 'globus_sdk.TransferClient', endpoint_id: str, base_path: str, max_depth: int = 1,
+                     max_workers: int = LISTING_MAX_WORKERS, cache: listing_cache.ListingCache = None,
+                     controller: concurrency_control.AimdController = None) -> Optional[tuple]:
+    """Finds the sub folders of a folder, optionally searching further down the folder tree
+    Arguments:
+        client: the Globus transfer client to use
+        endpoint_id: the ID of the endpoint to access
+        base_path: the path of the folder to search
+        max_depth: the number of folder levels to search (1 only returns the immediate sub folders)
+        max_workers: the maximum number of folders to list at the same time
+        cache: optional cache of folder listings to read through
+        controller: optional controller adjusting the number of folders listed at the same time, up to max_workers
+    Return:
+        Returns the sorted list of found sub folders, or None if the base folder couldn't be listed
+    """
+    base_contents = list_folder(client, endpoint_id, base_path, cache, controller)
+    if base_contents is None:
+        return None
+
+    found_folders = []
+    cur_level = [(base_path, base_contents)]
+    depth = 1
+    while cur_level:
+        next_paths = []
+        for one_path, one_contents in cur_level:
+            for one_entry in one_contents or []:
+                if one_entry['type'] == 'dir':
+                    sub_folder = os.path.join(one_path, one_entry['name'])
+                    logging.debug("Globus remote sub folder: %s", sub_folder)
+                    next_paths.append(sub_folder)
+        found_folders.extend(next_paths)
+
+        if depth >= max_depth:
+            break
+        depth += 1
+        cur_level = list_folders(client, endpoint_id, tuple(next_paths), max_workers, cache, controller)
+
+    return tuple(sorted(found_folders))
+
+
+def find_file_sizes(client: 'globus_sdk.TransferClient', endpoint_id: str, files: Iterable[str],
+                    max_workers: int = LISTING_MAX_WORKERS, cache: listing_cache.ListingCache = None,
+                    controller: concurrency_control.AimdController = None) -> dict:
+    """Looks up the sizes of files on the endpoint, such as the files read from a file list
+    Arguments:
+        client: the Globus transfer client to use
+        endpoint_id: the ID of the endpoint to access
+        files: the remote paths of the files
+        max_workers: the maximum number of folders to list at the same time
+        cache: optional cache of folder listings to read through
+        controller: optional controller adjusting the number of folders listed at the same time, up to max_workers
+    Return:
+        Returns a dictionary of remote file paths to their sizes; files that weren't found are left out
+    Notes:
+        Each folder holding any of the files is listed once
+    """
+    folder_names = collections.defaultdict(set)
+    for one_file in files:
+        folder_names[os.path.dirname(one_file)].add(os.path.basename(one_file))
+
+    file_sizes = {}
+    for folder_path, entries in iter_folders(client, endpoint_id, sorted(folder_names), max_workers, cache, controller):
+        for one_entry in entries or ():
+            if one_entry['type'] != 'dir' and one_entry['name'] in folder_names[folder_path]:
+                file_sizes[os.path.join(folder_path, one_entry['name'])] = one_entry['size']
+    return file_sizes
+
+
+def read_file_list(list_path: str):
+    """Yields the remote file paths stored in a file list, such as one written by an earlier query for files
+    Arguments:
+        list_path: the path to the file containing one remote file path per line
+    Return:
+        Yields each remote file path, skipping blank lines
+    Exceptions:
+        RuntimeError is raised if the file list can't be found
+    """
+    if not os.path.exists(list_path):
+        raise RuntimeError("Unable to find the file list: %s" % list_path)
+
+    with open(list_path, 'r') as in_file:
+        for one_line in in_file:
+            one_path = one_line.strip()
+            if one_path:
+                yield one_path
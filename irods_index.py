@@ -0,0 +1,76 @@
+""" Index of the data objects already stored in an iRODS collection """
+
+import logging
+import subprocess
+from typing import Optional
+
+# The separator between the fields returned by iquest
+IQUEST_SEPARATOR = '|'
+
+
+class IrodsIndex:
+    """In-memory index of the names, sizes, and checksums of the data objects in a collection"""
+
+    def __init__(self, objects: dict = None):
+        """Initializes the index
+        Arguments:
+            objects: optional dictionary of data object names to (size, checksum) tuples
+        """
+        self.objects = objects if objects is not None else {}
+
+    def __len__(self) -> int:
+        """Returns the number of data objects in the index"""
+        return len(self.objects)
+
+    def matches(self, name: str, size: Optional[int], checksum: str = None) -> bool:
+        """Returns whether a data object with the same name and contents is already stored
+        Arguments:
+            name: the name of the data object
+            size: the size of the file in bytes; a file without a known size never matches
+            checksum: the optional iRODS checksum of the file, only compared when both are known
+        Return:
+            Returns True if the stored data object matches the file
+        """
+        if size is None or name not in self.objects:
+            return False
+
+        stored_size, stored_checksum = self.objects[name]
+        if stored_size != size:
+            return False
+        if checksum and stored_checksum and checksum != stored_checksum:
+            return False
+        return True
+
+
+def build_index(collection: str, iquest_cmd: str = 'iquest') -> IrodsIndex:
+    """Lists the data objects in an iRODS collection with a single query
+    Arguments:
+        collection: the path of the iRODS collection to list
+        iquest_cmd: the iquest command to run
+    Return:
+        Returns the index of the data objects in the collection
+    Exceptions:
+        RuntimeError is raised if the collection can't be queried
+    """
+    collection = collection.rstrip('/')
+    query = "SELECT DATA_NAME, DATA_SIZE, DATA_CHECKSUM WHERE COLL_NAME = '%s'" % collection.replace("'", "''")
+    out_format = IQUEST_SEPARATOR.join(('%s', '%s', '%s'))
+    resp = subprocess.run([iquest_cmd, '--no-page', out_format, query], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = resp.stdout.decode('utf-8', errors='replace')
+    if 'CAT_NO_ROWS_FOUND' in output or 'CAT_NO_ROWS_FOUND' in resp.stderr.decode('utf-8', errors='replace'):
+        return IrodsIndex()
+    if resp.returncode != 0:
+        raise RuntimeError("Unable to list the iRODS collection %s" % collection)
+
+    objects = {}
+    for one_line in output.splitlines():
+        if not one_line:
+            continue
+        name, size, checksum = one_line.rsplit(IQUEST_SEPARATOR, 2)
+        try:
+            objects[name] = (int(size), checksum or None)
+        except ValueError:
+            logging.debug("Ignoring unexpected iquest output: %s", one_line)
+
+    logging.info("Found %s data objects in iRODS collection %s", str(len(objects)), collection)
+    return IrodsIndex(objects)
@@ -0,0 +1,203 @@
+""" Uploaders that store local files into an iRODS collection """
+
+import abc
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+
+import file_checksum
+import run_metrics
+
+# The names of the available upload backends
+BACKEND_IPUT = 'iput'
+BACKEND_SESSION = 'session'
+UPLOAD_BACKENDS = (BACKEND_IPUT, BACKEND_SESSION)
+
+# Default location of the iRODS environment file used by the session backend
+IRODS_ENVIRONMENT_FILE = os.path.expanduser('~/.irods/irods_environment.json')
+
+
+class Uploader(abc.ABC):
+    """Base class of the uploaders that keeps track of how long each upload takes"""
+
+    name = None
+
+    def __init__(self, irods_location: str):
+        """Initializes the uploader
+        Arguments:
+            irods_location: the iRODS collection to upload files into
+        """
+        self.irods_location = irods_location.rstrip('/')
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._bytes = 0
+
+    @abc.abstractmethod
+    def _put(self, local_path: str, irods_path: str, digests: dict = None) -> None:
+        """Uploads one file, to be implemented by the backends
+        Arguments:
+            local_path: the absolute path of the local file
+            irods_path: the absolute path of the iRODS data object
+            digests: the hex digests of the local file by algorithm name if they're already known
+        Exceptions:
+            RuntimeError is raised if the file can't be uploaded
+        """
+
+    def upload(self, save_path: str, digests: dict = None) -> None:
+        """Uploads a local file into the iRODS collection, replacing any existing data object
+        Arguments:
+            save_path: the path of the local file to upload
+            digests: the hex digests of the local file by algorithm name if they're already known, which saves the
+                     uploader from reading the file again; the one matching the zone's checksum scheme is compared
+        Exceptions:
+            RuntimeError is raised if the file can't be uploaded or the stored checksum doesn't match
+        """
+        irods_path = self.irods_location + '/' + os.path.basename(save_path)
+        file_size = os.path.getsize(save_path)
+        logging.info("Uploading file to irods: %s", save_path)
+        start = time.monotonic()
+        self._put(os.path.abspath(save_path), irods_path, digests)
+        elapsed = time.monotonic() - start
+        logging.debug("Uploaded %s bytes in %.3f seconds using %s: %s", str(file_size), elapsed, self.name, save_path)
+        with self._lock:
+            self._latencies.append(elapsed)
+            self._bytes += file_size
+
+    def close(self) -> None:
+        """Releases any resources held by the uploader"""
+
+    def latency_summary(self) -> dict:
+        """Returns a summary of the uploads performed
+        Return:
+            Returns a dictionary with the backend name, number of files and bytes, and the latencies in seconds
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            total_bytes = self._bytes
+        summary = {'backend': self.name, 'files': len(latencies), 'bytes': total_bytes}
+        if latencies:
+            summary.update({'mean': sum(latencies) / len(latencies), 'p50': run_metrics.percentile(latencies, 50),
+                            'p95': run_metrics.percentile(latencies, 95), 'max': latencies[-1]})
+        return summary
+
+    def log_summary(self) -> None:
+        """Logs the summary of the uploads performed"""
+        summary = self.latency_summary()
+        if summary['files']:
+            logging.info("Uploaded %s files (%s bytes) using %s: mean %.3fs p50 %.3fs p95 %.3fs max %.3fs per file",
+                         str(summary['files']), str(summary['bytes']), summary['backend'], summary['mean'],
+                         summary['p50'], summary['p95'], summary['max'])
+
+
+class IputUploader(Uploader):
+    """Uploads each file by running the iput command"""
+
+    name = BACKEND_IPUT
+
+    def _put(self, local_path: str, irods_path: str, digests: dict = None) -> None:
+        """Uploads one file with iput, verifying its checksum
+        Arguments:
+            local_path: the absolute path of the local file
+            irods_path: the absolute path of the iRODS data object
+            digests: the hex digests of the local file by algorithm name if they're already known
+        Exceptions:
+            RuntimeError is raised if the file can't be uploaded or the stored checksum doesn't match
+        Notes:
+            When the digests are known, only the server computes a checksum and it's compared against the digest
+            of the zone's checksum scheme; otherwise iput computes the checksum of the local file as well
+        """
+        resp = subprocess.run(['iput', '-k' if digests else '-K', '-f', local_path, irods_path], stdout=subprocess.PIPE)
+        if resp.returncode != 0:
+            raise RuntimeError("Unable to load file to iRODS %s" % local_path)
+
+        if digests:
+            resp = subprocess.run(['ichksum', irods_path], stdout=subprocess.PIPE)
+            # Each checksum line ends with the data object's checksum, which is followed by a summary line
+            stored = None
+            for one_line in resp.stdout.decode('utf-8', errors='replace').splitlines():
+                one_parts = one_line.split()
+                if one_parts and file_checksum.parse_irods_checksum(one_parts[-1]):
+                    stored = one_parts[-1]
+                    break
+            if resp.returncode != 0 or not stored:
+                raise RuntimeError("Unable to get the iRODS checksum of %s" % irods_path)
+            file_checksum.verify_irods_checksum(local_path, stored, digests)
+
+
+class SessionUploader(Uploader):
+    """Uploads files over a pool of iRODS sessions that are kept open between files"""
+
+    name = BACKEND_SESSION
+
+    def __init__(self, irods_location: str, num_sessions: int = 1, env_file: str = IRODS_ENVIRONMENT_FILE,
+                 threads_per_file: int = 0):
+        """Initializes the uploader and opens the sessions
+        Arguments:
+            irods_location: the iRODS collection to upload files into
+            num_sessions: the number of sessions to open, which is the number of uploads that can run at once
+            env_file: the iRODS environment file with the connection and authentication settings
+            threads_per_file: the number of transfer threads for each file (0 lets iRODS decide)
+        Exceptions:
+            RuntimeError is raised if python-irodsclient isn't installed
+        """
+        super().__init__(irods_location)
+        try:
+            from irods.session import iRODSSession
+            import irods.keywords
+        except ImportError as ex:
+            raise RuntimeError("The %s upload backend needs python-irodsclient to be installed" % self.name) from ex
+
+        self._keywords = irods.keywords
+        self._threads_per_file = threads_per_file
+        self._sessions = queue.Queue()
+        for _ in range(max(1, num_sessions)):
+            self._sessions.put(iRODSSession(irods_env_file=env_file))
+
+    def _put(self, local_path: str, irods_path: str, digests: dict = None) -> None:
+        """Uploads one file using the next available session, verifying its checksum
+        Arguments:
+            local_path: the absolute path of the local file
+            irods_path: the absolute path of the iRODS data object
+            digests: the hex digests of the local file by algorithm name if they're already known
+        Exceptions:
+            RuntimeError is raised if the file can't be uploaded or the stored checksum doesn't match
+        """
+        session = self._sessions.get()
+        try:
+            checksum_keyword = self._keywords.REG_CHKSUM_KW if digests else self._keywords.VERIFY_CHKSUM_KW
+            options = {self._keywords.FORCE_FLAG_KW: '', checksum_keyword: ''}
+            session.data_objects.put(local_path, irods_path, num_threads=self._threads_per_file, **options)
+            stored = session.data_objects.get(irods_path).checksum if digests else None
+        except Exception as ex:
+            raise RuntimeError("Unable to load file to iRODS %s: %s" % (local_path, str(ex))) from ex
+        finally:
+            self._sessions.put(session)
+
+        if digests:
+            file_checksum.verify_irods_checksum(local_path, stored, digests)
+
+    def close(self) -> None:
+        """Closes the sessions"""
+        while not self._sessions.empty():
+            self._sessions.get().cleanup()
+
+
+def create_uploader(backend: str, irods_location: str, num_streams: int = 1) -> Uploader:
+    """Creates an uploader
+    Arguments:
+        backend: the name of the upload backend to use
+        irods_location: the iRODS collection to upload files into
+        num_streams: the number of uploads that can run at the same time
+    Return:
+        Returns the uploader
+    Exceptions:
+        RuntimeError is raised if the backend is unknown or can't be used
+    """
+    if backend == BACKEND_IPUT:
+        return IputUploader(irods_location)
+    if backend == BACKEND_SESSION:
+        return SessionUploader(irods_location, num_streams)
+    raise RuntimeError("Unknown iRODS upload backend: %s" % backend)
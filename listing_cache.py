@@ -0,0 +1,135 @@
+""" On-disk cache of Globus endpoint folder listings """
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# Default number of seconds a cached listing is used before the folder is checked again
+CACHE_TTL_SECONDS = 24 * 60 * 60
+# Default name of the cache file
+CACHE_FILE_NAME = 'globus_listing.sqlite'
+
+
+def _cache_path(path: str) -> str:
+    """Returns the folder path used as a cache key, without any trailing separator
+    Arguments:
+        path: the path of the folder
+    Return:
+        Returns the normalized path
+    """
+    return path.rstrip('/') or '/'
+
+
+class ListingCache:
+    """SQLite backed cache of folder listings keyed by endpoint ID and folder path
+    Notes:
+        A listing older than the TTL is still used when the folder's last modified time, as found in the
+        listing of its parent folder, hasn't changed since the listing was cached. This allows an expired
+        tree of folders to be refreshed by only re-listing the folders that have changed
+    """
+
+    def __init__(self, cache_path: str, ttl: int = CACHE_TTL_SECONDS):
+        """Opens the cache file, creating it if needed
+        Arguments:
+            cache_path: the path to the SQLite cache file
+            ttl: the number of seconds a listing is used without checking the folder for changes
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS listings (
+                endpoint_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                folder_modified TEXT,
+                listed_at REAL NOT NULL,
+                PRIMARY KEY (endpoint_id, path));
+            CREATE TABLE IF NOT EXISTS entries (
+                endpoint_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                name TEXT NOT NULL,
+                type TEXT NOT NULL,
+                size INTEGER,
+                last_modified TEXT,
+                PRIMARY KEY (endpoint_id, path, name));
+            """)
+        self._conn.commit()
+
+    def close(self) -> None:
+        """Closes the cache file"""
+        with self._lock:
+            self._conn.close()
+
+    def clear(self) -> None:
+        """Removes all cached listings"""
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+            self._conn.execute("DELETE FROM listings")
+            self._conn.commit()
+
+    def _folder_modified(self, endpoint_id: str, path: str) -> Optional[str]:
+        """Returns the last modified time of a folder as recorded in the cached listing of its parent
+        Arguments:
+            endpoint_id: the ID of the endpoint
+            path: the path of the folder
+        Return:
+            Returns the last modified time, or None if it's not known
+        """
+        parent_path, name = os.path.split(path)
+        parent_path = _cache_path(parent_path)
+        row = self._conn.execute("SELECT last_modified FROM entries WHERE endpoint_id=? AND path=? AND name=?",
+                                 (endpoint_id, parent_path, name)).fetchone()
+        return row[0] if row else None
+
+    def get(self, endpoint_id: str, path: str) -> Optional[list]:
+        """Returns the cached listing of a folder if it's still valid
+        Arguments:
+            endpoint_id: the ID of the endpoint
+            path: the path of the folder
+        Return:
+            Returns the list of entries in the folder, or None if the folder needs to be listed
+        """
+        path = _cache_path(path)
+        with self._lock:
+            row = self._conn.execute("SELECT folder_modified, listed_at FROM listings WHERE endpoint_id=? AND path=?",
+                                     (endpoint_id, path)).fetchone()
+            if not row:
+                return None
+
+            folder_modified, listed_at = row
+            if time.time() - listed_at > self.ttl:
+                cur_modified = self._folder_modified(endpoint_id, path)
+                if cur_modified is None or cur_modified != folder_modified:
+                    return None
+                logging.debug("Folder is unchanged since it was cached: %s", path)
+                self._conn.execute("UPDATE listings SET listed_at=? WHERE endpoint_id=? AND path=?",
+                                   (time.time(), endpoint_id, path))
+                self._conn.commit()
+
+            rows = self._conn.execute("SELECT name, type, size, last_modified FROM entries "
+                                      "WHERE endpoint_id=? AND path=? ORDER BY rowid", (endpoint_id, path)).fetchall()
+
+        return [{'name': name, 'type': entry_type, 'size': size, 'last_modified': last_modified}
+                for name, entry_type, size, last_modified in rows]
+
+    def put(self, endpoint_id: str, path: str, entries: list) -> None:
+        """Stores the listing of a folder, replacing any earlier listing
+        Arguments:
+            endpoint_id: the ID of the endpoint
+            path: the path of the folder
+            entries: the list of entries returned by listing the folder
+        """
+        path = _cache_path(path)
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE endpoint_id=? AND path=?", (endpoint_id, path))
+            self._conn.executemany("INSERT INTO entries (endpoint_id, path, name, type, size, last_modified) "
+                                   "VALUES (?, ?, ?, ?, ?, ?)",
+                                   [(endpoint_id, path, one_entry['name'], one_entry['type'], one_entry.get('size'),
+                                     one_entry.get('last_modified')) for one_entry in entries])
+            self._conn.execute("INSERT OR REPLACE INTO listings (endpoint_id, path, folder_modified, listed_at) "
+                               "VALUES (?, ?, ?, ?)",
+                               (endpoint_id, path, self._folder_modified(endpoint_id, path), time.time()))
+            self._conn.commit()
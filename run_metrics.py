@@ -0,0 +1,231 @@
+""" Timing and counting of the stages of a run, with reports for spotting slow stages """
+
+import contextlib
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+
+# The file name of the default run report
+REPORT_FILE_NAME = 'run_report.json'
+# The prefix of the names of the metrics written to a Prometheus textfile
+PROMETHEUS_PREFIX = 'terraref_transfer'
+# The percentiles reported for each stage
+REPORT_PERCENTILES = (50, 95, 99)
+# The most events kept for the report; later events are counted but not kept
+MAX_EVENTS = 1000
+
+
+def percentile(values: list, percent: float) -> float:
+    """Returns the percentile of a list of values using the nearest rank
+    Arguments:
+        values: the sorted list of values
+        percent: the percentile to return, from 0 to 100
+    Return:
+        Returns the value at the percentile
+    """
+    rank = max(1, math.ceil(percent / 100.0 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def _metric_name(name: str) -> str:
+    """Returns a name that's safe to use in a Prometheus metric name
+    Arguments:
+        name: the name to convert
+    Return:
+        Returns the name with unsupported characters replaced by underscores
+    """
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+class _StageStats:
+    """The measurements of one stage"""
+
+    def __init__(self):
+        """Initializes the measurements"""
+        self.latencies = []
+        self.files = 0
+        self.bytes = 0
+        self.first_start = None
+        self.last_end = None
+
+
+class _GaugeStats:
+    """The samples of one gauge, such as a queue depth"""
+
+    def __init__(self):
+        """Initializes the samples"""
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+        self.last = 0
+
+
+class RunMetrics:
+    """Collects the wall time, latencies, throughput, queue depths, and counts of the stages of a run
+    Notes:
+        The metrics can be recorded from any thread. Stages that run on several threads at once have their
+        rates calculated over the wall time from the first start to the last end of the stage
+    """
+
+    def __init__(self):
+        """Initializes the metrics"""
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._stages = {}
+        self._gauges = {}
+        self._counters = {}
+        self._events = []
+        self._dropped_events = 0
+
+    def observe(self, stage: str, seconds: float, files: int = 1, num_bytes: int = 0) -> None:
+        """Records one timed operation of a stage
+        Arguments:
+            stage: the name of the stage
+            seconds: the number of seconds the operation took
+            files: the number of files handled by the operation
+            num_bytes: the number of bytes handled by the operation
+        """
+        end = time.monotonic()
+        with self._lock:
+            stats = self._stages.setdefault(stage, _StageStats())
+            stats.latencies.append(seconds)
+            stats.files += files
+            stats.bytes += num_bytes
+            start = end - seconds
+            stats.first_start = start if stats.first_start is None else min(stats.first_start, start)
+            stats.last_end = end if stats.last_end is None else max(stats.last_end, end)
+
+    @contextlib.contextmanager
+    def timed(self, stage: str, files: int = 1, num_bytes: int = 0):
+        """Times the enclosed operation as part of a stage
+        Arguments:
+            stage: the name of the stage
+            files: the number of files handled by the operation
+            num_bytes: the number of bytes handled by the operation
+        Notes:
+            Operations that raise an exception aren't recorded
+        """
+        start = time.monotonic()
+        yield
+        self.observe(stage, time.monotonic() - start, files, num_bytes)
+
+    def gauge(self, name: str, value: float) -> None:
+        """Records a sample of a value that goes up and down, such as a queue depth
+        Arguments:
+            name: the name of the gauge
+            value: the current value
+        """
+        with self._lock:
+            stats = self._gauges.setdefault(name, _GaugeStats())
+            stats.samples += 1
+            stats.total += value
+            stats.max = max(stats.max, value)
+            stats.last = value
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """Adds to a counter, such as the number of retries
+        Arguments:
+            name: the name of the counter
+            amount: the amount to add
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def event(self, kind: str, **details) -> None:
+        """Records a decision or other occurrence during the run, such as a change of a concurrency limit
+        Arguments:
+            kind: the kind of event
+            details: the details of the event
+        """
+        with self._lock:
+            if len(self._events) >= MAX_EVENTS:
+                self._dropped_events += 1
+                return
+            one_event = {'time': time.time() - self._start, 'kind': kind}
+            one_event.update(details)
+            self._events.append(one_event)
+
+    def report(self) -> dict:
+        """Returns the report of the run so far
+        Return:
+            Returns a dictionary of the stages, gauges, counters and events
+        """
+        with self._lock:
+            stages = {}
+            for stage_name, stats in self._stages.items():
+                latencies = sorted(stats.latencies)
+                wall_seconds = stats.last_end - stats.first_start
+                stage_report = {'operations': len(latencies), 'files': stats.files, 'bytes': stats.bytes,
+                                'wall_seconds': wall_seconds, 'busy_seconds': sum(latencies),
+                                'files_per_second': stats.files / wall_seconds if wall_seconds > 0 else None,
+                                'bytes_per_second': stats.bytes / wall_seconds if wall_seconds > 0 else None}
+                for one_percent in REPORT_PERCENTILES:
+                    stage_report['p%s' % str(one_percent)] = percentile(latencies, one_percent)
+                stage_report['max'] = latencies[-1]
+                stages[stage_name] = stage_report
+
+            gauges = {gauge_name: {'samples': stats.samples, 'mean': stats.total / stats.samples, 'max': stats.max,
+                                   'last': stats.last} for gauge_name, stats in self._gauges.items()}
+
+            return {'started': self._start, 'run_seconds': time.time() - self._start, 'stages': stages,
+                    'gauges': gauges, 'counters': dict(self._counters), 'events': list(self._events),
+                    'dropped_events': self._dropped_events}
+
+    def log_report(self) -> None:
+        """Logs a line for each stage of the run"""
+        for stage_name, stage_report in self.report()['stages'].items():
+            logging.info("Stage %s: %s operations, %s files, %s bytes in %.3fs wall: p50 %.3fs p95 %.3fs p99 %.3fs",
+                         stage_name, str(stage_report['operations']), str(stage_report['files']),
+                         str(stage_report['bytes']), stage_report['wall_seconds'], stage_report['p50'],
+                         stage_report['p95'], stage_report['p99'])
+
+    def write_json(self, report_path: str) -> None:
+        """Writes the report of the run as JSON
+        Arguments:
+            report_path: the path of the file to write
+        """
+        with open(report_path, 'w') as out_file:
+            json.dump(self.report(), out_file, indent=2, sort_keys=True)
+            out_file.write('\n')
+
+    def write_prometheus(self, textfile_path: str) -> None:
+        """Writes the report of the run in the Prometheus text format, for the node exporter's textfile collector
+        Arguments:
+            textfile_path: the path of the file to write
+        Notes:
+            The file is written under a temporary name and then renamed so that it's never read half written
+        """
+        report = self.report()
+        lines = ['%s_run_seconds %s' % (PROMETHEUS_PREFIX, repr(float(report['run_seconds'])))]
+        for stage_name, stage_report in sorted(report['stages'].items()):
+            labels = '{stage="%s"}' % stage_name
+            for one_key in ('operations', 'files', 'bytes', 'wall_seconds', 'busy_seconds'):
+                lines.append('%s_stage_%s%s %s' % (PROMETHEUS_PREFIX, one_key, labels, repr(float(stage_report[one_key]))))
+            for one_percent in REPORT_PERCENTILES:
+                lines.append('%s_stage_latency_seconds{stage="%s",quantile="%s"} %s' %
+                             (PROMETHEUS_PREFIX, stage_name, str(one_percent / 100.0),
+                              repr(float(stage_report['p%s' % str(one_percent)]))))
+        for gauge_name, gauge_report in sorted(report['gauges'].items()):
+            for one_key in ('mean', 'max', 'last'):
+                lines.append('%s_%s_%s %s' % (PROMETHEUS_PREFIX, _metric_name(gauge_name), one_key,
+                                              repr(float(gauge_report[one_key]))))
+        for counter_name, counter_value in sorted(report['counters'].items()):
+            lines.append('%s_%s_total %s' % (PROMETHEUS_PREFIX, _metric_name(counter_name), repr(float(counter_value))))
+
+        out_dir = os.path.dirname(os.path.abspath(textfile_path))
+        file_desc, temp_path = tempfile.mkstemp(dir=out_dir, prefix='.' + os.path.basename(textfile_path))
+        try:
+            with os.fdopen(file_desc, 'w') as out_file:
+                out_file.write('\n'.join(lines) + '\n')
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, textfile_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+""" Shared manifest of the files to transfer, split between several transfer nodes through leases """
+
+import argparse
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# Default number of seconds a claim on a file lasts before another worker can reclaim it
+SHARD_LEASE_SECONDS = 900
+# Default number of times a file is tried before it's marked as failed
+SHARD_MAX_ATTEMPTS = 3
+
+# The states of a file in the manifest
+SHARD_PENDING = 'pending'
+SHARD_CLAIMED = 'claimed'
+SHARD_DONE = 'done'
+SHARD_FAILED = 'failed'
+SHARD_STATES = (SHARD_PENDING, SHARD_CLAIMED, SHARD_DONE, SHARD_FAILED)
+
+
+def default_worker_id() -> str:
+    """Returns an ID for this process that's unique across the transfer nodes
+    Return:
+        Returns the host name and process ID
+    """
+    return '%s-%s' % (socket.gethostname(), str(os.getpid()))
+
+
+class ShardManifest:
+    """SQLite backed list of files that several workers claim a few at a time
+    Notes:
+        The manifest is meant to be on a filesystem shared by the transfer nodes. Claims are leases that are
+        renewed in the background while the worker is alive; a worker that dies stops renewing and its files
+        are reclaimed by the other workers once the leases expire. The rollback journal is used instead of WAL
+        since WAL doesn't work across machines. Network filesystems need working POSIX locks for this to be safe
+    """
+
+    def __init__(self, manifest_path: str, worker_id: str = None, lease_seconds: int = SHARD_LEASE_SECONDS,
+                 max_attempts: int = SHARD_MAX_ATTEMPTS):
+        """Opens the manifest file, creating it if needed, and starts renewing this worker's leases
+        Arguments:
+            manifest_path: the path to the SQLite manifest file
+            worker_id: the ID of this worker; defaults to the host name and process ID
+            lease_seconds: the number of seconds a claim lasts without being renewed
+            max_attempts: the number of times a file is tried before it's marked as failed
+        """
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(manifest_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                remote_path TEXT PRIMARY KEY,
+                size INTEGER,
+                state TEXT NOT NULL,
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated REAL NOT NULL)
+            """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_state ON entries (state, lease_expires)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS workers (
+                worker TEXT PRIMARY KEY,
+                started REAL NOT NULL,
+                heartbeat REAL NOT NULL,
+                files_done INTEGER NOT NULL DEFAULT 0,
+                bytes_done INTEGER NOT NULL DEFAULT 0,
+                files_failed INTEGER NOT NULL DEFAULT 0)
+            """)
+        now = time.time()
+        self._conn.execute("INSERT OR REPLACE INTO workers (worker, started, heartbeat) VALUES (?, ?, ?)",
+                           (self.worker_id, now, now))
+
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._run_heartbeat, name='manifest-heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    def _write(self, statements: list) -> None:
+        """Runs statements in one write transaction, waiting for other workers' transactions to finish
+        Arguments:
+            statements: list of (SQL, parameters) tuples to run in order
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _run_heartbeat(self) -> None:
+        """Renews this worker's leases until the manifest is closed"""
+        while not self._stop.wait(self.lease_seconds / 3.0):
+            try:
+                self.renew()
+            except sqlite3.Error as ex:
+                logging.warning("Unable to renew the leases of worker %s: %s", self.worker_id, str(ex))
+
+    def close(self) -> None:
+        """Stops renewing leases, returns any files still claimed to the manifest, and closes the file"""
+        self._stop.set()
+        self._heartbeat.join()
+        self.release_claimed()
+        with self._lock:
+            self._conn.close()
+
+    def is_empty(self) -> bool:
+        """Returns whether the manifest has no files in it"""
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM entries LIMIT 1").fetchone() is None
+
+    def add(self, files, file_sizes: dict = None) -> int:
+        """Adds files to the manifest, leaving files already in the manifest alone
+        Arguments:
+            files: the remote file paths to add; this can be any iterable, which is only read once
+            file_sizes: optional dictionary of remote file paths to their sizes
+        Return:
+            Returns the number of files newly added
+        """
+        now = time.time()
+        rows = [(one_file, file_sizes.get(one_file) if file_sizes else None, SHARD_PENDING, now) for one_file in files]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("INSERT OR IGNORE INTO entries (remote_path, size, state, updated) "
+                                       "VALUES (?, ?, ?, ?)", rows)
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+            return self._conn.total_changes - before
+
+    def claim(self, max_files: int) -> dict:
+        """Claims pending files, along with any files whose leases have expired
+        Arguments:
+            max_files: the maximum number of files to claim
+        Return:
+            Returns a dictionary of the claimed remote file paths to their sizes (None when not known); an empty
+            dictionary means there's nothing left to claim
+        """
+        now = time.time()
+        with self._lock:
+            # The immediate transaction keeps other workers from claiming until these files are marked as claimed
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute("SELECT remote_path, size, state, worker FROM entries WHERE state=? OR "
+                                          "(state=? AND lease_expires<?) ORDER BY rowid LIMIT ?",
+                                          (SHARD_PENDING, SHARD_CLAIMED, now, max(1, max_files))).fetchall()
+                self._conn.executemany("UPDATE entries SET state=?, worker=?, lease_expires=?, updated=? WHERE remote_path=?",
+                                       [(SHARD_CLAIMED, self.worker_id, now + self.lease_seconds, now, one_row[0])
+                                        for one_row in rows])
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        for remote_path, _, state, worker in rows:
+            if state == SHARD_CLAIMED:
+                logging.warning("Reclaiming file with an expired lease from worker %s: %s", worker, remote_path)
+        return {remote_path: size for remote_path, size, _, _ in rows}
+
+    def renew(self) -> None:
+        """Extends the leases on the files this worker has claimed and records that the worker is alive"""
+        now = time.time()
+        self._write([
+            ("UPDATE entries SET lease_expires=? WHERE worker=? AND state=?", (now + self.lease_seconds, self.worker_id,
+                                                                               SHARD_CLAIMED)),
+            ("UPDATE workers SET heartbeat=? WHERE worker=?", (now, self.worker_id)),
+        ])
+
+    def complete(self, remote_path: str) -> None:
+        """Records that a claimed file is finished
+        Arguments:
+            remote_path: the remote path of the file
+        """
+        now = time.time()
+        self._write([
+            ("UPDATE workers SET files_done=files_done+1, bytes_done=bytes_done+COALESCE((SELECT size FROM entries "
+             "WHERE remote_path=? AND worker=? AND state=?), 0), heartbeat=? WHERE worker=?",
+             (remote_path, self.worker_id, SHARD_CLAIMED, now, self.worker_id)),
+            ("UPDATE entries SET state=?, lease_expires=NULL, updated=? WHERE remote_path=? AND worker=?",
+             (SHARD_DONE, now, remote_path, self.worker_id)),
+        ])
+
+    def fail(self, remote_path: str) -> None:
+        """Records that a claimed file failed, returning it to the manifest unless it's been tried too many times
+        Arguments:
+            remote_path: the remote path of the file
+        """
+        now = time.time()
+        self._write([
+            ("UPDATE workers SET files_failed=files_failed+1 WHERE worker=?", (self.worker_id,)),
+            ("UPDATE entries SET attempts=attempts+1, worker=NULL, lease_expires=NULL, updated=?, "
+             "state=CASE WHEN attempts+1>=? THEN ? ELSE ? END WHERE remote_path=? AND worker=? AND state=?",
+             (now, self.max_attempts, SHARD_FAILED, SHARD_PENDING, remote_path, self.worker_id, SHARD_CLAIMED)),
+        ])
+
+    def fail_claimed(self) -> None:
+        """Records that all the files this worker still has claimed failed"""
+        now = time.time()
+        self._write([
+            ("UPDATE workers SET files_failed=files_failed+(SELECT COUNT(*) FROM entries WHERE worker=? AND state=?) "
+             "WHERE worker=?", (self.worker_id, SHARD_CLAIMED, self.worker_id)),
+            ("UPDATE entries SET attempts=attempts+1, worker=NULL, lease_expires=NULL, updated=?, "
+             "state=CASE WHEN attempts+1>=? THEN ? ELSE ? END WHERE worker=? AND state=?",
+             (now, self.max_attempts, SHARD_FAILED, SHARD_PENDING, self.worker_id, SHARD_CLAIMED)),
+        ])
+
+    def release_claimed(self) -> None:
+        """Returns the files this worker still has claimed to the manifest without counting an attempt"""
+        with self._lock:
+            self._conn.execute("UPDATE entries SET state=?, worker=NULL, lease_expires=NULL, updated=? "
+                               "WHERE worker=? AND state=?", (SHARD_PENDING, time.time(), self.worker_id, SHARD_CLAIMED))
+
+    def progress(self) -> dict:
+        """Returns the combined progress of all the workers
+        Return:
+            Returns a dictionary with the number of files and bytes in each state, and the totals of each worker
+        """
+        with self._lock:
+            return read_progress(self._conn)
+
+
+def read_progress(conn: sqlite3.Connection) -> dict:
+    """Reads the combined progress of all the workers from a manifest
+    Arguments:
+        conn: the open connection to the manifest file
+    Return:
+        Returns a dictionary with the number of files and bytes in each state, and the totals of each worker
+    """
+    states = {one_state: {'files': 0, 'bytes': 0} for one_state in SHARD_STATES}
+    for state, files, num_bytes in conn.execute("SELECT state, COUNT(*), COALESCE(SUM(size), 0) FROM entries GROUP BY state"):
+        states[state] = {'files': files, 'bytes': num_bytes}
+    claimed = dict(conn.execute("SELECT worker, COUNT(*) FROM entries WHERE state=? GROUP BY worker",
+                                (SHARD_CLAIMED,)).fetchall())
+    workers = {}
+    for worker, started, heartbeat, files_done, bytes_done, files_failed in conn.execute(
+            "SELECT worker, started, heartbeat, files_done, bytes_done, files_failed FROM workers ORDER BY worker"):
+        workers[worker] = {'started': started, 'heartbeat': heartbeat, 'claimed': claimed.get(worker, 0),
+                           'files_done': files_done, 'bytes_done': bytes_done, 'files_failed': files_failed,
+                           'bytes_per_second': bytes_done / max(heartbeat - started, 1e-9)}
+    return {'states': states, 'workers': workers}
+
+
+def print_progress(manifest_path: str) -> None:
+    """Prints the combined progress of the workers sharing a manifest
+    Arguments:
+        manifest_path: the path to the SQLite manifest file
+    """
+    conn = sqlite3.connect(manifest_path, timeout=60)
+    try:
+        progress = read_progress(conn)
+    finally:
+        conn.close()
+
+    print("%-10s %10s %16s" % ('state', 'files', 'bytes'))
+    for one_state in SHARD_STATES:
+        print("%-10s %10d %16d" % (one_state, progress['states'][one_state]['files'],
+                                   progress['states'][one_state]['bytes']))
+    total = sum(one_state['files'] for one_state in progress['states'].values())
+    done = progress['states'][SHARD_DONE]['files']
+    print("%s of %s files done (%.1f%%)" % (str(done), str(total), 100.0 * done / total if total else 0.0))
+
+    now = time.time()
+    print("%-32s %8s %10s %16s %8s %10s %14s" % ('worker', 'claimed', 'done', 'bytes', 'failed', 'MB/s', 'last seen (s)'))
+    for worker, one_worker in progress['workers'].items():
+        print("%-32s %8d %10d %16d %8d %10.1f %14.0f" % (worker, one_worker['claimed'], one_worker['files_done'],
+                                                        one_worker['bytes_done'], one_worker['files_failed'],
+                                                        one_worker['bytes_per_second'] / (1024 * 1024),
+                                                        now - one_worker['heartbeat']))
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description='Show the combined progress of the workers sharing a manifest')
+    PARSER.add_argument('manifest', type=str, help='Path to the shared manifest file')
+    print_progress(PARSER.parse_args().manifest)
@@ -0,0 +1,213 @@
+""" Bounded staging queue between the Globus transfers and the uploading of the staged files """
+
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from typing import Callable
+
+import concurrency_control
+import run_metrics
+
+# Default number of staged files waiting for upload before transfers are held back
+STAGING_QUEUE_DEPTH = 4
+# Default number of upload workers draining the staging queue
+STAGING_UPLOAD_WORKERS = 1
+# Default fraction of the free disk space that staged files may use when no budget is given
+STAGING_FREE_SPACE_FRACTION = 0.9
+
+# The orders that transfers can be scheduled in
+ORDER_LISTED = 'listed'
+ORDER_LARGEST = 'largest'
+ORDER_SMALLEST = 'smallest'
+ORDER_INTERLEAVED = 'interleaved'
+TRANSFER_ORDERS = (ORDER_LISTED, ORDER_LARGEST, ORDER_SMALLEST, ORDER_INTERLEAVED)
+
+
+def default_budget(staging_path: str) -> int:
+    """Returns the default number of bytes that can be staged
+    Arguments:
+        staging_path: the path of the folder files are staged in
+    Return:
+        Returns a fraction of the free space on the disk holding the folder
+    """
+    return int(shutil.disk_usage(staging_path).free * STAGING_FREE_SPACE_FRACTION)
+
+
+def order_transfers(files: tuple, file_sizes: dict, order: str) -> tuple:
+    """Orders the files to transfer
+    Arguments:
+        files: the remote files to order
+        file_sizes: dictionary of remote file paths to their sizes; missing files are treated as zero bytes
+        order: one of the TRANSFER_ORDERS values
+    Return:
+        Returns the ordered files
+    Notes:
+        The interleaved order alternates between the largest and smallest remaining files so that small
+        files keep arriving while large ones are uploading
+    """
+    if order == ORDER_LISTED or not file_sizes:
+        return tuple(files)
+
+    by_size = sorted(files, key=lambda one_file: file_sizes.get(one_file, 0), reverse=True)
+    if order == ORDER_LARGEST:
+        return tuple(by_size)
+    if order == ORDER_SMALLEST:
+        return tuple(reversed(by_size))
+
+    ordered = []
+    while by_size:
+        ordered.append(by_size.pop(0))
+        if by_size:
+            ordered.append(by_size.pop())
+    return tuple(ordered)
+
+
+class StagingBudget:
+    """Limits the number of bytes of staged files on the local disk
+    Notes:
+        Space is reserved before a transfer starts and released once the file has been uploaded and removed.
+        A reservation larger than the whole budget is admitted once nothing else is staged, so that it can't
+        wait forever
+    """
+
+    def __init__(self, budget_bytes: int):
+        """Initializes the budget
+        Arguments:
+            budget_bytes: the maximum number of bytes that can be staged
+        """
+        self.budget_bytes = budget_bytes
+        self._staged_bytes = 0
+        self._condition = threading.Condition()
+
+    @property
+    def staged_bytes(self) -> int:
+        """Returns the number of bytes currently reserved"""
+        with self._condition:
+            return self._staged_bytes
+
+    def acquire(self, num_bytes: int) -> None:
+        """Reserves space for files about to be staged, waiting until there's enough room
+        Arguments:
+            num_bytes: the number of bytes to reserve
+        """
+        with self._condition:
+            while self._staged_bytes and self._staged_bytes + num_bytes > self.budget_bytes:
+                logging.debug("Waiting for %s bytes of staging space (%s of %s bytes in use)", str(num_bytes),
+                              str(self._staged_bytes), str(self.budget_bytes))
+                self._condition.wait()
+            self._staged_bytes += num_bytes
+
+    def release(self, num_bytes: int) -> None:
+        """Releases reserved space
+        Arguments:
+            num_bytes: the number of bytes to release
+        """
+        with self._condition:
+            self._staged_bytes = max(0, self._staged_bytes - num_bytes)
+            self._condition.notify_all()
+
+
+class StagingPipeline:
+    """Uploads staged files on worker threads while the caller keeps transferring files
+    Notes:
+        Staging a file blocks while the queue is full, which holds back new transfers until the
+        uploaders have caught up. Files are removed from the local disk once they're uploaded, or once their
+        upload has failed on every retry, so that they don't outlast their staging space. A failed upload is
+        retried with backoff, and a concurrency controller can hold some of the workers back
+        while the server is struggling
+    """
+
+    def __init__(self, upload: Callable[[str], None], queue_depth: int = STAGING_QUEUE_DEPTH,
+                 num_workers: int = STAGING_UPLOAD_WORKERS, on_done: Callable[[str, bool], None] = None,
+                 metrics: run_metrics.RunMetrics = None, controller: concurrency_control.AimdController = None,
+                 retries: int = 0):
+        """Initializes the pipeline and starts the upload workers
+        Arguments:
+            upload: the function that uploads one local file, raising RuntimeError on failure
+            queue_depth: the maximum number of staged files waiting for upload
+            num_workers: the number of upload workers to start
+            on_done: optional function called with each staged file and whether it was uploaded, once it's
+                     finished with
+            metrics: optional run metrics to record the staging queue depth and the removal of files in
+            controller: optional controller adjusting the number of uploads running at the same time, up to num_workers
+            retries: the number of times a failed upload is retried
+        """
+        self._upload = upload
+        self._controller = controller
+        self._retries = retries
+        self._on_done = on_done
+        self._metrics = metrics
+        self._queue = queue.Queue(maxsize=max(1, queue_depth))
+        self._lock = threading.Lock()
+        self._failed = []
+        self._workers = []
+        for idx in range(max(1, num_workers)):
+            worker = threading.Thread(target=self._run_worker, name='uploader-%s' % str(idx), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _run_worker(self) -> None:
+        """Uploads and removes staged files until the end of the queue is reached"""
+        while True:
+            save_path = self._queue.get()
+            uploaded = False
+            try:
+                if save_path is None:
+                    return
+                logging.info("Uploading staged file (%s waiting): %s", str(self._queue.qsize()), save_path)
+                concurrency_control.call_with_retries(lambda: self._upload(save_path), "upload of '%s'" % save_path,
+                                                      self._retries, (RuntimeError,), self._controller, self._metrics,
+                                                      os.path.getsize(save_path))
+                start = time.monotonic()
+                os.remove(save_path)
+                if self._metrics:
+                    self._metrics.observe('delete', time.monotonic() - start)
+                uploaded = True
+            except (RuntimeError, OSError) as ex:
+                logging.warning("Failed to upload image: %s", str(ex))
+                with self._lock:
+                    self._failed.append(save_path)
+                self._remove_failed(save_path)
+            finally:
+                if save_path is not None and self._on_done:
+                    self._on_done(save_path, uploaded)
+                self._queue.task_done()
+
+    @staticmethod
+    def _remove_failed(save_path: str) -> None:
+        """Removes a file that failed to upload, so that the staging space released for it is free on the disk
+        Arguments:
+            save_path: the path of the local file
+        Notes:
+            The file is transferred again when it's next tried
+        """
+        try:
+            if os.path.exists(save_path):
+                os.remove(save_path)
+        except OSError as ex:
+            logging.warning("Unable to remove file that failed to upload %s: %s", save_path, str(ex))
+
+    def stage(self, save_path: str) -> None:
+        """Adds a downloaded file to the queue of files to upload, waiting if the queue is full
+        Arguments:
+            save_path: the path of the local file to upload
+        """
+        if self._metrics:
+            self._metrics.gauge('staging_queue_depth', self._queue.qsize())
+        self._queue.put(save_path)
+
+    def close(self) -> tuple:
+        """Waits for all the staged files to be uploaded and stops the workers
+        Return:
+            Returns the list of local files that failed to upload
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+        return tuple(self._failed)
@@ -0,0 +1,266 @@
+""" Monitoring of many Globus transfer tasks at the same time """
+
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    # globus_sdk is imported when a task is submitted or checked instead of when this module loads
+    import globus_sdk
+
+import concurrency_control
+
+# Default maximum number of transfer tasks that are active at the same time
+MONITOR_MAX_ACTIVE = 4
+# Default shortest and longest number of seconds between status checks of a task
+MONITOR_MIN_INTERVAL = 0.5
+MONITOR_MAX_INTERVAL = 30.0
+# The transfer rate assumed when estimating how long a task will take
+MONITOR_ASSUMED_BYTES_PER_SECOND = 50 * 1024 * 1024
+# How much the interval between status checks of a task grows after each check
+MONITOR_BACKOFF_FACTOR = 1.5
+
+# The task statuses that indicate the task is finished
+TASK_DONE_STATUSES = ('SUCCEEDED', 'FAILED')
+
+
+class _MonitoredTask:
+    """A submitted task that's being monitored"""
+
+    def __init__(self, task_id: str, context: object, interval: float, next_check: float, deadline: float,
+                 submitted: float = None, expected_bytes: int = 0):
+        """Initializes the task
+        Arguments:
+            task_id: the ID of the Globus task
+            context: the caller's information associated with the task
+            interval: the number of seconds until the following status check
+            next_check: the time of the next status check
+            deadline: the time after which the task is cancelled
+            submitted: the time the task was submitted
+            expected_bytes: the number of bytes the task transfers
+        """
+        self.task_id = task_id
+        self.context = context
+        self.submitted = submitted
+        self.expected_bytes = expected_bytes
+        self.interval = interval
+        self.next_check = next_check
+        self.deadline = deadline
+
+
+class TaskMonitor:
+    """Keeps several Globus transfer tasks in flight and reports each one as soon as it finishes
+    Notes:
+        The status of every active task is checked from a single background thread. Small tasks are checked
+        soon after they're submitted and large tasks later, with the interval between checks growing the
+        longer a task runs. The completion callback is called on the monitor thread. When a concurrency controller
+        is given, its limit replaces the maximum number of active tasks, and the outcome of each task is reported to it
+    """
+
+    def __init__(self, client: 'globus_sdk.TransferClient', on_complete: Callable[[str, str, object], None],
+                 max_active: int = MONITOR_MAX_ACTIVE, min_interval: float = MONITOR_MIN_INTERVAL,
+                 max_interval: float = MONITOR_MAX_INTERVAL, clock: Callable[[], float] = time.monotonic,
+                 controller: concurrency_control.AimdController = None,
+                 submit_retries: int = concurrency_control.RETRY_ATTEMPTS):
+        """Initializes the monitor and starts its thread
+        Arguments:
+            client: the Globus transfer client to use
+            on_complete: called with the task ID, the final status, and the task's context when a task finishes; it
+                         can return False when some of the task's files failed, which counts as a failure of the task
+            max_active: the maximum number of tasks that are active at the same time
+            min_interval: the shortest number of seconds between status checks of a task
+            max_interval: the longest number of seconds between status checks of a task
+            clock: the function returning the current time in seconds
+            controller: optional controller adjusting the number of active tasks, up to its own maximum
+            submit_retries: the number of times a rejected submission is retried
+        """
+        self._client = client
+        self._on_complete = on_complete
+        self.max_active = max(1, max_active)
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._clock = clock
+        self._controller = controller
+        self._submit_retries = submit_retries
+        self._tasks = []
+        self._condition = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='task-monitor', daemon=True)
+        self._thread.start()
+
+    @property
+    def active_count(self) -> int:
+        """Returns the number of tasks being monitored"""
+        with self._condition:
+            return len(self._tasks)
+
+    def _first_interval(self, expected_bytes: int) -> float:
+        """Returns the number of seconds to wait before first checking a task
+        Arguments:
+            expected_bytes: the number of bytes the task transfers
+        Return:
+            Returns the estimated transfer time, limited to the minimum and maximum intervals
+        """
+        estimate = expected_bytes / MONITOR_ASSUMED_BYTES_PER_SECOND if expected_bytes else 0
+        return min(self._max_interval, max(self._min_interval, estimate))
+
+    def _active_limit(self) -> int:
+        """Returns the number of tasks that can be active at the same time"""
+        if self._controller:
+            return self._controller.limit
+        return self.max_active
+
+    def wait_for_slot(self) -> None:
+        """Waits while the maximum number of tasks are active"""
+        with self._condition:
+            while len(self._tasks) >= self._active_limit():
+                self._condition.wait()
+
+    def wait_for_completion(self, timeout: float = None) -> None:
+        """Waits for a task to finish, returning at once if no tasks are active
+        Arguments:
+            timeout: the longest number of seconds to wait, or None to wait until a task finishes
+        Notes:
+            This can also return early when a task is submitted, so callers check for what they're waiting for
+        """
+        with self._condition:
+            if self._tasks:
+                self._condition.wait(timeout=timeout)
+
+    def _submit_transfer(self, transfer_data: 'globus_sdk.TransferData') -> str:
+        """Submits a transfer task, retrying with backoff when Globus can't be reached or rejects it for a reason that may pass
+        Arguments:
+            transfer_data: the transfer to submit
+        Return:
+            Returns the ID of the submitted task
+        Exceptions:
+            globus_sdk.exc.GlobusError is raised if the task couldn't be submitted
+        Notes:
+            The transfer data keeps its submission ID across attempts, so a retry of a submission that Globus
+            accepted but didn't answer won't start a second task
+        """
+        import globus_sdk
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return self._client.submit_transfer(transfer_data)['task_id']
+            except globus_sdk.exc.GlobusError as ex:
+                if self._controller:
+                    self._controller.failure(concurrency_control.is_throttled(ex))
+                if attempt > self._submit_retries or not concurrency_control.is_retryable(ex):
+                    raise
+                delay = concurrency_control.backoff_delay(attempt)
+                logging.warning("Retrying transfer submission in %.1f seconds after attempt %s failed: %s", delay,
+                                str(attempt), str(ex))
+                if self._controller and self._controller.metrics:
+                    self._controller.metrics.count(self._controller.name + '_retries')
+                time.sleep(delay)
+
+    def submit(self, transfer_data: 'globus_sdk.TransferData', context: object = None, expected_bytes: int = 0,
+               timeout: float = None) -> str:
+        """Submits a transfer task, first waiting while the maximum number of tasks are active
+        Arguments:
+            transfer_data: the transfer to submit
+            context: the caller's information to pass to the completion callback
+            expected_bytes: the number of bytes the task transfers, used to decide when to check on it
+            timeout: the number of seconds after which the task is cancelled
+        Return:
+            Returns the ID of the submitted task
+        """
+        self.wait_for_slot()
+
+        task_id = self._submit_transfer(transfer_data)
+        now = self._clock()
+        interval = self._first_interval(expected_bytes)
+        with self._condition:
+            self._tasks.append(_MonitoredTask(task_id, context, interval, now + interval,
+                                              now + timeout if timeout else None, now, expected_bytes))
+            self._condition.notify_all()
+        logging.debug("Monitoring transfer task %s, first check in %.1f seconds", task_id, interval)
+        return task_id
+
+    def _check_task(self, task: _MonitoredTask) -> str:
+        """Checks the status of a task, cancelling it if it's past its deadline
+        Arguments:
+            task: the task to check
+        Return:
+            Returns the final status of the task, or None if the task is still active
+        """
+        import globus_sdk
+
+        try:
+            status = self._client.get_task(task.task_id)['status']
+        except globus_sdk.exc.GlobusError as ex:
+            logging.warning("Unable to check transfer task %s: %s", task.task_id, str(ex))
+            if self._controller and concurrency_control.is_throttled(ex):
+                self._controller.failure(throttled=True)
+            return None
+        if status in TASK_DONE_STATUSES:
+            return status
+
+        if task.deadline is not None and self._clock() >= task.deadline:
+            logging.warning("Transfer task %s did not complete in time, cancelling it", task.task_id)
+            try:
+                self._client.cancel_task(task.task_id)
+            except globus_sdk.exc.GlobusError as ex:
+                logging.warning("Unable to cancel transfer task %s: %s", task.task_id, str(ex))
+            return 'CANCELED'
+        return None
+
+    def poll(self) -> float:
+        """Checks on the tasks that are due and reports the ones that have finished
+        Return:
+            Returns the number of seconds until the next task is due to be checked, or None if there are no tasks
+        """
+        with self._condition:
+            now = self._clock()
+            due_tasks = [one_task for one_task in self._tasks if one_task.next_check <= now]
+
+        for one_task in due_tasks:
+            status = self._check_task(one_task)
+            if status is None:
+                one_task.interval = min(self._max_interval, one_task.interval * MONITOR_BACKOFF_FACTOR)
+                one_task.next_check = self._clock() + one_task.interval
+                continue
+
+            logging.debug("Transfer task %s finished with status %s", one_task.task_id, status)
+            try:
+                all_done = self._on_complete(one_task.task_id, status, one_task.context)
+                if self._controller:
+                    if status == 'SUCCEEDED' and all_done is not False:
+                        self._controller.success(self._clock() - one_task.submitted, one_task.expected_bytes)
+                    else:
+                        self._controller.failure()
+            finally:
+                with self._condition:
+                    self._tasks.remove(one_task)
+                    self._condition.notify_all()
+
+        with self._condition:
+            if not self._tasks:
+                return None
+            return max(0.0, min(one_task.next_check for one_task in self._tasks) - self._clock())
+
+    def _run(self) -> None:
+        """Checks on the tasks until the monitor is closed and all the tasks have finished"""
+        while True:
+            try:
+                wait_seconds = self.poll()
+            except Exception as ex:
+                logging.error("Transfer task monitor failed to process a task: %s", str(ex))
+                wait_seconds = self._min_interval
+            with self._condition:
+                if self._closing and not self._tasks:
+                    return
+                # Wake up early when a new task is submitted or the monitor is closed
+                self._condition.wait(timeout=wait_seconds)
+
+    def close(self) -> None:
+        """Waits for all the tasks to finish and stops the monitor"""
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join()
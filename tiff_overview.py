@@ -0,0 +1,236 @@
+""" Derivation of reduced scale overviews of full field GeoTIFF mosaics """
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import time
+from typing import Callable, Optional
+
+# Default number of source pixels along each side of an overview pixel (10 gives a 10 percent image)
+OVERVIEW_FACTOR = 10
+# Default number of bytes of source pixels read at a time, which bounds the memory used for any size of mosaic
+OVERVIEW_STRIP_BYTES = 64 * 1024 * 1024
+# Default number of overviews derived at the same time
+OVERVIEW_WORKERS = 2
+# The fragment added to the name of a mosaic to name its overview
+OVERVIEW_NAME_PART = '_10pct'
+# The creation options of the overview GeoTIFFs
+OVERVIEW_CREATE_OPTIONS = ('TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER')
+
+
+def overview_name(file_name: str) -> str:
+    """Returns the name of the overview of a mosaic
+    Arguments:
+        file_name: the name of the mosaic file
+    Return:
+        Returns the name with the overview fragment added before the extension, the way the upstream overviews are named
+    """
+    base_name, extension = os.path.splitext(file_name)
+    return base_name + OVERVIEW_NAME_PART + extension
+
+
+def _load_gdal():
+    """Returns the GDAL module, configured to raise exceptions
+    Exceptions:
+        RuntimeError is raised if the GDAL python bindings, with their NumPy array support, aren't installed
+    """
+    try:
+        from osgeo import gdal
+        # Reading bands into arrays fails later without GDAL's NumPy support, so check for it now
+        from osgeo import gdal_array
+    except ImportError as ex:
+        raise RuntimeError("Deriving overviews needs the GDAL python bindings and NumPy to be installed") from ex
+    gdal.UseExceptions()
+    return gdal
+
+
+def block_mean(data, factor: int, nodata: float = None):
+    """Reduces a 2D array by averaging each square block of values
+    Arguments:
+        data: the NumPy array to reduce
+        factor: the number of values along each side of a block
+        nodata: optional value marking missing data, which is left out of the averages
+    Return:
+        Returns the reduced array with the same data type; blocks at the right and bottom edges may be partial,
+        and blocks without any data are set to the nodata value (or zero)
+    """
+    import numpy
+
+    rows, cols = data.shape
+    out_rows = -(-rows // factor)
+    out_cols = -(-cols // factor)
+
+    valid = numpy.ones(data.shape, dtype=bool)
+    if nodata is not None:
+        valid &= data != nodata
+    if numpy.issubdtype(data.dtype, numpy.floating):
+        valid &= ~numpy.isnan(data)
+    values = numpy.where(valid, data, 0).astype(numpy.float64)
+
+    # Pad the edges to whole blocks with values that aren't counted
+    padding = ((0, out_rows * factor - rows), (0, out_cols * factor - cols))
+    sums = numpy.pad(values, padding).reshape(out_rows, factor, out_cols, factor).sum(axis=(1, 3))
+    counts = numpy.pad(valid, padding).reshape(out_rows, factor, out_cols, factor).sum(axis=(1, 3))
+
+    means = numpy.divide(sums, counts, out=numpy.zeros_like(sums), where=counts > 0)
+    if numpy.issubdtype(data.dtype, numpy.integer):
+        type_info = numpy.iinfo(data.dtype)
+        means = numpy.clip(numpy.rint(means), type_info.min, type_info.max)
+    if nodata is not None:
+        means[counts == 0] = nodata
+    return means.astype(data.dtype)
+
+
+def make_overview(source_path: str, dest_path: str, factor: int = OVERVIEW_FACTOR,
+                  strip_bytes: int = OVERVIEW_STRIP_BYTES) -> float:
+    """Writes a reduced scale overview of a GeoTIFF mosaic
+    Arguments:
+        source_path: the path of the mosaic
+        dest_path: the path of the overview to write
+        factor: the number of source pixels along each side of an overview pixel
+        strip_bytes: the number of bytes of source pixels to read at a time
+    Return:
+        Returns the number of seconds taken
+    Exceptions:
+        RuntimeError is raised if the mosaic can't be read or the overview can't be written
+    Notes:
+        The mosaic is read in strips of whole block rows, all bands at once, so that memory use doesn't depend on
+        the size of the mosaic. The geotransform, projection, ground control points, metadata and nodata values are
+        carried over, scaled to the overview's pixels. The overview is written to a temporary file that's renamed
+        once it's complete
+    """
+    gdal = _load_gdal()
+    start = time.monotonic()
+
+    source = gdal.Open(source_path, gdal.GA_ReadOnly)
+    width, height, num_bands = source.RasterXSize, source.RasterYSize, source.RasterCount
+    if not num_bands:
+        raise RuntimeError("Mosaic has no bands to derive an overview from: %s" % source_path)
+    source_bands = [source.GetRasterBand(idx + 1) for idx in range(num_bands)]
+    nodata_values = [one_band.GetNoDataValue() for one_band in source_bands]
+
+    # Each strip holds the bands as read, plus the working copies made while averaging one band
+    pixel_bytes = num_bands * gdal.GetDataTypeSize(source_bands[0].DataType) // 8 + 8 + 1
+    strip_rows = max(factor, (strip_bytes // max(1, width * pixel_bytes)) // factor * factor)
+
+    partial_path = dest_path + '.partial'
+    driver = gdal.GetDriverByName('GTiff')
+    dest = driver.Create(partial_path, -(-width // factor), -(-height // factor), num_bands, source_bands[0].DataType,
+                         options=list(OVERVIEW_CREATE_OPTIONS))
+    try:
+        geo_transform = source.GetGeoTransform(can_return_null=True)
+        if geo_transform:
+            dest.SetGeoTransform((geo_transform[0], geo_transform[1] * factor, geo_transform[2] * factor,
+                                  geo_transform[3], geo_transform[4] * factor, geo_transform[5] * factor))
+        if source.GetProjection():
+            dest.SetProjection(source.GetProjection())
+        if source.GetGCPCount():
+            dest.SetGCPs([gdal.GCP(one_gcp.GCPX, one_gcp.GCPY, one_gcp.GCPZ, one_gcp.GCPPixel / factor,
+                                   one_gcp.GCPLine / factor, one_gcp.Info, one_gcp.Id) for one_gcp in source.GetGCPs()],
+                         source.GetGCPProjection())
+        dest.SetMetadata(source.GetMetadata())
+        for one_source_band, one_nodata, idx in zip(source_bands, nodata_values, range(num_bands)):
+            dest_band = dest.GetRasterBand(idx + 1)
+            dest_band.SetColorInterpretation(one_source_band.GetColorInterpretation())
+            if one_nodata is not None:
+                dest_band.SetNoDataValue(one_nodata)
+
+        for row in range(0, height, strip_rows):
+            num_rows = min(strip_rows, height - row)
+            strip = source.ReadAsArray(0, row, width, num_rows)
+            if num_bands == 1:
+                strip = strip.reshape((1,) + strip.shape)
+            for idx in range(num_bands):
+                dest.GetRasterBand(idx + 1).WriteArray(block_mean(strip[idx], factor, nodata_values[idx]), 0,
+                                                       row // factor)
+            logging.debug("Derived %s of %s rows of the overview of %s", str(row + num_rows), str(height), source_path)
+
+        dest.FlushCache()
+        dest = None
+        source = None
+        os.replace(partial_path, dest_path)
+    except Exception:
+        dest = None
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    return time.monotonic() - start
+
+
+def make_overviews(jobs: dict, max_workers: int = OVERVIEW_WORKERS, factor: int = OVERVIEW_FACTOR) -> tuple:
+    """Derives the overviews of many mosaics in parallel processes
+    Arguments:
+        jobs: dictionary of mosaic paths to the paths of their overviews
+        max_workers: the number of overviews derived at the same time
+        factor: the number of source pixels along each side of an overview pixel
+    Return:
+        Returns a tuple of a dictionary of the mosaics whose overviews were written to the seconds each took,
+        and a dictionary of the mosaics that failed to their error messages
+    Exceptions:
+        RuntimeError is raised if the GDAL python bindings or NumPy aren't installed
+    """
+    succeeded = {}
+    failed = {}
+    if not jobs:
+        return succeeded, failed
+    _load_gdal()
+
+    # New processes are started instead of forked so that they don't inherit the caller's threads and open files
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, max_workers), mp_context=context) as executor:
+        futures = {executor.submit(make_overview, source_path, dest_path, factor): source_path
+                   for source_path, dest_path in jobs.items()}
+        for one_future in concurrent.futures.as_completed(futures):
+            source_path = futures[one_future]
+            try:
+                succeeded[source_path] = one_future.result()
+                logging.info("Derived overview of %s in %.1f seconds", source_path, succeeded[source_path])
+            except Exception as ex:
+                logging.warning("Unable to derive the overview of %s: %s", source_path, str(ex))
+                failed[source_path] = str(ex)
+
+    return succeeded, failed
+
+
+class OverviewWorkers:
+    """Derives overviews in parallel processes as the mosaics arrive, reporting each one when it's done"""
+
+    def __init__(self, max_workers: int = OVERVIEW_WORKERS, factor: int = OVERVIEW_FACTOR):
+        """Checks GDAL can be used and starts the worker processes
+        Arguments:
+            max_workers: the number of overviews derived at the same time
+            factor: the number of source pixels along each side of an overview pixel
+        Exceptions:
+            RuntimeError is raised if the GDAL python bindings or NumPy aren't installed
+        """
+        _load_gdal()
+        self._factor = factor
+        # New processes are started instead of forked so that they don't inherit the caller's threads and open files
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, max_workers),
+                                                                mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, source_path: str, dest_path: str, on_done: Callable[[str, Optional[float]], None]) -> None:
+        """Queues the derivation of an overview
+        Arguments:
+            source_path: the path of the mosaic
+            dest_path: the path of the overview to write
+            on_done: called with the mosaic's path and the seconds taken, or None if the overview couldn't be
+                     derived; it's called on another thread
+        """
+        def derived(future: concurrent.futures.Future) -> None:
+            """Reports the outcome of a derivation"""
+            try:
+                seconds = future.result()
+                logging.info("Derived overview of %s in %.1f seconds", source_path, seconds)
+            except Exception as ex:
+                logging.warning("Unable to derive the overview of %s: %s", source_path, str(ex))
+                seconds = None
+            on_done(source_path, seconds)
+
+        self._executor.submit(make_overview, source_path, dest_path, self._factor).add_done_callback(derived)
+
+    def close(self) -> None:
+        """Waits for the queued overviews to be derived and stops the worker processes"""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,824 @@
+""" Engine shared by the scripts that finds files on a Globus endpoint, transfers them, and hands them to a sink """
+
+import argparse
+import collections
+import logging
+import os
+import stat
+import subprocess
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Iterable, Optional
+
+import concurrency_control
+import globus_batch
+import globus_credentials
+import globus_listing
+import listing_cache
+import run_metrics
+import shard_manifest
+import staging_pipeline
+import task_monitor
+import transfer_journal
+import transfer_sinks
+
+if TYPE_CHECKING:
+    # globus_sdk is imported once a run starts, so that --help and argument errors don't wait for it
+    import globus_sdk
+
+# The ID of the scripts registered with Globus
+GLOBUS_CLIENT_ID = '80e3a80b-0e81-43b0-84df-125ce5ad6088'
+# The Globus error codes and HTTP statuses that mean an endpoint ID may be out of date
+STALE_ENDPOINT_CODES = ('EndpointNotFound',)
+STALE_ENDPOINT_HTTP_STATUSES = (401,)
+
+
+def get_authorizer(credentials: globus_credentials.CredentialsCache = None,
+                   client_id: str = GLOBUS_CLIENT_ID) -> 'globus_sdk.RefreshTokenAuthorizer':
+    """Returns Globus authorization information (requires user interaction when there are no saved credentials)
+    Arguments:
+        credentials: optional saved credentials to use and update
+        client_id: the ID of the client registered with Globus
+    Return:
+        The authorizer instance
+    """
+    import globus_sdk
+
+    auth_client = globus_sdk.NativeAppAuthClient(client_id)
+    if credentials:
+        authorizer = globus_credentials.cached_authorizer(credentials, auth_client, client_id)
+        if authorizer:
+            return authorizer
+
+    auth_client.oauth2_start_flow(refresh_tokens=True)
+
+    authorize_url = auth_client.oauth2_get_authorize_url()
+    print("Authorization URL: %s" % authorize_url)
+    print("Go to the following URL to obtain the authorization code:", authorize_url)
+
+    get_input = getattr(__builtins__, 'raw_input', input)
+    auth_code = get_input('Enter the authorization code: ').strip()
+
+    token_response = auth_client.oauth2_exchange_code_for_tokens(auth_code)
+    transfer_info = token_response.by_resource_server['transfer.api.globus.org']
+    if credentials:
+        credentials.set_tokens(client_id, transfer_info)
+
+    return globus_sdk.RefreshTokenAuthorizer(transfer_info['refresh_token'], auth_client,
+                                             access_token=transfer_info['access_token'],
+                                             expires_at=transfer_info['expires_at_seconds'],
+                                             on_refresh=credentials.on_refresh if credentials else None)
+
+
+def create_client(authorizer: 'globus_sdk.RefreshTokenAuthorizer') -> 'globus_sdk.TransferClient':
+    """Returns a Globus transfer client
+    Arguments:
+        authorizer: the Globus authorization instance
+    """
+    import globus_sdk
+
+    return globus_sdk.TransferClient(authorizer=authorizer)
+
+
+def find_endpoint(client: 'globus_sdk.TransferClient', remote_endpoint: str,
+                  credentials: globus_credentials.CredentialsCache = None, use_saved: bool = True) -> str:
+    """Returns the ID of a remote endpoint
+    Arguments:
+        client: the Globus transfer client to use
+        remote_endpoint: the display or canonical name of the endpoint
+        credentials: optional saved credentials holding the IDs of the endpoints found by earlier runs
+        use_saved: set to False to ignore any saved endpoint ID and search for the endpoint
+    Return:
+        Returns the ID of the endpoint
+    Exceptions:
+        RuntimeError is raised if the endpoint can't be found
+    """
+    if use_saved and credentials:
+        endpoint_id = credentials.get_endpoint_id(remote_endpoint)
+        if endpoint_id:
+            return endpoint_id
+
+    endpoint_id = None
+    for endpoint in client.endpoint_search(filter_scope='shared-with-me'):
+        if 'display_name' in endpoint and endpoint['display_name'] == remote_endpoint:
+            endpoint_id = endpoint['id']
+            break
+        if 'canonical_name' in endpoint and endpoint['canonical_name'] == remote_endpoint:
+            endpoint_id = endpoint['id']
+            break
+    if not endpoint_id:
+        raise RuntimeError("Unable to find remote endpoint: %s" % remote_endpoint)
+
+    if credentials:
+        credentials.set_endpoint_id(remote_endpoint, endpoint_id)
+    return endpoint_id
+
+
+def is_stale_endpoint(ex: Exception) -> bool:
+    """Returns whether a Globus error may be caused by using an endpoint ID that's out of date
+    Arguments:
+        ex: the exception to check
+    Return:
+        Returns True if the endpoint wasn't found or the request wasn't authorized
+    """
+    return getattr(ex, 'code', None) in STALE_ENDPOINT_CODES or \
+        getattr(ex, 'http_status', None) in STALE_ENDPOINT_HTTP_STATUSES
+
+
+def find_local_endpoint(credentials: globus_credentials.CredentialsCache = None) -> str:
+    """Returns the ID of the local Globus endpoint
+    Arguments:
+        credentials: optional saved credentials holding the ID found by an earlier run
+    Return:
+        Returns the ID of the local endpoint
+    Exceptions:
+        RuntimeError is raised if the ID can't be found
+    """
+    endpoint_id = credentials.get_endpoint_id(globus_credentials.LOCAL_ENDPOINT_NAME) if credentials else None
+    if not endpoint_id:
+        resp = subprocess.run(['globus', 'endpoint', 'local-id'], stdout=subprocess.PIPE)
+        if resp.returncode != 0:
+            raise RuntimeError("Unable to get Local Endpoint ID for Globus. Please use --local_endpoint_id and try again")
+        endpoint_id = resp.stdout.decode('ascii').rstrip('\n')
+        if credentials:
+            credentials.set_endpoint_id(globus_credentials.LOCAL_ENDPOINT_NAME, endpoint_id)
+    return endpoint_id
+
+
+class TransferEngine:
+    """Finds the wanted files in the sub folders of a remote path, transfers them in batches that are kept in
+    flight at the same time, and hands each file to a sink as soon as its transfer finishes
+    Notes:
+        The wanted file of each folder is chosen by the caller's select function, which is called with the
+        folder's name, its remote path and its listing entries, and returns a (remote path, entry) tuple or None.
+        A third value of False in the tuple downloads the file without writing it to the list of wanted files.
+        When the sink removes the files it's finished with, the bytes of the files waiting for the sink on the
+        local disk are limited by the staging budget
+    """
+
+    def __init__(self, sink: transfer_sinks.Sink, save_path: str, local_endpoint_id: str = None,
+                 metrics: run_metrics.RunMetrics = None, credentials: globus_credentials.CredentialsCache = None,
+                 listing_workers: int = globus_listing.LISTING_MAX_WORKERS, listing_depth: int = 1,
+                 cache: listing_cache.ListingCache = None, batch_files: int = globus_batch.BATCH_MAX_FILES,
+                 batch_bytes: int = globus_batch.BATCH_MAX_BYTES, max_active: int = task_monitor.MONITOR_MAX_ACTIVE,
+                 order: str = staging_pipeline.ORDER_LISTED, staging_budget: int = 0,
+                 journal: transfer_journal.TransferJournal = None, manifest: shard_manifest.ShardManifest = None,
+                 claim_files: int = 0, retries: int = concurrency_control.RETRY_ATTEMPTS,
+                 listing_control: concurrency_control.AimdController = None,
+                 transfer_control: concurrency_control.AimdController = None):
+        """Initializes the engine
+        Arguments:
+            sink: the sink to hand the transferred files to
+            save_path: the local folder the files are transferred into
+            local_endpoint_id: the ID of the local Globus endpoint; it's found when first needed if not given
+            metrics: optional run metrics to record the timings of the stages in
+            credentials: optional saved credentials and endpoint IDs
+            listing_workers: the maximum number of remote folders listed at the same time
+            listing_depth: the number of folder levels to search below the remote path
+            cache: optional cache of folder listings to read through
+            batch_files: the maximum number of files in one transfer task (0 for no limit)
+            batch_bytes: the maximum number of bytes in one transfer task (0 for no limit)
+            max_active: the maximum number of transfer tasks that are active at the same time
+            order: one of the staging_pipeline.TRANSFER_ORDERS values
+            staging_budget: the maximum number of bytes of files waiting for the sink (0 for most of the free space)
+            journal: optional journal recording the progress of each file so that a run can be resumed
+            manifest: optional shared manifest for splitting the files between several nodes
+            claim_files: the number of files to claim from the manifest at a time (0 for enough to fill the tasks)
+            retries: the number of times a failed transfer of a file is tried again
+            listing_control: optional controller adjusting the number of folders listed at the same time
+            transfer_control: optional controller adjusting the number of active transfer tasks
+        """
+        self.sink = sink
+        self.save_path = save_path
+        self._local_endpoint_id = local_endpoint_id
+        self._local_endpoint_given = bool(local_endpoint_id)
+        self.metrics = metrics or run_metrics.RunMetrics()
+        self.credentials = credentials
+        self.listing_workers = listing_workers
+        self.listing_depth = listing_depth
+        self.cache = cache
+        self.batch_files = batch_files
+        self.batch_bytes = batch_bytes
+        self.max_active = max_active
+        self.order = order
+        self.staging_budget = staging_budget
+        self.journal = journal
+        self.manifest = manifest
+        self.claim_files = claim_files
+        self.retries = retries
+        self.listing_control = listing_control
+        self.transfer_control = transfer_control
+        # The local save paths of the files transferred by this run, and their remote paths
+        self.transferred = {}
+        # The name of the remote endpoint being accessed, and whether its ID has been looked up again
+        self.remote_endpoint = None
+        self._endpoints_refreshed = False
+
+    @property
+    def local_endpoint_id(self) -> str:
+        """Returns the ID of the local Globus endpoint, finding it the first time it's needed
+        Exceptions:
+            RuntimeError is raised if the ID can't be found
+        """
+        if not self._local_endpoint_id:
+            self._local_endpoint_id = find_local_endpoint(self.credentials)
+        return self._local_endpoint_id
+
+    def refresh_endpoints(self, client: 'globus_sdk.TransferClient') -> Optional[str]:
+        """Forgets the saved endpoint IDs, which may be out of date, and looks up the remote endpoint again
+        Arguments:
+            client: the Globus transfer client to use
+        Return:
+            Returns the ID of the remote endpoint, or None if the IDs were already looked up again during this run
+        Exceptions:
+            RuntimeError is raised if the remote endpoint can't be found
+        Notes:
+            The local endpoint ID is found again the next time it's needed, unless it was given by the caller
+        """
+        if self._endpoints_refreshed or not self.remote_endpoint:
+            return None
+        self._endpoints_refreshed = True
+        self.metrics.count('endpoint_retries')
+        logging.info("Looking up the IDs of the endpoints again")
+        if not self._local_endpoint_given:
+            self._local_endpoint_id = None
+            if self.credentials:
+                self.credentials.set_endpoint_id(globus_credentials.LOCAL_ENDPOINT_NAME, None)
+        return find_endpoint(client, self.remote_endpoint, self.credentials, use_saved=False)
+
+    def get_folders(self, client: 'globus_sdk.TransferClient', endpoint_id: str, remote_path: str) -> Optional[tuple]:
+        """Returns a list of the sub folders of the remote path
+        Arguments:
+            client: the Globus transfer client to use
+            endpoint_id: the ID of the endpoint to access
+            remote_path: the remote path to search
+        Return:
+            Returns a list of found sub folders, searching listing_depth levels deep, or None if the remote path
+            couldn't be listed
+        """
+        base_path = os.path.join('/-', remote_path)
+        start = time.monotonic()
+        folders = globus_listing.find_sub_folders(client, endpoint_id, base_path, self.listing_depth,
+                                                  self.listing_workers, self.cache, self.listing_control)
+        self.metrics.observe('list_folders', time.monotonic() - start, len(folders) if folders else 0)
+        return folders
+
+    def query_files(self, client: 'globus_sdk.TransferClient', endpoint_id: str, folders: tuple,
+                    select: Callable[[str, str, list], Optional[tuple]], list_name: str, file_sizes: dict = None):
+        """Finds the wanted file in each of the folders
+        Arguments:
+            client: the Globus transfer client to use
+            endpoint_id: the ID of the endpoint to access
+            folders: a list of folders to search within (search is 1 deep, folders are listed concurrently)
+            select: returns the wanted (remote path, entry[, listed]) tuple of a folder, or None
+            list_name: the name of the file in the save folder to write the list of wanted files to
+            file_sizes: optional dictionary that's filled in with the sizes of the wanted files
+        Return:
+            Yields the wanted files
+        Notes:
+            Each wanted file is written to the file list as soon as it's found
+        """
+        found_count = 0
+        folder_paths = (os.path.join('/-', one_folder) for one_folder in folders or ())
+        folder_contents = globus_listing.iter_folders(client, endpoint_id, folder_paths, self.listing_workers,
+                                                      self.cache, self.listing_control)
+        with open(os.path.join(self.save_path, list_name), 'w') as out_file:
+            # The time a folder takes includes waiting for its listing, but not the time taken by the consumer
+            folder_start = time.monotonic()
+            for one_folder, (cur_path, path_contents) in zip(folders or (), folder_contents):
+                logging.debug("Globus files path: %s", cur_path)
+                if path_contents is None:
+                    self.metrics.count('listing_failed_folders')
+                    folder_start = time.monotonic()
+                    continue
+
+                found_path = select(one_folder, cur_path, path_contents)
+                self.metrics.observe('query', time.monotonic() - folder_start, 1 if found_path else 0)
+                if found_path:
+                    file_path, one_entry = found_path[:2]
+                    if file_sizes is not None:
+                        file_sizes[file_path] = one_entry['size']
+                    if len(found_path) < 3 or found_path[2]:
+                        found_count += 1
+                        out_file.write(file_path + '\n')
+                        out_file.flush()
+                    yield file_path
+                folder_start = time.monotonic()
+
+        print("Done searching for files to download: found", found_count, "files")
+
+    def _select_transfers(self, client: 'globus_sdk.TransferClient', endpoint_id: str, files, file_sizes: dict) -> tuple:
+        """Sorts out which of the files need transferring and which are already on hand
+        Arguments:
+            client: the Globus transfer client to use
+            endpoint_id: the ID of the endpoint to access
+            files: the list of files to fetch; this can be any iterable, which is only read once
+            file_sizes: dictionary of remote file paths to their sizes, which is filled in with any missing sizes
+        Return:
+            Returns a tuple of two dictionaries of remote file paths to their local save paths: the files to transfer,
+            and the files downloaded by an earlier run that only need handing to the sink
+        """
+        file_transfers = {}
+        staged_transfers = {}
+        for one_file in files:
+            save_path = os.path.join(self.save_path, os.path.basename(one_file))
+            if self.journal and self.journal.reached(one_file, transfer_journal.STATE_VERIFIED):
+                logging.debug("Skipping file that's already stored: %s", one_file)
+                self.metrics.count('skipped_verified')
+                if self.manifest:
+                    self.manifest.complete(one_file)
+                continue
+            if os.path.exists(save_path) and self.journal and \
+                    self.journal.reached(one_file, transfer_journal.STATE_TRANSFERRED):
+                if self.sink.keeps_files:
+                    # Kept by an earlier run
+                    if self.manifest:
+                        self.manifest.complete(one_file)
+                else:
+                    # Downloaded by an earlier run that stopped before the sink was finished with it
+                    staged_transfers[one_file] = save_path
+            elif os.path.exists(save_path) and self.sink.keeps_files and not self.journal:
+                # Kept by an earlier run, which can only be told by the file being there
+                if self.manifest:
+                    self.manifest.complete(one_file)
+            else:
+                if os.path.exists(save_path):
+                    # Left by a run that stopped during its transfer; Globus repairs it by comparing checksums
+                    logging.info("Transferring again the file that may be incomplete: %s", save_path)
+                    self.metrics.count('resumed_partial_files')
+                file_transfers[one_file] = save_path
+
+        # Files from a file list or a manifest may not have sizes, which are looked up when the staging budget or
+        # the order needs them; otherwise the endpoint isn't listed at all
+        unsized_files = ()
+        if not self.sink.keeps_files or self.order != staging_pipeline.ORDER_LISTED:
+            unsized_files = [one_file for one_file in file_transfers if one_file not in file_sizes]
+        if unsized_files:
+            with self.metrics.timed('size_lookup', len(unsized_files)):
+                file_sizes.update(globus_listing.find_file_sizes(client, endpoint_id, unsized_files, self.listing_workers,
+                                                                 self.cache, self.listing_control))
+            sized_count = sum(1 for one_file in unsized_files if one_file in file_sizes)
+            logging.debug("Found the sizes of %s of %s files without one", str(sized_count), str(len(unsized_files)))
+
+        # Drop any files the sink already has before anything is transferred
+        for remote_path in self.sink.existing(file_transfers, file_sizes):
+            logging.debug("Skipping file that's already stored: %s", remote_path)
+            del file_transfers[remote_path]
+            if self.manifest:
+                self.manifest.complete(remote_path)
+
+        return file_transfers, staged_transfers
+
+    def _download(self, client: 'globus_sdk.TransferClient', endpoint_id: str, next_files: Callable[[], Optional[Iterable]],
+                  file_sizes: dict = None) -> bool:
+        """Transfers files and hands them to the sink, asking for more files once all the earlier ones are submitted
+        Arguments:
+            client: the Globus transfer client to use
+            endpoint_id: the ID of the endpoint to access
+            next_files: returns the next files to fetch, which can be any iterable, or None when there are no more files
+            file_sizes: optional dictionary of remote file paths to their sizes, which may be filled in while the
+                        files are read and is filled in with any missing sizes
+        Return:
+            Returns False if any of the files couldn't be transferred or stored by the sink
+        Exceptions:
+            RuntimeError is raised if the local endpoint or the sink's destination can't be found
+        Notes:
+            The sink, the staging budget and the task monitor are shared by all the files, so that the sink's
+            workers and sessions are only started once. More files are asked for again once everything has
+            finished, in case files that failed were returned to be tried again. A task rejected because an endpoint
+            ID may be out of date is submitted once more after the IDs are looked up again
+        """
+        import globus_sdk
+
+        have_exception = False
+        sink_open = False
+        cnt = 1
+        num_batches = 0
+        file_sizes = {} if file_sizes is None else file_sizes
+        file_transfers = {}
+        save_remote_paths = {}
+        # Staging space is reserved before each transfer and released once the sink is finished with the file
+        staged_sizes = {}
+        budget = None
+        # The number of files handed to the sink that it hasn't reported on yet
+        sink_files = 0
+        sink_condition = threading.Condition()
+        max_batch_bytes = self.batch_bytes
+        if not self.sink.keeps_files:
+            budget = staging_pipeline.StagingBudget(self.staging_budget or staging_pipeline.default_budget(self.save_path))
+            logging.debug("Staging up to %s bytes at a time", str(budget.budget_bytes))
+            max_batch_bytes = min(self.batch_bytes, budget.budget_bytes) if self.batch_bytes else budget.budget_bytes
+
+        def file_done(save_path: str, succeeded: bool) -> None:
+            """Records the outcome of a file the sink is finished with"""
+            nonlocal have_exception, sink_files
+            remote_path = save_remote_paths[save_path]
+            with sink_condition:
+                sink_files -= 1
+                sink_condition.notify_all()
+            if budget:
+                budget.release(staged_sizes[save_path])
+            if not succeeded:
+                have_exception = True
+                if self.manifest:
+                    self.manifest.fail(remote_path)
+                return
+            if self.journal and self.sink.stores_files:
+                self.journal.record(remote_path, transfer_journal.STATE_UPLOADED)
+                # The sink has verified the stored file
+                self.journal.record(remote_path, transfer_journal.STATE_VERIFIED)
+            if self.manifest:
+                self.manifest.complete(remote_path)
+
+        def put_file(save_path: str) -> None:
+            """Hands a file to the sink, counting it until the sink reports on it"""
+            nonlocal sink_files
+            with sink_condition:
+                sink_files += 1
+            try:
+                self.sink.put(save_path)
+            except Exception:
+                with sink_condition:
+                    sink_files -= 1
+                raise
+
+        pending_batches = collections.deque()
+        # Files that fail to transfer are tried again in later tasks, each after its own backoff
+        retry_schedule = concurrency_control.RetrySchedule(self.retries)
+
+        def add_next_files() -> bool:
+            """Plans the transfers of the next files, returning False if there aren't any more"""
+            nonlocal sink_open, num_batches
+            files = next_files()
+            if files is None:
+                return False
+            new_transfers, new_staged = self._select_transfers(client, endpoint_id, files, file_sizes)
+            if not new_transfers and not new_staged:
+                return True
+
+            if self.journal:
+                self.journal.add(new_transfers, file_sizes)
+            file_transfers.update(new_transfers)
+            for remote_path, save_path in new_transfers.items():
+                save_remote_paths[save_path] = remote_path
+                staged_sizes[save_path] = file_sizes.get(remote_path, 0)
+            for remote_path, save_path in new_staged.items():
+                save_remote_paths[save_path] = remote_path
+                staged_sizes[save_path] = os.path.getsize(save_path)
+
+            if not sink_open:
+                self.sink.open(file_done)
+                sink_open = True
+            for save_path in new_staged.values():
+                if budget:
+                    budget.acquire(staged_sizes[save_path])
+                put_file(save_path)
+
+            ordered_files = staging_pipeline.order_transfers(tuple(new_transfers.keys()), file_sizes, self.order)
+            new_batches = globus_batch.plan_batches(ordered_files, file_sizes, self.batch_files, max_batch_bytes)
+            pending_batches.extend(new_batches)
+            num_batches += len(new_batches)
+            return True
+
+        def transfer_done(task_id: str, status: str, context: tuple) -> bool:
+            """Hands the files of a finished transfer task to the sink and schedules the ones that failed to be
+            tried again, returning whether all the files were transferred"""
+            nonlocal have_exception
+            batch_transfers, submitted = context
+            if status != 'SUCCEEDED':
+                logging.warning("Transfer task %s finished with status %s", task_id, status)
+            try:
+                succeeded, failed = concurrency_control.call_with_retries(
+                    lambda: globus_batch.task_results(client, task_id, batch_transfers, status),
+                    "results of transfer task %s" % task_id, self.retries, (globus_sdk.exc.GlobusError,),
+                    metrics=self.metrics)
+            except globus_sdk.exc.GlobusError as ex:
+                # Only when the results stay out of reach is the whole batch tried again
+                logging.warning("Unable to get the results of transfer task %s: %s", task_id, str(ex))
+                succeeded, failed = (), tuple(batch_transfers.keys())
+            self.metrics.observe('transfer', time.monotonic() - submitted, len(succeeded),
+                                 sum(staged_sizes[batch_transfers[remote_path]] for remote_path in succeeded))
+            self.metrics.count('transfer_failed_files', len(failed))
+            for remote_path in failed:
+                if budget:
+                    budget.release(staged_sizes[batch_transfers[remote_path]])
+                if retry_schedule.schedule(remote_path):
+                    logging.info("Will try to get image again: %s", remote_path)
+                    self.metrics.count('transfer_retries')
+                    continue
+                have_exception = True
+                logging.warning("Failed to get image: %s", remote_path)
+                if self.manifest:
+                    self.manifest.fail(remote_path)
+
+            for remote_path in succeeded:
+                self.transferred[batch_transfers[remote_path]] = remote_path
+                if self.journal:
+                    self.journal.record(remote_path, transfer_journal.STATE_TRANSFERRED)
+                try:
+                    put_file(batch_transfers[remote_path])
+                except Exception as ex:
+                    logging.warning("Unable to hand %s to the %s sink: %s", batch_transfers[remote_path], self.sink.name,
+                                    str(ex))
+                    have_exception = True
+                    if budget:
+                        budget.release(staged_sizes[batch_transfers[remote_path]])
+                    if self.manifest:
+                        self.manifest.fail(remote_path)
+            return not failed
+
+        # Several transfer tasks are kept in flight and each file goes to the sink as soon as its task finishes
+        monitor = task_monitor.TaskMonitor(client, transfer_done, self.max_active, controller=self.transfer_control,
+                                           submit_retries=self.retries)
+        more_files = True
+        try:
+            while True:
+                if not pending_batches:
+                    retry_files = retry_schedule.pop_due()
+                    if retry_files:
+                        retry_batches = globus_batch.plan_batches(retry_files, file_sizes, self.batch_files,
+                                                                  max_batch_bytes)
+                        pending_batches.extend(retry_batches)
+                        num_batches += len(retry_batches)
+                        continue
+                    if more_files:
+                        more_files = add_next_files()
+                        continue
+                    # Wait for the running tasks, which may fail files that need retrying, or for the next retry
+                    wait_seconds = retry_schedule.seconds_until_due()
+                    if monitor.active_count:
+                        monitor.wait_for_completion(wait_seconds)
+                    elif wait_seconds is not None:
+                        time.sleep(wait_seconds)
+                    elif sink_files:
+                        # The sink may still fail files, which can be returned to be tried again
+                        with sink_condition:
+                            sink_condition.wait_for(lambda: sink_files == 0, timeout=task_monitor.MONITOR_MAX_INTERVAL)
+                    else:
+                        more_files = add_next_files()
+                        if not more_files:
+                            break
+                    continue
+
+                one_batch = pending_batches.popleft()
+                batch_transfers = {one_file: file_transfers[one_file] for one_file in one_batch}
+                batch_bytes = sum(staged_sizes[save_path] for save_path in batch_transfers.values())
+                if budget:
+                    with self.metrics.timed('staging_budget_wait', len(one_batch), batch_bytes):
+                        budget.acquire(batch_bytes)
+                    self.metrics.gauge('staged_bytes', budget.staged_bytes)
+                logging.info("Trying transfer %s of %s: %s files", str(cnt), str(num_batches), str(len(one_batch)))
+                cnt += 1
+                transfer_setup = globus_batch.build_transfer(client, endpoint_id, self.local_endpoint_id, batch_transfers)
+                with self.metrics.timed('task_slot_wait', len(one_batch), batch_bytes):
+                    monitor.wait_for_slot()
+                self.metrics.gauge('active_tasks', monitor.active_count)
+                try:
+                    monitor.submit(transfer_setup, (batch_transfers, time.monotonic()), batch_bytes,
+                                   globus_batch.BATCH_TIMEOUT_PER_FILE * len(batch_transfers))
+                except globus_sdk.exc.GlobusError as ex:
+                    refreshed_id = self.refresh_endpoints(client) if is_stale_endpoint(ex) else None
+                    if not refreshed_id:
+                        raise
+                    # A saved endpoint ID may be out of date, so the batch is submitted again with the IDs found now
+                    logging.warning("Submitting transfer again after looking up the endpoints: %s", str(ex))
+                    endpoint_id = refreshed_id
+                    transfer_setup = globus_batch.build_transfer(client, endpoint_id, self.local_endpoint_id,
+                                                                 batch_transfers)
+                    monitor.submit(transfer_setup, (batch_transfers, time.monotonic()), batch_bytes,
+                                   globus_batch.BATCH_TIMEOUT_PER_FILE * len(batch_transfers))
+        finally:
+            monitor.close()
+            if sink_open:
+                self.sink.close()
+        return not have_exception
+
+    def download_files(self, client: 'globus_sdk.TransferClient', endpoint_id: str, files, file_sizes: dict = None) -> None:
+        """Transfers the files and hands them to the sink
+        Arguments:
+            client: the Globus transfer client to use
+            endpoint_id: the ID of the endpoint to access
+            files: the list of files to fetch; this can be any iterable, which is only read once
+            file_sizes: optional dictionary of remote file paths to their sizes; missing sizes are looked up
+        Exceptions:
+            RuntimeError is raised if any of the files couldn't be transferred or stored by the sink
+        """
+        pending_files = [files]
+        if not self._download(client, endpoint_id, lambda: pending_files.pop() if pending_files else None, file_sizes):
+            raise RuntimeError("Unable to retrieve all files individually")
+
+    def download_shard(self, client: 'globus_sdk.TransferClient', endpoint_id: str, files, file_sizes: dict = None) -> None:
+        """Adds the files to the shared manifest and downloads the files this worker claims until none are left
+        Arguments:
+            client: the Globus transfer client to use
+            endpoint_id: the ID of the endpoint to access
+            files: the list of files to add to the manifest; this can be any iterable, which is only read once
+            file_sizes: optional dictionary of remote file paths to their sizes
+        Exceptions:
+            RuntimeError is raised if any of the files in the manifest failed on every attempt, or if the local
+            endpoint or the sink's destination can't be found
+        Notes:
+            Each claim is a few batches' worth of files so that the work stays spread across the workers, and the
+            next claim is made as soon as the files of the last one are submitted. Files that fail are returned to
+            the manifest to be tried again by any worker
+        """
+        added = self.manifest.add(files, file_sizes)
+        logging.info("Added %s files to the shared manifest", str(added))
+
+        claim_files = self.claim_files or max(1, self.batch_files) * self.max_active
+        claimed_sizes = {}
+
+        def next_claim() -> Optional[tuple]:
+            """Claims the next files from the manifest"""
+            claimed = self.manifest.claim(claim_files)
+            if not claimed:
+                return None
+            logging.info("Worker %s claimed %s files", self.manifest.worker_id, str(len(claimed)))
+            claimed_sizes.update((remote_path, size) for remote_path, size in claimed.items() if size is not None)
+            return tuple(claimed.keys())
+
+        try:
+            if not self._download(client, endpoint_id, next_claim, claimed_sizes):
+                logging.warning("Continuing after failing to retrieve some of the claimed files")
+        finally:
+            # Files that weren't finished, such as when the run stopped early, go back to the manifest to be tried again
+            self.manifest.fail_claimed()
+
+        failed_files = self.manifest.progress()['states'][shard_manifest.SHARD_FAILED]['files']
+        if failed_files:
+            raise RuntimeError("Unable to retrieve %s files after %s attempts each" %
+                               (str(failed_files), str(self.manifest.max_attempts)))
+
+    def run(self, remote_endpoint: str, remote_path: str, select: Callable[[str, str, list], Optional[tuple]],
+            list_name: str, file_list: str = None, list_only: bool = False,
+            client: 'globus_sdk.TransferClient' = None) -> None:
+        """Fetches the wanted files in the sub folders of the remote path
+        Arguments:
+            remote_endpoint: the remote endpoint to access
+            remote_path: the path of remote folder to start in
+            select: returns the wanted (remote path, entry[, listed]) tuple of a folder, or None
+            list_name: the name of the file in the save folder to write the list of wanted files to
+            file_list: optional path to a file containing the list of files to download instead of searching
+            list_only: set to True to write the list of wanted files without downloading them
+            client: optional Globus transfer client to use instead of authorizing a new one
+        Exceptions:
+            RuntimeError is raised if the endpoint can't be found or any of the files couldn't be fetched
+        """
+        if client is None:
+            client = create_client(get_authorizer(self.credentials))
+
+        # Find the remote ID
+        self.remote_endpoint = remote_endpoint
+        endpoint_id = find_endpoint(client, remote_endpoint, self.credentials)
+
+        file_sizes = {}
+        if file_list:
+            # Use the planned list of files without searching the endpoint
+            files = globus_listing.read_file_list(file_list)
+        elif self.manifest and not self.manifest.is_empty():
+            # Another worker has already found the files
+            files = ()
+        else:
+            # Get all the sub folders for this location
+            folders = self.get_folders(client, endpoint_id, remote_path)
+            if folders is None:
+                # The saved endpoint ID may be out of date
+                refreshed_id = self.refresh_endpoints(client)
+                if refreshed_id:
+                    endpoint_id = refreshed_id
+                    folders = self.get_folders(client, endpoint_id, remote_path)
+
+            # Query for all the files to download
+            files = self.query_files(client, endpoint_id, folders, select, list_name, file_sizes)
+
+        if list_only:
+            logging.info("Found %s files to download", str(sum(1 for _ in files)))
+            return
+
+        # Download the files
+        if self.manifest:
+            self.download_shard(client, endpoint_id, files, file_sizes)
+        else:
+            self.download_files(client, endpoint_id, files, file_sizes)
+
+    def close(self, report_path: str = None, prometheus_path: str = None) -> None:
+        """Releases the shared manifest and reports on the run
+        Arguments:
+            report_path: optional path of the JSON file to write the run report to, instead of one in the save folder
+            prometheus_path: optional path to also write the run report to in the Prometheus textfile format
+        """
+        if self.manifest:
+            self.manifest.close()
+        self.metrics.log_report()
+        self.metrics.write_json(report_path or os.path.join(self.save_path, run_metrics.REPORT_FILE_NAME))
+        if prometheus_path:
+            self.metrics.write_prometheus(prometheus_path)
+
+
+def add_arguments(parser: argparse.ArgumentParser, save_path: str) -> None:
+    """Adds the command line arguments of the engine shared by the scripts
+    Arguments:
+        parser: the parser to add the arguments to
+        save_path: the default folder the files are saved to
+    """
+    parser.add_argument('--list', type=str, help='Filename containing the the list of files to download')
+    parser.add_argument('--list_only', action='store_true',
+                        help='Write the list of files to download without downloading them')
+    parser.add_argument('--save_path', type=str, default=save_path, help='Folder to save the downloaded files in')
+    parser.add_argument('--local_endpoint_id', type=str, default=None,
+                        help='ID of the local Globus endpoint (defaults to the saved ID or the one the globus CLI reports)')
+    parser.add_argument('--credentials', type=str, default=globus_credentials.CREDENTIALS_FILE,
+                        help='Path to the file saving the Globus credentials and endpoint IDs between runs')
+    parser.add_argument('--no_credentials', action='store_true', help='Do not save or use saved Globus credentials')
+    parser.add_argument('--reauthorize', action='store_true',
+                        help='Discard the saved Globus credentials and endpoint IDs and authorize again')
+    parser.add_argument('--list_workers', type=int, default=globus_listing.LISTING_MAX_WORKERS,
+                        help='Maximum number of remote folders to list at the same time')
+    parser.add_argument('--depth', type=int, default=1, help='Number of folder levels to search below the remote path')
+    parser.add_argument('--cache_file', type=str, default=None,
+                        help='Path to the file caching the remote folder listings (defaults to one in the save folder)')
+    parser.add_argument('--cache_ttl', type=int, default=listing_cache.CACHE_TTL_SECONDS,
+                        help='Seconds before cached folder listings are checked for changes')
+    parser.add_argument('--no_cache', action='store_true', help='Do not use the cached remote folder listings')
+    parser.add_argument('--rebuild_cache', action='store_true',
+                        help='Discard the cached remote folder listings and list all folders again')
+    parser.add_argument('--batch_files', type=int, default=globus_batch.BATCH_MAX_FILES,
+                        help='Maximum number of files to transfer in one Globus task (0 for no limit)')
+    parser.add_argument('--batch_bytes', type=int, default=globus_batch.BATCH_MAX_BYTES,
+                        help='Maximum number of bytes to transfer in one Globus task (0 for no limit)')
+    parser.add_argument('--max_active_tasks', type=int, default=task_monitor.MONITOR_MAX_ACTIVE,
+                        help='Maximum number of Globus transfer tasks that are active at the same time')
+    parser.add_argument('--staging_budget', type=int, default=0,
+                        help='Maximum bytes of downloaded files waiting on the local disk (0 for most of the free space)')
+    parser.add_argument('--order', type=str, choices=staging_pipeline.TRANSFER_ORDERS,
+                        default=staging_pipeline.ORDER_LISTED, help='Order to transfer the files in, based upon their sizes')
+    parser.add_argument('--journal', type=str, default=None,
+                        help='Path to the file recording the progress of each file so that a run can be resumed '
+                             '(defaults to one in the save folder)')
+    parser.add_argument('--no_journal', action='store_true', help='Do not record or resume from the progress of files')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Path to a manifest on a shared filesystem for splitting the files between several nodes')
+    parser.add_argument('--worker_id', type=str, default=None,
+                        help='ID of this worker in the shared manifest (defaults to the host name and process ID)')
+    parser.add_argument('--lease', type=int, default=shard_manifest.SHARD_LEASE_SECONDS,
+                        help='Seconds before the files claimed by a worker that stopped responding are reclaimed')
+    parser.add_argument('--claim_files', type=int, default=0,
+                        help='Number of files to claim from the manifest at a time (0 for enough to fill the active tasks)')
+    parser.add_argument('--retries', type=int, default=concurrency_control.RETRY_ATTEMPTS,
+                        help='Number of times a failed transfer or upload of a file is tried again')
+    parser.add_argument('--fixed_concurrency', action='store_true',
+                        help='Always run the maximum numbers of listings, transfer tasks and uploads at the same time')
+    parser.add_argument('--report', type=str, default=None,
+                        help='Path to the JSON file reporting the timing of each stage of the run (defaults to one in '
+                             'the save folder)')
+    parser.add_argument('--prometheus_file', type=str, default=None,
+                        help='Path to also write the run report to in the Prometheus textfile format')
+
+
+def create_engine(args: argparse.Namespace, sink: transfer_sinks.Sink,
+                  metrics: run_metrics.RunMetrics = None) -> TransferEngine:
+    """Creates an engine configured by the command line arguments added by add_arguments()
+    Arguments:
+        args: the parsed command line arguments
+        sink: the sink to hand the transferred files to
+        metrics: optional run metrics to record the timings of the stages in
+    Return:
+        Returns the engine
+    """
+    metrics = metrics or run_metrics.RunMetrics()
+    save_path = os.path.realpath(args.save_path)
+
+    # Make sure our storage endpoint exists
+    if not os.path.exists(save_path):
+        os.makedirs(save_path, exist_ok=True)
+        os.chmod(save_path, stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IWGRP|stat.S_IXGRP|
+                 stat.S_IROTH|stat.S_IWOTH|stat.S_IXOTH)
+
+    credentials = None
+    if not args.no_credentials:
+        credentials = globus_credentials.CredentialsCache(args.credentials)
+        if args.reauthorize:
+            credentials.clear()
+    cache = None
+    if not args.no_cache:
+        cache = listing_cache.ListingCache(args.cache_file or os.path.join(save_path, listing_cache.CACHE_FILE_NAME),
+                                           args.cache_ttl)
+        if args.rebuild_cache:
+            cache.clear()
+    journal = None
+    if not args.no_journal:
+        journal = transfer_journal.TransferJournal(args.journal or os.path.join(save_path, transfer_journal.JOURNAL_FILE_NAME))
+    manifest = shard_manifest.ShardManifest(args.manifest, args.worker_id, args.lease) if args.manifest else None
+
+    listing_control = None
+    transfer_control = None
+    if not args.fixed_concurrency:
+        # The limits start low and rise towards the maximums while the services keep up
+        listing_control = concurrency_control.AimdController('listing', args.list_workers, metrics=metrics)
+        transfer_control = concurrency_control.AimdController('transfer', args.max_active_tasks, metrics=metrics)
+
+    # The local endpoint is only looked up once a transfer needs it, so listing files doesn't need the Globus CLI
+    return TransferEngine(sink, save_path, args.local_endpoint_id, metrics,
+                          credentials, args.list_workers, args.depth, cache, args.batch_files, args.batch_bytes,
+                          args.max_active_tasks, args.order, args.staging_budget, journal, manifest, args.claim_files,
+                          args.retries, listing_control, transfer_control)
@@ -0,0 +1,105 @@
+""" Durable journal of the progress of each file through the transfer steps """
+
+import sqlite3
+import threading
+import time
+
+# Default name of the journal file
+JOURNAL_FILE_NAME = 'transfer_journal.sqlite'
+
+# The states of a file, in the order they are reached
+STATE_LISTED = 'listed'
+STATE_TRANSFERRED = 'transferred'
+# A transferred file that was only fetched to derive another file from, and can be removed once that's done
+STATE_DERIVING = 'deriving'
+STATE_UPLOADED = 'uploaded'
+STATE_VERIFIED = 'verified'
+STATE_ORDER = (STATE_LISTED, STATE_TRANSFERRED, STATE_DERIVING, STATE_UPLOADED, STATE_VERIFIED)
+
+
+class TransferJournal:
+    """SQLite backed record of the state of each remote file so that an interrupted run can be resumed
+    Notes:
+        Every change of state is committed immediately so that the journal survives the process being killed
+    """
+
+    def __init__(self, journal_path: str):
+        """Opens the journal file, creating it if needed
+        Arguments:
+            journal_path: the path to the SQLite journal file
+        """
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(journal_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                remote_path TEXT PRIMARY KEY,
+                local_path TEXT,
+                size INTEGER,
+                state TEXT NOT NULL,
+                updated REAL NOT NULL)
+            """)
+        self._conn.commit()
+
+    def close(self) -> None:
+        """Closes the journal file"""
+        with self._lock:
+            self._conn.close()
+
+    def add(self, files: dict, file_sizes: dict = None) -> None:
+        """Adds files to the journal as listed, leaving the state of files already in the journal alone
+        Arguments:
+            files: dictionary of remote file paths to their local save paths
+            file_sizes: optional dictionary of remote file paths to their sizes
+        """
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO files (remote_path, local_path, size, state, updated) "
+                                   "VALUES (?, ?, ?, ?, ?)",
+                                   [(remote_path, local_path, file_sizes.get(remote_path) if file_sizes else None,
+                                     STATE_LISTED, time.time()) for remote_path, local_path in files.items()])
+            self._conn.commit()
+
+    def record(self, remote_path: str, state: str) -> None:
+        """Records that a file has reached a state
+        Arguments:
+            remote_path: the remote path of the file
+            state: the state that was reached
+        """
+        with self._lock:
+            self._conn.execute("INSERT INTO files (remote_path, state, updated) VALUES (?, ?, ?) "
+                               "ON CONFLICT(remote_path) DO UPDATE SET state=excluded.state, updated=excluded.updated",
+                               (remote_path, state, time.time()))
+            self._conn.commit()
+
+    def state(self, remote_path: str) -> str:
+        """Returns the state of a file
+        Arguments:
+            remote_path: the remote path of the file
+        Return:
+            Returns the state of the file, or None if the file isn't in the journal
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM files WHERE remote_path=?", (remote_path,)).fetchone()
+        return row[0] if row else None
+
+    def reached(self, remote_path: str, state: str) -> bool:
+        """Returns whether a file has reached a state
+        Arguments:
+            remote_path: the remote path of the file
+            state: the state to check for
+        Return:
+            Returns True if the file is in the state or a later one
+        """
+        cur_state = self.state(remote_path)
+        return cur_state is not None and STATE_ORDER.index(cur_state) >= STATE_ORDER.index(state)
+
+    def files_in_state(self, state: str) -> dict:
+        """Returns the files that are in a state
+        Arguments:
+            state: the state to look for
+        Return:
+            Returns a dictionary of the remote paths of the files in the state to their local save paths
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT remote_path, local_path FROM files WHERE state=?", (state,)).fetchall()
+        return dict(rows)
@@ -0,0 +1,326 @@
+""" Destinations for the files fetched by the transfer engine: a local folder, iRODS, or nowhere """
+
+import abc
+import logging
+import os
+import subprocess
+from typing import Callable
+
+import concurrency_control
+import file_checksum
+import irods_index
+import irods_upload
+import run_metrics
+import staging_pipeline
+import tiff_overview
+
+# The names of the available sinks
+SINK_LOCAL = 'local'
+SINK_IRODS = 'irods'
+SINK_NULL = 'null'
+SINKS = (SINK_LOCAL, SINK_IRODS, SINK_NULL)
+# The sink deriving 10 percent images, which is chosen by the options of get_10pct.py instead of by name
+SINK_OVERVIEW = 'overview'
+
+
+class Sink(abc.ABC):
+    """Base class of the sinks that receive each file as soon as its transfer finishes
+    Notes:
+        The engine calls open() before handing over any files, put() with each transferred file, and close() once
+        all the transfers have finished. The sink reports on each file it was handed through the callback given
+        to open(), which may be called from another thread
+    """
+
+    name = None
+    # Whether the files stay in the local folder once the sink is finished with them
+    keeps_files = False
+    # Whether the sink stores and verifies the files somewhere else, so they don't need transferring again
+    stores_files = False
+
+    def __init__(self):
+        """Initializes the sink"""
+        self._on_done = None
+
+    def existing(self, file_transfers: dict, file_sizes: dict = None) -> tuple:
+        """Returns the files that are already stored by the sink and don't need transferring
+        Arguments:
+            file_transfers: dictionary of remote file paths to their local save paths
+            file_sizes: optional dictionary of remote file paths to their sizes
+        Return:
+            Returns the remote paths of the files that are already stored
+        """
+        return ()
+
+    def open(self, on_done: Callable[[str, bool], None]) -> None:
+        """Prepares to receive files
+        Arguments:
+            on_done: called with the local path of each file handed to the sink and whether it was stored
+        Exceptions:
+            RuntimeError is raised if the sink's destination can't be used
+        """
+        self._on_done = on_done
+
+    @abc.abstractmethod
+    def put(self, save_path: str) -> None:
+        """Hands over a transferred file, to be implemented by the sinks; this may wait while the sink catches up
+        Arguments:
+            save_path: the local path of the transferred file
+        """
+
+    def close(self) -> None:
+        """Waits until the sink is finished with all the files it was handed"""
+
+
+class LocalSink(Sink):
+    """Keeps the transferred files in the local folder they were saved to"""
+
+    name = SINK_LOCAL
+    keeps_files = True
+
+    def put(self, save_path: str) -> None:
+        """Accepts a transferred file where it is
+        Arguments:
+            save_path: the local path of the transferred file
+        """
+        self._on_done(save_path, True)
+
+
+class NullSink(Sink):
+    """Removes the transferred files, which is useful for measuring the transfers on their own"""
+
+    name = SINK_NULL
+
+    def put(self, save_path: str) -> None:
+        """Removes a transferred file
+        Arguments:
+            save_path: the local path of the transferred file
+        """
+        try:
+            os.remove(save_path)
+        except OSError as ex:
+            logging.warning("Unable to remove transferred file %s: %s", save_path, str(ex))
+            self._on_done(save_path, False)
+            return
+        self._on_done(save_path, True)
+
+
+class OverviewSink(Sink):
+    """Derives the overviews of the transferred mosaics as they arrive, removing the mosaics that were only downloaded
+    to derive from, and keeps the other files where they are
+    Notes:
+        Since the mosaics are removed as soon as their overviews are written, the staging budget limits the bytes of
+        mosaics waiting on the local disk
+    """
+
+    name = SINK_OVERVIEW
+
+    def __init__(self, is_source: Callable[[str], bool], removable: Callable[[str], bool],
+                 max_workers: int = tiff_overview.OVERVIEW_WORKERS, metrics: run_metrics.RunMetrics = None):
+        """Initializes the sink
+        Arguments:
+            is_source: returns whether a transferred file is a mosaic to derive an overview from
+            removable: returns whether a mosaic was downloaded to derive from, and can be removed once that's done;
+                       it's called when the mosaic is handed over
+            max_workers: the number of overviews derived at the same time
+            metrics: optional run metrics to record the derivations in
+        """
+        super().__init__()
+        self._is_source = is_source
+        self._removable = removable
+        self._max_workers = max_workers
+        self._metrics = metrics or run_metrics.RunMetrics()
+        self._workers = None
+
+    def open(self, on_done: Callable[[str, bool], None]) -> None:
+        """Starts the processes deriving the overviews
+        Arguments:
+            on_done: called with the local path of each file handed to the sink and whether it was handled
+        Exceptions:
+            RuntimeError is raised if the GDAL python bindings or NumPy aren't installed
+        """
+        super().open(on_done)
+        self._workers = tiff_overview.OverviewWorkers(self._max_workers)
+
+    def put(self, save_path: str) -> None:
+        """Queues the derivation of the overview of a transferred mosaic, or accepts any other file where it is
+        Arguments:
+            save_path: the local path of the transferred file
+        """
+        if not self._is_source(save_path):
+            self._on_done(save_path, True)
+            return
+
+        overview_path = os.path.join(os.path.dirname(save_path), tiff_overview.overview_name(os.path.basename(save_path)))
+        remove = self._removable(save_path)
+        if os.path.exists(overview_path):
+            self._finish(save_path, remove, True)
+            return
+        self._workers.submit(save_path, overview_path,
+                             lambda source_path, seconds: self._derived(source_path, remove, seconds))
+
+    def _derived(self, save_path: str, remove: bool, seconds: float) -> None:
+        """Records the derivation of an overview
+        Arguments:
+            save_path: the local path of the mosaic
+            remove: whether to remove the mosaic
+            seconds: the number of seconds the derivation took, or None if it failed
+        """
+        if seconds is None:
+            self._metrics.count('derive_failed_files')
+        else:
+            self._metrics.observe('derive_overview', seconds, 1, os.path.getsize(save_path))
+        self._finish(save_path, remove, seconds is not None)
+
+    def _finish(self, save_path: str, remove: bool, succeeded: bool) -> None:
+        """Removes a mosaic that was only downloaded to derive from and reports it
+        Arguments:
+            save_path: the local path of the mosaic
+            remove: whether to remove the mosaic
+            succeeded: whether its overview was derived
+        Notes:
+            A mosaic whose overview couldn't be derived is removed as well, so that it doesn't hold disk space
+            outside of the staging budget; it's downloaded again by the next run
+        """
+        if remove:
+            try:
+                os.remove(save_path)
+            except OSError as ex:
+                logging.warning("Unable to remove mosaic %s: %s", save_path, str(ex))
+        self._on_done(save_path, succeeded)
+
+    def close(self) -> None:
+        """Waits for the queued overviews to be derived and stops the worker processes"""
+        if self._workers:
+            self._workers.close()
+            self._workers = None
+
+
+class IrodsSink(Sink):
+    """Uploads the transferred files into an iRODS collection on worker threads, removing each one once it's finished with
+    Notes:
+        Handing over a file waits while the upload queue is full, which holds back further transfers until the
+        uploads have caught up
+    """
+
+    name = SINK_IRODS
+    stores_files = True
+
+    def __init__(self, irods_location: str, backend: str = irods_upload.BACKEND_IPUT,
+                 num_workers: int = staging_pipeline.STAGING_UPLOAD_WORKERS,
+                 queue_depth: int = staging_pipeline.STAGING_QUEUE_DEPTH, local_checksums: bool = False,
+                 preflight: bool = True, metrics: run_metrics.RunMetrics = None,
+                 controller: concurrency_control.AimdController = None,
+                 retries: int = concurrency_control.RETRY_ATTEMPTS):
+        """Initializes the sink
+        Arguments:
+            irods_location: the iRODS collection to upload files into
+            backend: one of the irods_upload.UPLOAD_BACKENDS values
+            num_workers: the number of uploads that can run at the same time
+            queue_depth: the maximum number of transferred files waiting for upload
+            local_checksums: set to True to compute the digests of both iRODS checksum schemes in one read of each
+                             file and compare them with the checksum iRODS registers, instead of letting the
+                             uploader verify the checksum
+            preflight: set to False to transfer files even if they're already in iRODS with the same size
+            metrics: optional run metrics to record the checksums, uploads and failures in
+            controller: optional controller adjusting the number of uploads running at the same time
+            retries: the number of times a failed upload is retried
+        """
+        super().__init__()
+        self.irods_location = irods_location
+        self._backend = backend
+        self._num_workers = num_workers
+        self._queue_depth = queue_depth
+        self._local_checksums = local_checksums
+        self._preflight = preflight
+        self._metrics = metrics or run_metrics.RunMetrics()
+        self._controller = controller
+        self._retries = retries
+        self._uploader = None
+        self._pipeline = None
+        self._irods_objects = None
+
+    def existing(self, file_transfers: dict, file_sizes: dict = None) -> tuple:
+        """Returns the files that are already in the iRODS collection with the same size
+        Arguments:
+            file_transfers: dictionary of remote file paths to their local save paths
+            file_sizes: optional dictionary of remote file paths to their sizes
+        Return:
+            Returns the remote paths of the files that are already uploaded
+        Notes:
+            The collection is only queried the first time, since the files uploaded after that are the sink's own
+        """
+        if not self._preflight or not file_transfers:
+            return ()
+        if self._irods_objects is None:
+            try:
+                with self._metrics.timed('irods_preflight', files=0):
+                    self._irods_objects = irods_index.build_index(self.irods_location)
+            except RuntimeError as ex:
+                logging.warning("Continuing without checking for files already in iRODS: %s", str(ex))
+                self._irods_objects = irods_index.IrodsIndex()
+
+        found = tuple(remote_path for remote_path in file_transfers
+                      if self._irods_objects.matches(os.path.basename(remote_path),
+                                               file_sizes.get(remote_path) if file_sizes else None))
+        self._metrics.count('skipped_in_irods', len(found))
+        return found
+
+    def open(self, on_done: Callable[[str, bool], None]) -> None:
+        """Checks the iRODS collection exists and starts the uploaders
+        Arguments:
+            on_done: called with the local path of each file handed to the sink and whether it was uploaded
+        Exceptions:
+            RuntimeError is raised if the iRODS collection can't be found
+        """
+        super().open(on_done)
+        resp = subprocess.run(['ils', self.irods_location], stdout=subprocess.PIPE)
+        if resp.returncode != 0:
+            raise RuntimeError("Unable to find iRODS location %s" % self.irods_location)
+
+        self._uploader = irods_upload.create_uploader(self._backend, self.irods_location, self._num_workers)
+        self._pipeline = staging_pipeline.StagingPipeline(self._upload, self._queue_depth, self._num_workers,
+                                                          on_done=self._uploaded, metrics=self._metrics,
+                                                          controller=self._controller, retries=self._retries)
+
+    def _upload(self, save_path: str) -> None:
+        """Uploads a transferred file, checksumming it locally first when asked to
+        Arguments:
+            save_path: the local path of the file
+        Exceptions:
+            RuntimeError is raised if the file can't be uploaded or its stored checksum doesn't match
+        """
+        file_size = os.path.getsize(save_path)
+        digests = None
+        if self._local_checksums:
+            # One read of the file provides the digests of both checksum schemes, so either can be compared
+            with self._metrics.timed('checksum', num_bytes=file_size):
+                digests = file_checksum.compute_digests(save_path)
+        with self._metrics.timed('upload', num_bytes=file_size):
+            self._uploader.upload(save_path, digests)
+
+    def _uploaded(self, save_path: str, succeeded: bool) -> None:
+        """Reports a file the upload workers are finished with
+        Arguments:
+            save_path: the local path of the file
+            succeeded: whether the file was uploaded
+        """
+        if not succeeded:
+            self._metrics.count('upload_failed_files')
+        self._on_done(save_path, succeeded)
+
+    def put(self, save_path: str) -> None:
+        """Queues a transferred file for upload, waiting while the queue is full
+        Arguments:
+            save_path: the local path of the transferred file
+        """
+        self._pipeline.stage(save_path)
+
+    def close(self) -> None:
+        """Waits for the queued files to be uploaded and stops the uploaders"""
+        if self._pipeline:
+            self._pipeline.close()
+            self._pipeline = None
+        if self._uploader:
+            self._uploader.log_summary()
+            self._uploader.close()
+            self._uploader = None